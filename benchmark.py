@@ -0,0 +1,669 @@
+"""Нагрузочный тест бота без Telegram и OpenRouter.
+
+Поднимает локальные заглушки OpenRouter (задержка, поток, ошибки) и
+Telegram Bot API, прогоняет синтетические обновления через
+dp.feed_update и печатает пропускную способность, p50/p99 задержки,
+задержку event loop и RSS.
+
+    python benchmark.py --users 200 --messages 20
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json   # код 1 при регрессии
+
+С --workers бот запускается супервизором с воркерами (config.WORKERS)
+для каждого N из списка. Обновления идут через WorkerPool.dispatch, а
+задержка считается до ответа, пришедшего в заглушку Telegram. Ответы в
+этом режиме не потоковые. Лимиты Bot API и моделей сняты, чтобы
+масштабирование упиралось в процессор, а не во внешние ограничения.
+
+    python benchmark.py --workers 1,2,4 --users 400 --messages 10
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Any
+
+from aiohttp import web
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+import bot as app
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+HOST = "127.0.0.1"
+
+
+# Заглушка OpenRouter
+class MockOpenRouter:
+    """Эндпоинт chat/completions с настраиваемой задержкой и ошибками.
+
+    Кэш промпта как у Anthropic: начало запроса до точки cache_control
+    запоминается, и повтор того же начала засчитывается в cached_tokens.
+    prefill - секунд на 1000 некэшированных токенов промпта.
+    """
+
+    IMAGE_TOKENS = 1000
+
+    def __init__(
+        self,
+        latency: float,
+        jitter: float,
+        chunks: int,
+        chunk_interval: float,
+        error_rate: float,
+        prefill: float = 0.0
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunks = chunks
+        self.chunk_interval = chunk_interval
+        self.error_rate = error_rate
+        self.prefill = prefill
+        self.requests = 0
+        self.errors = 0
+        self.prefixes: set = set()
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def _usage(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        prompt = cached = 0
+        prefix = hashlib.blake2b(digest_size=16)
+        for message in messages:
+            content = message["content"]
+            parts = [{"type": "text", "text": content}] if isinstance(content, str) else content
+            for part in parts:
+                data = {key: value for key, value in part.items() if key != "cache_control"}
+                prefix.update(json.dumps([message["role"], data], sort_keys=True).encode("utf-8"))
+                if data.get("type") == "image_url":
+                    prompt += self.IMAGE_TOKENS
+                else:
+                    prompt += len(data.get("text", "")) // 4 + 1
+                if "cache_control" in part:
+                    key = prefix.hexdigest()
+                    if key in self.prefixes:
+                        cached = prompt
+                    self.prefixes.add(key)
+        self.prompt_tokens += prompt
+        self.cached_tokens += cached
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": self.chunks,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text="injected error")
+
+        usage = self._usage(body["messages"])
+        prefill = (usage["prompt_tokens"] - usage["prompt_tokens_details"]["cached_tokens"]) / 1000 * self.prefill
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)) + prefill)
+        words = [f"слово{i}" for i in range(self.chunks)]
+
+        if not body.get("stream"):
+            return web.json_response({
+                "choices": [{"message": {"role": "assistant", "content": " ".join(words)}}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(b": OPENROUTER PROCESSING\n\n")
+        for word in words:
+            chunk = {"choices": [{"delta": {"content": word + " "}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            if self.chunk_interval:
+                await asyncio.sleep(self.chunk_interval)
+        final = {"choices": [], "usage": usage}
+        await response.write(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def handle_key(self, request: web.Request) -> web.Response:
+        return web.json_response({"data": {"limit": None, "usage": 0.0}})
+
+
+# Заглушка Telegram Bot API
+class MockTelegram:
+    """Ответы Bot API на методы, которые вызывает бот"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self.message_id = 0
+        # Итоговые ответы по чатам (все сообщения, кроме статуса "⏳ ...")
+        self.replies: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self.photo = self._make_photo()
+
+    @staticmethod
+    def _make_photo() -> bytes:
+        if Image is None:
+            return os.urandom(200 * 1024)
+        buffer = io.BytesIO()
+        Image.effect_noise((1280, 960), 64).convert("RGB").save(buffer, "JPEG", quality=90)
+        return buffer.getvalue()
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "sendMessage" and not params.get("text", "").startswith("⏳"):
+            self.replies[int(params.get("chat_id", 0))].put_nowait(time.perf_counter())
+
+        if method in ("sendMessage", "editMessageText"):
+            self.message_id += 1
+            result: Any = {
+                "message_id": int(params.get("message_id") or self.message_id),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        elif method == "getFile":
+            result = {
+                "file_id": params["file_id"],
+                "file_unique_id": params["file_id"],
+                "file_size": len(self.photo),
+                "file_path": f"photos/{params['file_id']}.jpg",
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        self.calls["downloadFile"] = self.calls.get("downloadFile", 0) + 1
+        return web.Response(body=self.photo, content_type="image/jpeg")
+
+
+async def start_server(routes: List[web.RouteDef]) -> web.AppRunner:
+    # Запросы с несколькими фото больше лимита aiohttp по умолчанию (1MB)
+    application = web.Application(client_max_size=64 * 2 ** 20)
+    application.add_routes(routes)
+    runner = web.AppRunner(application, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, 0).start()
+    return runner
+
+def server_url(runner: web.AppRunner) -> str:
+    port = runner.addresses[0][1]
+    return f"http://{HOST}:{port}"
+
+
+# Синтетические обновления
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+
+    def _base(self, user_id: int) -> Dict[str, Any]:
+        self.update_id += 1
+        return {
+            "message_id": self.update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+
+    def text(self, user_id: int, text: str) -> Dict[str, Any]:
+        message = self._base(user_id)
+        message["text"] = text
+        return {"update_id": self.update_id, "message": message}
+
+    def photo(self, user_id: int, file_key: str) -> Dict[str, Any]:
+        message = self._base(user_id)
+        message["photo"] = [
+            {"file_id": f"{file_key}_s", "file_unique_id": f"{file_key}_s", "width": 320, "height": 240, "file_size": 15000},
+            {"file_id": f"{file_key}_m", "file_unique_id": f"{file_key}_m", "width": 800, "height": 600, "file_size": 80000},
+            {"file_id": f"{file_key}_x", "file_unique_id": f"{file_key}_x", "width": 1280, "height": 960, "file_size": 200000},
+        ]
+        return {"update_id": self.update_id, "message": message}
+
+
+# Замеры
+class LoopLagMonitor:
+    """Опоздание пробуждений event loop и пиковый RSS"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags: List[float] = []
+        self.peak_rss = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        ticks = 0
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - started - self.interval))
+            ticks += 1
+            if ticks % 50 == 0:
+                self.peak_rss = max(self.peak_rss, current_rss())
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+def current_rss(pid: Any = "self") -> int:
+    """Текущий RSS в байтах (Linux), иначе пиковый по getrusage"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+# Прогон
+def configure_bot(args: argparse.Namespace, workdir: str, openrouter_url: str, telegram_url: str) -> None:
+    """Перенастройка бота на заглушки и временные файлы"""
+    config = app.config
+    config.ADMIN_ID = 0
+    config.RUN_MODE = "polling"
+    config.STATE_BACKEND = "memory"
+    config.METRICS_ENABLED = False
+    config.STATS_DB_PATH = os.path.join(workdir, "stats.db")
+    config.CONV_SPILL_DIR = os.path.join(workdir, "conversations")
+    config.SNAPSHOT_PATH = os.path.join(workdir, "state.snap")
+    config.STREAM_RESPONSES = args.stream
+    config.DEFAULT_MODEL = args.model
+    config.MESSAGE_DEBOUNCE = args.debounce
+    config.RESPONSE_CACHE_ENABLED = args.cache
+    # Ограничение частоты пользователей мешает измерять пропускную способность
+    config.SCHED_USER_RATE = 1e9
+    config.SCHED_USER_BURST = 10 ** 9
+    config.SCHED_MAX_QUEUE = 10 ** 9
+    config.RETRY_BASE_DELAY = 0.05
+
+    app.ai_service.api_url = f"{openrouter_url}/api/v1/chat/completions"
+    app.bot.session.api = TelegramAPIServer.from_base(telegram_url)
+
+def configure_cluster(workers: int) -> None:
+    """Воркеры и снятие внешних лимитов для замера масштабирования"""
+    config = app.config
+    config.WORKERS = workers
+    config.STREAM_RESPONSES = False
+    config.SEND_GLOBAL_RATE = 1e9
+    config.SEND_CHAT_RATE = 1e9
+    config.SEND_CHAT_BURST = 10 ** 9
+    config.SCHED_MODEL_CONCURRENCY = 10 ** 6
+    for model_info in config.MODELS.values():
+        model_info["max_concurrency"] = 10 ** 6
+
+def next_update(user_id: int, i: int, args: argparse.Namespace, factory: UpdateFactory):
+    if random.random() < args.photo_ratio:
+        return "photo", factory.photo(user_id, f"p{user_id}_{i}")
+    text = "Сколько будет 2+2?" if args.cache else f"Вопрос {i} от {user_id}: объясни тему подробно"
+    return "text", factory.text(user_id, text)
+
+async def simulate_user(
+    user_id: int,
+    args: argparse.Namespace,
+    factory: UpdateFactory,
+    latencies: Dict[str, List[float]],
+    failures: List[str]
+) -> None:
+    """Пользователь отправляет сообщения по одному, дожидаясь ответа"""
+    await asyncio.sleep(random.uniform(0, args.ramp_up))
+    for i in range(args.messages):
+        kind, data = next_update(user_id, i, args, factory)
+        update = Update.model_validate(data, context={"bot": app.bot})
+
+        started = time.perf_counter()
+        try:
+            await app.dp.feed_update(app.bot, update)
+        except Exception as e:
+            failures.append(f"{type(e).__name__}: {e}")
+            continue
+        latencies[kind].append(time.perf_counter() - started)
+
+        if args.think_time:
+            await asyncio.sleep(random.expovariate(1 / args.think_time))
+
+async def check_image_cache(factory: UpdateFactory) -> bool:
+    """Одинаковый вопрос по одинаковому фото без истории: второй раз из кэша ответов"""
+    hits = app.response_cache.hits
+    for user_id in (90001, 90002):
+        for data in (factory.photo(user_id, f"cache{user_id}"), factory.text(user_id, "Что на фото?")):
+            await app.dp.feed_update(app.bot, Update.model_validate(data, context={"bot": app.bot}))
+    return app.response_cache.hits > hits
+
+async def simulate_cluster_user(
+    user_id: int,
+    args: argparse.Namespace,
+    factory: UpdateFactory,
+    pool: "app.WorkerPool",
+    telegram: MockTelegram,
+    latencies: Dict[str, List[float]],
+    failures: List[str]
+) -> None:
+    """То же через супервизор: ответ ждем в заглушке Telegram"""
+    await asyncio.sleep(random.uniform(0, args.ramp_up))
+    replies = telegram.replies[user_id]
+    for i in range(args.messages):
+        kind, data = next_update(user_id, i, args, factory)
+
+        started = time.perf_counter()
+        await pool.dispatch(data)
+        try:
+            answered = await asyncio.wait_for(replies.get(), timeout=args.reply_timeout)
+        except asyncio.TimeoutError:
+            failures.append(f"нет ответа пользователю {user_id} за {args.reply_timeout:.0f}с")
+            continue
+        latencies[kind].append(answered - started)
+
+        if args.think_time:
+            await asyncio.sleep(random.expovariate(1 / args.think_time))
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    random.seed(args.seed)
+    openrouter = MockOpenRouter(
+        args.latency, args.jitter, args.chunks, args.chunk_interval, args.error_rate, args.prefill
+    )
+    telegram = MockTelegram(args.telegram_latency)
+
+    openrouter_runner = await start_server([
+        web.post("/api/v1/chat/completions", openrouter.handle),
+        web.get("/api/v1/auth/key", openrouter.handle_key),
+    ])
+    telegram_runner = await start_server([
+        web.post("/bot{token}/{method}", telegram.handle_method),
+        web.get("/file/bot{token}/{path:.+}", telegram.handle_file),
+    ])
+
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_bot(args, workdir, server_url(openrouter_runner), server_url(telegram_runner))
+        await app.dp.emit_startup(bot=app.bot)
+
+        factory = UpdateFactory()
+        latencies: Dict[str, List[float]] = {"text": [], "photo": []}
+        failures: List[str] = []
+        monitor = LoopLagMonitor()
+        rss_before = current_rss()
+
+        monitor.start()
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(
+                simulate_user(100000 + n, args, factory, latencies, failures)
+                for n in range(args.users)
+            ))
+            elapsed = time.perf_counter() - started
+            image_cache_hit = await check_image_cache(factory) if args.cache else None
+        finally:
+            await monitor.stop()
+            await app.dp.emit_shutdown(bot=app.bot)
+            await app.bot.session.close()
+            await openrouter_runner.cleanup()
+            await telegram_runner.cleanup()
+
+    all_latencies = latencies["text"] + latencies["photo"]
+    result = {
+        "users": args.users,
+        "updates": len(all_latencies),
+        "failures": len(failures),
+        "elapsed": elapsed,
+        "throughput": len(all_latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(all_latencies, 0.5),
+        "p99": percentile(all_latencies, 0.99),
+        "text_p50": percentile(latencies["text"], 0.5),
+        "text_p99": percentile(latencies["text"], 0.99),
+        "photo_p50": percentile(latencies["photo"], 0.5),
+        "photo_p99": percentile(latencies["photo"], 0.99),
+        "loop_lag_p99": percentile(monitor.lags, 0.99),
+        "loop_lag_max": max(monitor.lags, default=0.0),
+        "rss_before_mb": rss_before / 2 ** 20,
+        "rss_peak_mb": monitor.peak_rss / 2 ** 20,
+        "openrouter_requests": openrouter.requests,
+        "openrouter_errors": openrouter.errors,
+        "prompt_tokens": openrouter.prompt_tokens,
+        "cached_tokens": openrouter.cached_tokens,
+        "telegram_calls": dict(sorted(telegram.calls.items())),
+        "response_cache": app.response_cache.get_stats(),
+    }
+    if image_cache_hit is not None:
+        result["image_cache_hit"] = image_cache_hit
+    if failures:
+        result["failure_sample"] = failures[:5]
+    return result
+
+async def run_cluster(args: argparse.Namespace, workers: int) -> Dict[str, Any]:
+    random.seed(args.seed)
+    openrouter = MockOpenRouter(
+        args.latency, args.jitter, args.chunks, args.chunk_interval, args.error_rate, args.prefill
+    )
+    telegram = MockTelegram(args.telegram_latency)
+
+    openrouter_runner = await start_server([
+        web.post("/api/v1/chat/completions", openrouter.handle),
+        web.get("/api/v1/auth/key", openrouter.handle_key),
+    ])
+    telegram_runner = await start_server([
+        web.post("/bot{token}/{method}", telegram.handle_method),
+        web.get("/file/bot{token}/{path:.+}", telegram.handle_file),
+    ])
+
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_bot(args, workdir, server_url(openrouter_runner), server_url(telegram_runner))
+        configure_cluster(workers)
+        pool = app.WorkerPool(workers)
+        await pool.start()
+
+        factory = UpdateFactory()
+        latencies: Dict[str, List[float]] = {"text": [], "photo": []}
+        failures: List[str] = []
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(
+                simulate_cluster_user(100000 + n, args, factory, pool, telegram, latencies, failures)
+                for n in range(args.users)
+            ))
+            elapsed = time.perf_counter() - started
+            stats = pool.get_stats()
+            rss_workers = sum(current_rss(worker["pid"]) for worker in stats["workers"] if worker["alive"])
+        finally:
+            await pool.close()
+            await openrouter_runner.cleanup()
+            await telegram_runner.cleanup()
+
+    all_latencies = latencies["text"] + latencies["photo"]
+    result = {
+        "workers": workers,
+        "users": args.users,
+        "updates": len(all_latencies),
+        "failures": len(failures),
+        "elapsed": elapsed,
+        "throughput": len(all_latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(all_latencies, 0.5),
+        "p99": percentile(all_latencies, 0.99),
+        "rss_workers_mb": rss_workers / 2 ** 20,
+        "restarts": stats["restarts"],
+        "openrouter_requests": openrouter.requests,
+        "telegram_calls": dict(sorted(telegram.calls.items())),
+    }
+    if failures:
+        result["failure_sample"] = failures[:5]
+    return result
+
+async def run_scaling(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    for workers in args.workers:
+        results.append(await run_cluster(args, workers))
+    return results
+
+def format_report(result: Dict[str, Any], args: argparse.Namespace) -> str:
+    lines = [
+        "=" * 60,
+        f"Пользователей: {result['users']}, сообщений на пользователя: {args.messages}, "
+        f"фото: {args.photo_ratio:.0%}",
+        f"Модель: {args.model}, поток: {'да' if args.stream else 'нет'}, "
+        f"задержка модели: {args.latency:.2f}±{args.jitter:.2f}с, ошибки: {args.error_rate:.0%}",
+        "-" * 60,
+        f"Обновлений: {result['updates']} за {result['elapsed']:.1f}с, ошибок: {result['failures']}",
+        f"Пропускная способность: {result['throughput']:.1f} обновлений/с",
+        f"Задержка: p50 {result['p50'] * 1000:.0f}мс, p99 {result['p99'] * 1000:.0f}мс",
+        f"  текст: p50 {result['text_p50'] * 1000:.0f}мс, p99 {result['text_p99'] * 1000:.0f}мс",
+        f"  фото:  p50 {result['photo_p50'] * 1000:.0f}мс, p99 {result['photo_p99'] * 1000:.0f}мс",
+        f"Задержка event loop: p99 {result['loop_lag_p99'] * 1000:.1f}мс, "
+        f"макс. {result['loop_lag_max'] * 1000:.1f}мс",
+        f"RSS: {result['rss_before_mb']:.0f}MB -> пик {result['rss_peak_mb']:.0f}MB",
+        f"OpenRouter: {result['openrouter_requests']} запросов, {result['openrouter_errors']} ошибок, "
+        f"из кэша {result['cached_tokens']} из {result['prompt_tokens']} токенов промпта",
+        "Telegram: " + ", ".join(f"{k} {v}" for k, v in result["telegram_calls"].items()),
+    ]
+    if "image_cache_hit" in result:
+        cache = result["response_cache"]
+        lines.append(
+            f"Кэш ответов: {cache['hits']} попаданий, {cache['misses']} промахов, "
+            f"вопрос по фото из кэша: {'да' if result['image_cache_hit'] else 'НЕТ'}"
+        )
+    for failure in result.get("failure_sample", []):
+        lines.append(f"  ! {failure}")
+    lines.append("=" * 60)
+    return "\n".join(lines)
+
+def format_scaling_report(results: List[Dict[str, Any]], args: argparse.Namespace) -> str:
+    base = results[0]["throughput"] or 1.0
+    lines = [
+        "=" * 60,
+        f"Пользователей: {args.users}, сообщений на пользователя: {args.messages}, "
+        f"фото: {args.photo_ratio:.0%}, ядер: {os.cpu_count()}",
+        f"Модель: {args.model}, задержка модели: {args.latency:.2f}±{args.jitter:.2f}с",
+        "-" * 60,
+        f"{'воркеров':>8} {'обн/с':>8} {'ускор.':>7} {'p50, мс':>8} {'p99, мс':>8} {'RSS, MB':>8} {'ошибок':>7}",
+    ]
+    for result in results:
+        lines.append(
+            f"{result['workers']:>8} {result['throughput']:>8.1f} {result['throughput'] / base:>6.2f}x "
+            f"{result['p50'] * 1000:>8.0f} {result['p99'] * 1000:>8.0f} "
+            f"{result['rss_workers_mb']:>8.0f} {result['failures']:>7}"
+        )
+        for failure in result.get("failure_sample", []):
+            lines.append(f"  ! {failure}")
+    lines.append("=" * 60)
+    return "\n".join(lines)
+
+# Метрики, по которым рост считается регрессией
+REGRESSION_KEYS = ("p50", "p99", "loop_lag_p99", "rss_peak_mb")
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Метрики, ухудшившиеся больше чем на threshold (доля)"""
+    regressions = []
+    for key in REGRESSION_KEYS:
+        before, after = baseline.get(key), result.get(key)
+        if before and after is not None and after > before * (1 + threshold):
+            regressions.append(f"{key}: {before:.4g} -> {after:.4g} (+{(after / before - 1) * 100:.0f}%)")
+    before, after = baseline.get("throughput"), result.get("throughput")
+    if before and after is not None and after < before * (1 - threshold):
+        regressions.append(f"throughput: {before:.4g} -> {after:.4g} (-{(1 - after / before) * 100:.0f}%)")
+    return regressions
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест AI Assistant")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=10, help="сообщений на пользователя")
+    parser.add_argument("--photo-ratio", type=float, default=0.1)
+    parser.add_argument("--think-time", type=float, default=0.0, help="средняя пауза пользователя, с")
+    parser.add_argument("--ramp-up", type=float, default=1.0, help="разброс старта пользователей, с")
+    parser.add_argument("--model", default=app.config.DEFAULT_MODEL)
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=app.config.STREAM_RESPONSES)
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=False,
+                        help="одинаковые вопросы без истории (проверка кэша ответов)")
+    parser.add_argument("--debounce", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка модели, с")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--chunks", type=int, default=40, help="фрагментов в ответе")
+    parser.add_argument("--chunk-interval", type=float, default=0.005)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--prefill", type=float, default=0.0, help="с на 1000 некэшированных токенов промпта")
+    parser.add_argument("--telegram-latency", type=float, default=0.005)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=lambda value: [int(n) for n in value.split(",")],
+                        help="список числа воркеров для замера масштабирования, например 1,2,4")
+    parser.add_argument("--reply-timeout", type=float, default=60.0, help="ожидание ответа в режиме --workers, с")
+    parser.add_argument("--save", help="сохранить результат в JSON")
+    parser.add_argument("--compare", help="сравнить с сохраненным результатом")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое ухудшение (доля)")
+    parser.add_argument("--output", help="дописать отчет в файл")
+    parser.add_argument("--verbose", action="store_true", help="логи бота (ошибки заглушек)")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    level = logging.WARNING if args.verbose else logging.CRITICAL
+    logging.getLogger().setLevel(level)
+    # воркеры настраивают журнал заново после fork
+    app.config.LOG_LEVEL = logging.getLevelName(level)
+
+    if args.workers:
+        results = asyncio.run(run_scaling(args))
+        report = format_scaling_report(results, args)
+        print(report)
+        if args.output:
+            with open(args.output, "a", encoding="utf-8") as f:
+                f.write(report + "\n")
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        return 0
+
+    result = asyncio.run(run(args))
+    report = format_report(result, args)
+    print(report)
+
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(report + "\n")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if result.get("image_cache_hit") is False:
+        print("Повторный вопрос по фото не попал в кэш ответов")
+        return 1
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.threshold)
+        if regressions:
+            print("Регрессия относительно " + args.compare + ":")
+            for line in regressions:
+                print("  " + line)
+            return 1
+        print(f"Регрессий нет (порог {args.threshold:.0%})")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
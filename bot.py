@@ -1,24 +1,59 @@
 import asyncio
 import logging
+import logging.handlers
 import base64
 import time
-from typing import Dict, List, Optional, Any, Tuple
+import json
+import math
+import heapq
+import hashlib
+import sqlite3
+import threading
+import os
+import zlib
+import struct
+import mmap
+import io
+import urllib.parse
+import random
+import bisect
+import re
+import signal
+import tempfile
+import queue
+import copy
+import multiprocessing
+from abc import ABC, abstractmethod
+from email.utils import parsedate_to_datetime
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Dict, List, Optional, Any, Tuple, AsyncIterator, Callable, Awaitable
 from dataclasses import dataclass, field
-from datetime import datetime, timedelta
-from collections import defaultdict
+from datetime import datetime, timedelta, date
+from collections import defaultdict, OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 
 from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, PhotoSize
 from aiogram.filters import Command, CommandStart
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 import aiohttp
+from aiohttp import web
+
+try:
+    from PIL import Image
+except ImportError:  # без Pillow изображения отправляются без уменьшения
+    Image = None
+
+try:
+    import orjson
+except ImportError:  # без orjson тела запросов кодирует стандартный json
+    orjson = None
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
 logger = logging.getLogger(__name__)
 
 # Конфигурация
@@ -34,258 +69,4231 @@ class Config:
     # Админ ID
     ADMIN_ID: int = 8154266510
     
-    # Модели
+    # Модели. prompt_cache - модель принимает точки cache_control
+    # (Anthropic, Gemini); OpenAI и DeepSeek кэшируют начало запроса сами
     MODELS: Dict[str, Dict[str, Any]] = field(default_factory=lambda: {
         "gemini": {
             "name": "Google Gemini 3 Flash",
             "id": "google/gemini-3-flash-preview",
             "supports_images": True,
-            "description": "Анализ изображений и текста"
+            "description": "Анализ изображений и текста",
+            "context_tokens": 8000,
+            "max_image_side": 3072,
+            "prompt_cache": True
         },
         "gpt4": {
             "name": "GPT-4o Mini",
             "id": "openai/gpt-4o-mini",
             "supports_images": True,
-            "description": "Универсальная модель"
+            "description": "Универсальная модель",
+            "context_tokens": 6000,
+            "max_image_side": 2048
         },
         "claude": {
             "name": "Claude 4.5 Opus",
             "id": "anthropic/claude-opus-4.5",
             "supports_images": True,
-            "description": "Детальный анализ"
+            "description": "Детальный анализ",
+            "context_tokens": 6000,
+            "max_concurrency": 4,
+            "max_image_side": 1568,
+            "prompt_cache": True
         },
         "deepseek": {
             "name": "DeepSeek R1",
             "id": "deepseek/deepseek-r1",
             "supports_images": False,
-            "description": "Текстовая модель"
+            "description": "Текстовая модель",
+            "context_tokens": 6000,
+            "max_concurrency": 4
         }
     })
     
-    DEFAULT_MODEL: str = "gemini"
+    DEFAULT_MODEL: str = "gemini"      # ключ из MODELS или AUTO_MODEL
+    
+    # Автоматический выбор модели
+    AUTO_MODEL: str = "auto"
+    ROUTER_EWMA_ALPHA: float = 0.2
+    ROUTER_DEFAULT_LATENCY: float = 5.0  # оценка для модели без замеров, секунд
+    ROUTER_ERROR_PENALTY: float = 4.0    # рост оценки задержки на долю ошибок
+    ROUTER_EXPLORE: float = 0.05         # доля запросов в случайную модель
+    ROUTER_SAMPLES: int = 200            # замеров на модель для p95
+    HEDGE_ENABLED: bool = True           # дублировать медленный запрос (поток - до первого события) в следующую модель
+    HEDGE_MIN_SAMPLES: int = 20
+    HEDGE_MIN_DELAY: float = 2.0
+    
+    # Режим работы: "polling" (разработка) или "webhook"
+    RUN_MODE: str = "polling"
+    WEBHOOK_URL: str = ""        # внешний адрес; пустой - webhook не регистрируется (локальные тесты)
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_SECRET: str = ""     # проверяется в X-Telegram-Bot-Api-Secret-Token
+    WEBAPP_HOST: str = "0.0.0.0"
+    WEBAPP_PORT: int = 8080
     
     # Настройки бота
     MAX_MESSAGE_LENGTH: int = 4000
     MAX_HISTORY_LENGTH: int = 10
     MAX_IMAGE_SIZE_MB: int = 5
+    MAX_IMAGES_PER_REQUEST: int = 5     # фото альбома, прикладываемых к одному запросу
+    MAX_IMAGES_TOTAL_MB: int = 15       # суммарный размер этих фото
+    ALBUM_WAIT: float = 0.5             # ожидание остальных частей альбома, секунд
+    
+    # HTTP клиент
+    HTTP_TIMEOUT: float = 60.0
+    HTTP_CONNECT_TIMEOUT: float = 10.0
+    HTTP_POOL_LIMIT: int = 100
+    HTTP_POOL_LIMIT_PER_HOST: int = 30
+    HTTP_KEEPALIVE_TIMEOUT: float = 75.0
+    HTTP_DNS_CACHE_TTL: int = 300
+    
+    # Потоковые ответы
+    STREAM_RESPONSES: bool = True
+    STREAM_EDIT_INTERVAL: float = 1.0  # секунд между правками сообщения
+    
+    # Хранилище состояния: "memory" (один процесс) или "redis" (несколько реплик)
+    STATE_BACKEND: str = "memory"
+    REDIS_URL: str = "redis://localhost:6379/0"
+    STATE_CACHE_TTL: float = 1.0     # локальный кэш чтений из общего хранилища, секунд
+    STATE_CACHE_SIZE: int = 10000
+    
+    # Статистика
+    STATS_HOURLY_DAYS: int = 7   # глубина почасовых счетчиков
+    STATS_DAILY_DAYS: int = 31   # глубина посуточных счетчиков
+    STATS_TOP_K: int = 50
+    STATS_HLL_PRECISION: int = 10
+    STATS_DB_PATH: str = "stats.db"  # пустая строка - без сохранения
+    STATS_FLUSH_INTERVAL: float = 5.0
+    STATS_VIEW_TTL: float = 30.0  # сводка админа в режиме воркеров
+    STATS_COMPACT_INTERVAL: float = 3600.0
+    STATS_RETENTION_DAYS: int = 90
+    BALANCE_REFRESH_INTERVAL: float = 300.0  # фоновое обновление баланса OpenRouter
+    
+    # История диалогов
+    CONV_MEMORY_BUDGET_MB: int = 64
+    CONV_COLD_AFTER: float = 600.0      # сжатие после N секунд простоя
+    CONV_IDLE_TTL: float = 3600.0       # выгрузка на диск после N секунд простоя
+    CONV_SPILL_DIR: str = "conversations"  # пустая строка - выгруженная история удаляется
+    CONV_SPILL_TTL: float = 30 * 24 * 3600.0  # срок хранения выгруженной истории на диске
+    CONV_SPILL_SWEEP_INTERVAL: float = 3600.0
+    CONV_MAINTENANCE_INTERVAL: float = 60.0
+    CONV_SHARED_TTL: float = 30 * 24 * 3600.0  # срок хранения истории в общем хранилище
+    
+    # Остановка и теплый перезапуск
+    SHUTDOWN_DRAIN_TIMEOUT: float = 20.0  # ожидание начатых ответов при остановке
+    SNAPSHOT_PATH: str = "state.snap"     # пустая строка - состояние не сохраняется
+    
+    # Бюджет контекста и краткое содержание старых сообщений
+    HISTORY_TOKEN_BUDGET: int = 4000   # если у модели не задан context_tokens
+    SUMMARY_MODEL: str = "gpt4"
+    SUMMARY_MAX_TOKENS: int = 400
+    SUMMARY_TARGET_RATIO: float = 0.6  # доля бюджета после сворачивания
+    SUMMARY_MAX_PENDING: int = 40
+    
+    # Обработка изображений
+    IMAGE_WORKERS: int = 2
+    IMAGE_USE_PROCESSES: bool = False  # True - пул процессов вместо потоков
+    IMAGE_MAX_SIDE: int = 2048         # если у модели не задан max_image_side
+    IMAGE_JPEG_QUALITY: int = 85
+    IMAGE_CACHE_MB: int = 128
+    IMAGE_CACHE_TTL: float = 3600.0
+    
+    # Тело запроса к OpenRouter пишется потоком, base64 изображений - блоками
+    JSON_CODEC: str = "auto"           # auto (orjson, если установлен) или json
+    REQUEST_CHUNK_KB: int = 48
+    
+    # Очередь сообщений пользователя
+    MESSAGE_DEBOUNCE: float = 0.3  # окно объединения быстрых сообщений, секунд
+    
+    # Планировщик запросов к моделям
+    SCHED_MODEL_CONCURRENCY: int = 8   # если у модели не задан max_concurrency
+    SCHED_MAX_QUEUE: int = 200
+    SCHED_USER_RATE: float = 10.0      # запросов в минуту
+    SCHED_USER_BURST: int = 5
+    
+    # Повторы и резервные модели
+    RETRY_ATTEMPTS: int = 2
+    RETRY_BASE_DELAY: float = 0.5
+    RETRY_MAX_DELAY: float = 10.0
+    RETRY_STATUSES: Tuple[int, ...] = (408, 429, 500, 502, 503, 504)
+    BREAKER_FAILURE_THRESHOLD: int = 5
+    BREAKER_RESET_TIMEOUT: float = 30.0
+    FALLBACK_ORDER: List[str] = field(default_factory=lambda: ["claude", "gpt4", "gemini"])
+    
+    # Кэш ответов на запросы без истории
+    RESPONSE_CACHE_ENABLED: bool = True
+    RESPONSE_CACHE_MB: int = 16
+    RESPONSE_CACHE_TTL: float = 3600.0
+    
+    # Метрики в формате Prometheus
+    METRICS_ENABLED: bool = True
+    METRICS_HOST: str = "127.0.0.1"  # только локально, наружу не публикуется
+    METRICS_PORT: int = 9100
+    
+    # Исходящие вызовы Telegram (лимиты Bot API)
+    SEND_GLOBAL_RATE: float = 30.0   # сообщений в секунду на бота
+    SEND_CHAT_RATE: float = 1.0      # сообщений в секунду в один чат
+    SEND_CHAT_BURST: int = 3
+    SEND_MAX_RETRIES: int = 3        # повторов после TelegramRetryAfter
+    SEND_DRAIN_TIMEOUT: float = 10.0 # дослать очередь при остановке
+    
+    # Несколько процессов: супервизор принимает обновления (polling или
+    # webhook) и раздает их воркерам по from_user.id. Общие лимиты
+    # (SEND_GLOBAL_RATE, max_concurrency моделей) делятся между воркерами,
+    # метрики воркера i - на METRICS_PORT + i
+    WORKERS: int = 1                 # 1 - один процесс без супервизора
+    WORKER_VNODES: int = 64          # точек воркера на кольце хешей
+    WORKER_BATCH: int = 100          # обновлений в одной пересылке воркеру
+    WORKER_QUEUE_SIZE: int = 10000   # очередь воркера, дальше прием ждет
+    WORKER_RESTART_DELAY: float = 1.0
+    WORKER_RESTART_MAX_DELAY: float = 30.0
+    WORKER_STOP_TIMEOUT: float = 40.0  # больше SHUTDOWN_DRAIN_TIMEOUT + SEND_DRAIN_TIMEOUT
+    
+    # Журнал: записи идут через очередь, в stderr их пишет отдельный поток
+    LOG_LEVEL: str = "INFO"
+    LOG_FORMAT: str = "json"         # json - запись одной строкой JSON, text - как раньше
+    LOG_QUEUE_SIZE: int = 10000      # при переполнении записи отбрасываются
+    LOG_MAX_FIELD: int = 1000        # длиннее обрезается (тела ошибок API, трассировки)
+    LOG_SAMPLE_WINDOW: float = 60.0  # окно выборки предупреждений и ошибок, секунд
+    LOG_SAMPLE_BURST: int = 5        # записей с одного места кода за окно
 
 config = Config()
 
+# Настройка логирования
+LOG_TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+LOG_FIELDS = ("user_id", "model", "status", "latency", "duration", "tokens", "suppressed")
+
+def truncate_text(value: str, limit: int, tail: bool = False) -> str:
+    """Обрезка длинной строки; tail=True сохраняет конец (трассировки)"""
+    if len(value) <= limit:
+        return value
+    if tail:
+        return f"... (+{len(value) - limit}) {value[-limit:]}"
+    return f"{value[:limit]}... (+{len(value) - limit})"
+
+
+class LogSampler(logging.Filter):
+    """Выборка повторяющихся предупреждений и ошибок.
+    
+    С одного места кода (отдельно для каждой модели и статуса из extra)
+    за LOG_SAMPLE_WINDOW проходит LOG_SAMPLE_BURST записей, остальные
+    отбрасываются. Первая запись следующего окна несет число пропущенных
+    в поле suppressed.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        # (файл, строка, модель, статус) -> [начало окна, пропущено записей, отброшено]
+        self.windows: Dict[Tuple[Any, ...], List[float]] = {}
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        # Ошибки разных моделей и статусов с одной строки считаются отдельно
+        key = (
+            record.pathname,
+            record.lineno,
+            getattr(record, "model", None),
+            getattr(record, "status", None),
+        )
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= config.LOG_SAMPLE_WINDOW:
+                if window is not None and window[2]:
+                    record.suppressed = int(window[2])
+                window = self.windows[key] = [now, 0, 0]
+            if window[1] >= config.LOG_SAMPLE_BURST:
+                window[2] += 1
+                metrics.log_dropped.inc("sampled")
+                return False
+            window[1] += 1
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Постановка записи в очередь без ожидания.
+    
+    Сообщение и трассировка собираются и обрезаются в вызывающем потоке,
+    форматирование и запись в поток вывода - в потоке QueueListener.
+    """
+    
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.exc_formatter = logging.Formatter()
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = truncate_text(record.getMessage(), config.LOG_MAX_FIELD)
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = truncate_text(
+                self.exc_formatter.formatException(record.exc_info),
+                config.LOG_MAX_FIELD * 4,
+                tail=True
+            )
+            record.exc_info = None
+        return record
+    
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.log_dropped.inc("queue_full")
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись одной строкой JSON: время, уровень, логгер, текст и поля LOG_FIELDS"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for name in LOG_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogPipeline:
+    """Журнал через очередь: вызовы logger не ждут записи в stderr"""
+    
+    def __init__(self):
+        self.listener: Optional[logging.handlers.QueueListener] = None
+        self.pid = 0
+    
+    def start(self) -> None:
+        """Настройка корневого логгера. В процессе после fork поток
+        записи родителя не существует, поэтому запускается свой."""
+        if self.listener is not None and self.pid == os.getpid():
+            return
+        stream = logging.StreamHandler()
+        stream.setFormatter(
+            JsonFormatter() if config.LOG_FORMAT == "json" else logging.Formatter(LOG_TEXT_FORMAT)
+        )
+        log_queue: queue.Queue = queue.Queue(config.LOG_QUEUE_SIZE)
+        handler = LogQueueHandler(log_queue)
+        handler.addFilter(LogSampler())
+        
+        root = logging.getLogger()
+        for old in root.handlers[:]:
+            root.removeHandler(old)
+        root.addHandler(handler)
+        root.setLevel(config.LOG_LEVEL)
+        
+        self.listener = logging.handlers.QueueListener(log_queue, stream)
+        self.listener.start()
+        self.pid = os.getpid()
+    
+    def stop(self) -> None:
+        """Запись оставшихся в очереди записей перед выходом процесса"""
+        if self.listener is None or self.pid != os.getpid():
+            return
+        while True:
+            try:
+                self.listener.stop()
+                break
+            except queue.Full:  # маркер остановки ждет места в очереди
+                time.sleep(0.05)
+        self.listener = None
+
+log_pipeline = LogPipeline()
+
+# Хранилище состояния
+class StateBackend(ABC):
+    """Интерфейс хранилища состояния бота.
+    
+    shared=True означает, что данные видят все реплики бота, и локальные
+    копии нужно периодически перечитывать.
+    """
+    
+    shared = False
+    
+    @abstractmethod
+    async def get(self, key: str, cached: bool = True) -> Optional[bytes]:
+        ...
+    
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        ...
+    
+    @abstractmethod
+    async def delete(self, *keys: str) -> None:
+        ...
+    
+    @abstractmethod
+    async def hset(self, key: str, field: str, value: str) -> None:
+        ...
+    
+    @abstractmethod
+    async def hsetnx(self, key: str, field: str, value: str) -> None:
+        ...
+    
+    @abstractmethod
+    async def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        ...
+    
+    @abstractmethod
+    async def hdel(self, key: str, *fields: str) -> None:
+        ...
+    
+    def items(self, prefix: str) -> List[Tuple[str, bytes]]:
+        """Все значения с ключами на prefix. Есть только у локального
+        хранилища: общее не копируется в снимок состояния"""
+        return []
+    
+    @abstractmethod
+    async def hgetall(self, key: str) -> Dict[str, str]:
+        ...
+    
+    async def close(self) -> None:
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """Состояние в памяти процесса"""
+    
+    def __init__(self):
+        self.values: Dict[str, Tuple[bytes, Optional[float]]] = {}
+        self.hashes: Dict[str, Dict[str, str]] = defaultdict(dict)
+    
+    async def get(self, key: str, cached: bool = True) -> Optional[bytes]:
+        item = self.values.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires < time.monotonic():
+            del self.values[key]
+            return None
+        return value
+    
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self.values[key] = (value, time.monotonic() + ttl if ttl else None)
+    
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self.values.pop(key, None)
+            self.hashes.pop(key, None)
+    
+    async def hset(self, key: str, field: str, value: str) -> None:
+        self.hashes[key][field] = value
+    
+    async def hsetnx(self, key: str, field: str, value: str) -> None:
+        self.hashes[key].setdefault(field, value)
+    
+    async def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        value = int(self.hashes[key].get(field, 0)) + amount
+        self.hashes[key][field] = str(value)
+        return value
+    
+    async def hdel(self, key: str, *fields: str) -> None:
+        for field in fields:
+            self.hashes[key].pop(field, None)
+    
+    async def hgetall(self, key: str) -> Dict[str, str]:
+        return dict(self.hashes.get(key, {}))
+    
+    def items(self, prefix: str) -> List[Tuple[str, bytes]]:
+        now = time.monotonic()
+        return [
+            (key, value)
+            for key, (value, expires) in self.values.items()
+            if key.startswith(prefix) and (expires is None or expires >= now)
+        ]
+
+
+class RedisError(Exception):
+    """Ошибка, возвращенная сервером Redis"""
+
+
+class RedisBackend(StateBackend):
+    """Состояние в Redis (протокол RESP2) для нескольких реплик.
+    
+    Команды, отправленные за одну итерацию event loop, уходят на сервер
+    одной записью (автоматический pipelining), ответы разбираются по
+    порядку. Чтения кэшируются локально на STATE_CACHE_TTL секунд.
+    """
+    
+    shared = True
+    
+    def __init__(self, url: str):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        self.connect_lock = asyncio.Lock()
+        
+        self.pending: deque = deque()
+        self.outgoing: List[bytes] = []
+        self.outgoing_futures: List[asyncio.Future] = []
+        self.flush_scheduled = False
+        
+        self.cache: "OrderedDict[str, Tuple[Optional[bytes], float]]" = OrderedDict()
+        self.commands = 0
+        self.batches = 0
+    
+    @staticmethod
+    def _encode(args: Tuple[Any, ...]) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(out)
+    
+    async def _read_reply(self, reader: asyncio.StreamReader) -> Any:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Redis закрыл соединение")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b"+":
+            return rest.decode("utf-8")
+        if prefix == b"-":
+            return RedisError(rest.decode("utf-8"))
+        if prefix == b":":
+            return int(rest)
+        if prefix == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            return (await reader.readexactly(length + 2))[:-2]
+        if prefix == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [await self._read_reply(reader) for _ in range(length)]
+        raise ConnectionError(f"Неизвестный ответ Redis: {line!r}")
+    
+    async def _read_loop(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                reply = await self._read_reply(reader)
+                future = self.pending.popleft()
+                if future.done():
+                    continue
+                if isinstance(reply, RedisError):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except (asyncio.CancelledError, Exception) as e:
+            self._fail_all(e if isinstance(e, Exception) else ConnectionError("Соединение закрыто"))
+            if isinstance(e, asyncio.CancelledError):
+                raise
+    
+    def _fail_all(self, error: Exception) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        for future in list(self.pending) + self.outgoing_futures:
+            if not future.done():
+                future.set_exception(ConnectionError(f"Redis недоступен: {error}"))
+        self.pending.clear()
+        self.outgoing.clear()
+        self.outgoing_futures = []
+    
+    async def _connect(self) -> None:
+        if self.writer is not None:
+            return
+        async with self.connect_lock:
+            if self.writer is not None:
+                return
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            # AUTH и SELECT уходят одним пакетом до публикации writer,
+            # иначе команды других корутин попадут в базу 0
+            handshake = []
+            if self.password:
+                handshake.append(("AUTH", self.password))
+            if self.db:
+                handshake.append(("SELECT", self.db))
+            try:
+                writer.write(b"".join(self._encode(args) for args in handshake))
+                for _ in handshake:
+                    reply = await self._read_reply(reader)
+                    if isinstance(reply, RedisError):
+                        raise reply
+            except BaseException:
+                writer.close()
+                raise
+            self.reader, self.writer = reader, writer
+            self.reader_task = asyncio.create_task(self._read_loop(reader))
+    
+    def _flush(self) -> None:
+        self.flush_scheduled = False
+        if not self.outgoing:
+            return
+        if self.writer is None:
+            self._fail_all(ConnectionError("нет соединения"))
+            return
+        data = b"".join(self.outgoing)
+        self.pending.extend(self.outgoing_futures)
+        self.outgoing = []
+        self.outgoing_futures = []
+        self.writer.write(data)
+        self.batches += 1
+    
+    async def execute(self, *args: Any) -> Any:
+        """Выполнение команды (объединяется с соседними в один пакет)"""
+        await self._connect()
+        future = asyncio.get_running_loop().create_future()
+        self.outgoing.append(self._encode(args))
+        self.outgoing_futures.append(future)
+        self.commands += 1
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+        return await future
+    
+    def _cache_put(self, key: str, value: Optional[bytes]) -> None:
+        if config.STATE_CACHE_TTL <= 0:
+            return
+        self.cache[key] = (value, time.monotonic() + config.STATE_CACHE_TTL)
+        self.cache.move_to_end(key)
+        while len(self.cache) > config.STATE_CACHE_SIZE:
+            self.cache.popitem(last=False)
+    
+    async def get(self, key: str, cached: bool = True) -> Optional[bytes]:
+        if cached:
+            item = self.cache.get(key)
+            if item is not None and item[1] >= time.monotonic():
+                return item[0]
+        value = await self.execute("GET", key)
+        if cached:
+            self._cache_put(key, value)
+        return value
+    
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        if ttl:
+            await self.execute("SET", key, value, "PX", int(ttl * 1000))
+        else:
+            await self.execute("SET", key, value)
+        if key in self.cache:
+            self._cache_put(key, value)
+    
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self.cache.pop(key, None)
+        await self.execute("DEL", *keys)
+    
+    async def hset(self, key: str, field: str, value: str) -> None:
+        await self.execute("HSET", key, field, value)
+    
+    async def hsetnx(self, key: str, field: str, value: str) -> None:
+        await self.execute("HSETNX", key, field, value)
+    
+    async def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        return await self.execute("HINCRBY", key, field, amount)
+    
+    async def hdel(self, key: str, *fields: str) -> None:
+        if fields:
+            await self.execute("HDEL", key, *fields)
+    
+    async def hgetall(self, key: str) -> Dict[str, str]:
+        reply = await self.execute("HGETALL", key) or []
+        return {
+            reply[i].decode("utf-8"): reply[i + 1].decode("utf-8")
+            for i in range(0, len(reply), 2)
+        }
+    
+    async def close(self) -> None:
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.reader_task = None
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+def create_state_backend() -> StateBackend:
+    if config.STATE_BACKEND == "redis":
+        return RedisBackend(config.REDIS_URL)
+    return MemoryBackend()
+
+state_backend = create_state_backend()
+
+# Агрегаты для статистики
+class RingCounter:
+    """Кольцевой буфер счетчиков по временным корзинам"""
+    
+    def __init__(self, size: int):
+        self.size = size
+        self.ids: List[int] = [-1] * size
+        self.counts: List[int] = [0] * size
+    
+    def add(self, bucket: int, amount: int = 1) -> None:
+        i = bucket % self.size
+        if self.ids[i] != bucket:
+            self.ids[i] = bucket
+            self.counts[i] = 0
+        self.counts[i] += amount
+    
+    def items(self, first_bucket: int) -> List[Tuple[int, int]]:
+        """Корзины с номером >= first_bucket"""
+        return [
+            (bucket, count)
+            for bucket, count in zip(self.ids, self.counts)
+            if bucket >= first_bucket and count
+        ]
+    
+    def total(self, first_bucket: int) -> int:
+        return sum(count for _, count in self.items(first_bucket))
+
+
+class HyperLogLog:
+    """Приближенный подсчет уникальных значений"""
+    
+    def __init__(self, precision: int = 10):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+    
+    def add(self, value: int) -> None:
+        h = int.from_bytes(
+            hashlib.blake2b(value.to_bytes(8, "big", signed=True), digest_size=8).digest(),
+            "big"
+        )
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    def merge(self, other: "HyperLogLog") -> None:
+        self.registers = bytearray(map(max, self.registers, other.registers))
+    
+    def clear(self) -> None:
+        self.registers = bytearray(self.m)
+    
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+
+class StatsStore:
+    """Хранилище статистики в SQLite (WAL).
+    
+    Запросы к базе выполняются в фоновом потоке через asyncio.to_thread,
+    чтобы не блокировать event loop.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen);
+        CREATE INDEX IF NOT EXISTS idx_users_requests ON users(requests);
+        CREATE TABLE IF NOT EXISTS hourly (
+            kind TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (kind, bucket)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS daily (
+            kind TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (kind, bucket)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS totals (
+            kind TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS usage_models (
+            model TEXT PRIMARY KEY,
+            requests INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost_micros INTEGER NOT NULL,
+            latency_ms INTEGER NOT NULL,
+            duration_ms INTEGER NOT NULL,
+            cached_tokens INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS usage_users (
+            user_id INTEGER PRIMARY KEY,
+            requests INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost_micros INTEGER NOT NULL,
+            latency_ms INTEGER NOT NULL,
+            duration_ms INTEGER NOT NULL,
+            cached_tokens INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            day INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            requests INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost_micros INTEGER NOT NULL,
+            latency_ms INTEGER NOT NULL,
+            duration_ms INTEGER NOT NULL,
+            cached_tokens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, model)
+        ) WITHOUT ROWID;
+    """
+    
+    # Ключевые столбцы таблиц расхода
+    USAGE_TABLES = {"models": ("model",), "users": ("user_id",), "daily": ("day", "model")}
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self._migrate()
+    
+    def _migrate(self) -> None:
+        """Столбцы расхода, добавленные после создания базы"""
+        for scope in self.USAGE_TABLES:
+            existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info(usage_{scope})")}
+            for field_name in Statistics.USAGE_FIELDS:
+                if field_name not in existing:
+                    self.conn.execute(
+                        f"ALTER TABLE usage_{scope} ADD COLUMN {field_name} INTEGER NOT NULL DEFAULT 0"
+                    )
+    
+    async def write_batch(self, batch: Dict[str, Any]) -> None:
+        """Запись накопленных изменений одной транзакцией"""
+        await asyncio.to_thread(self._write_batch, batch)
+    
+    async def compact(self, min_hour: int, min_day: int) -> None:
+        """Удаление корзин старше срока хранения"""
+        await asyncio.to_thread(self._compact, min_hour, min_day)
+    
+    async def load(self, min_hour: int, min_day: int, active_since: float, top_k: int) -> Dict[str, Any]:
+        """Агрегаты для восстановления статистики в памяти"""
+        return await asyncio.to_thread(self._load, min_hour, min_day, active_since, top_k)
+    
+    async def close(self) -> None:
+        await asyncio.to_thread(self._close)
+    
+    def _write_batch(self, batch: Dict[str, Any]) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO users (user_id, first_seen, last_seen, requests) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                "first_seen = MIN(first_seen, excluded.first_seen), "
+                "last_seen = MAX(last_seen, excluded.last_seen), "
+                "requests = requests + excluded.requests",
+                [(uid, first, last, reqs) for uid, (first, last, reqs) in batch["users"].items()]
+            )
+            for table in ("hourly", "daily"):
+                self.conn.executemany(
+                    f"INSERT INTO {table} (kind, bucket, count) VALUES (?, ?, ?) "
+                    "ON CONFLICT(kind, bucket) DO UPDATE SET count = count + excluded.count",
+                    [(kind, bucket, n) for (kind, bucket), n in batch[table].items()]
+                )
+            self.conn.executemany(
+                "INSERT INTO totals (kind, count) VALUES (?, ?) "
+                "ON CONFLICT(kind) DO UPDATE SET count = count + excluded.count",
+                list(batch["totals"].items())
+            )
+            fields = Statistics.USAGE_FIELDS
+            for scope, key_columns in self.USAGE_TABLES.items():
+                rows = [
+                    (key if isinstance(key, tuple) else (key,)) + tuple(values)
+                    for (row_scope, key), values in batch["usage"].items() if row_scope == scope
+                ]
+                if not rows:
+                    continue
+                columns = key_columns + fields
+                self.conn.executemany(
+                    f"INSERT INTO usage_{scope} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))}) "
+                    f"ON CONFLICT({', '.join(key_columns)}) DO UPDATE SET "
+                    + ", ".join(f"{f} = {f} + excluded.{f}" for f in fields),
+                    rows
+                )
+    
+    def _compact(self, min_hour: int, min_day: int) -> None:
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM hourly WHERE bucket < ?", (min_hour,))
+            self.conn.execute("DELETE FROM daily WHERE bucket < ?", (min_day,))
+            self.conn.execute("DELETE FROM usage_daily WHERE day < ?", (min_day,))
+    
+    def _load(self, min_hour: int, min_day: int, active_since: float, top_k: int) -> Dict[str, Any]:
+        with self.lock:
+            c = self.conn
+            return {
+                "users": c.execute(
+                    "SELECT user_id, first_seen, last_seen, requests FROM users"
+                ).fetchall(),
+                "top": c.execute(
+                    "SELECT user_id, requests FROM users ORDER BY requests DESC LIMIT ?", (top_k,)
+                ).fetchall(),
+                "active": c.execute(
+                    "SELECT user_id, last_seen FROM users WHERE last_seen >= ?", (active_since,)
+                ).fetchall(),
+                "hourly": c.execute(
+                    "SELECT kind, bucket, count FROM hourly WHERE bucket >= ?", (min_hour,)
+                ).fetchall(),
+                "daily": c.execute(
+                    "SELECT kind, bucket, count FROM daily WHERE bucket >= ?", (min_day,)
+                ).fetchall(),
+                "totals": c.execute("SELECT kind, count FROM totals").fetchall(),
+                "usage": (
+                    [("models", row[0], row[1:]) for row in c.execute("SELECT * FROM usage_models")]
+                    + [("users", row[0], row[1:]) for row in c.execute("SELECT * FROM usage_users")]
+                    + [
+                        ("daily", (row[0], row[1]), row[2:])
+                        for row in c.execute("SELECT * FROM usage_daily WHERE day >= ?", (min_day,))
+                    ]
+                ),
+            }
+    
+    def _close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+class BackendStatsStore:
+    """Статистика в общем хранилище состояния (для нескольких реплик).
+    
+    Интерфейс совпадает со StatsStore; счетчики хранятся в хэшах.
+    """
+    
+    def __init__(self, backend: StateBackend):
+        self.backend = backend
+    
+    async def write_batch(self, batch: Dict[str, Any]) -> None:
+        ops = []
+        for user_id, (first, last, reqs) in batch["users"].items():
+            ops.append(self.backend.hsetnx("stats:first_seen", str(user_id), repr(first)))
+            ops.append(self.backend.hset("stats:last_seen", str(user_id), repr(last)))
+            if reqs:
+                ops.append(self.backend.hincrby("stats:requests", str(user_id), reqs))
+        for table in ("hourly", "daily"):
+            for (kind, bucket), n in batch[table].items():
+                ops.append(self.backend.hincrby(f"stats:{table}:{kind}", str(bucket), n))
+        for kind, n in batch["totals"].items():
+            ops.append(self.backend.hincrby("stats:totals", kind, n))
+        for (scope, key), values in batch["usage"].items():
+            name = self._usage_name(scope, key)
+            ops.append(self.backend.hset("stats:usage", name, "1"))
+            for field_name, n in zip(Statistics.USAGE_FIELDS, values):
+                if n:
+                    ops.append(self.backend.hincrby(f"stats:usage:{name}", field_name, n))
+        # Команды одной итерации уходят одним пакетом
+        await asyncio.gather(*ops)
+    
+    @staticmethod
+    def _usage_name(scope: str, key: Any) -> str:
+        if scope == "daily":
+            return f"daily:{key[0]}:{key[1]}"
+        return f"{scope}:{key}"
+    
+    @staticmethod
+    def _parse_usage_name(name: str) -> Tuple[str, Any]:
+        scope, _, key = name.partition(":")
+        if scope == "daily":
+            day, _, model = key.partition(":")
+            return scope, (int(day), model)
+        return scope, int(key) if scope == "users" else key
+    
+    async def compact(self, min_hour: int, min_day: int) -> None:
+        for table, min_bucket in (("hourly", min_hour), ("daily", min_day)):
+            for kind in Statistics.KINDS:
+                key = f"stats:{table}:{kind}"
+                buckets = await self.backend.hgetall(key)
+                old = [bucket for bucket in buckets if int(bucket) < min_bucket]
+                await self.backend.hdel(key, *old)
+        
+        old = []
+        for name in await self.backend.hgetall("stats:usage"):
+            scope, key = self._parse_usage_name(name)
+            if scope == "daily" and key[0] < min_day:
+                old.append(name)
+        if old:
+            await self.backend.hdel("stats:usage", *old)
+            await self.backend.delete(*(f"stats:usage:{name}" for name in old))
+    
+    async def load(self, min_hour: int, min_day: int, active_since: float, top_k: int) -> Dict[str, Any]:
+        first_seen, last_seen, requests, totals = await asyncio.gather(
+            self.backend.hgetall("stats:first_seen"),
+            self.backend.hgetall("stats:last_seen"),
+            self.backend.hgetall("stats:requests"),
+            self.backend.hgetall("stats:totals"),
+        )
+        users = [
+            (int(uid), float(first), float(last_seen.get(uid, first)), int(requests.get(uid, 0)))
+            for uid, first in first_seen.items()
+        ]
+        data: Dict[str, Any] = {
+            "users": users,
+            "top": heapq.nlargest(top_k, [(u[0], u[3]) for u in users if u[3]], key=lambda x: x[1]),
+            "active": [(u[0], u[2]) for u in users if u[2] >= active_since],
+            "totals": [(kind, int(n)) for kind, n in totals.items()],
+        }
+        for table, min_bucket in (("hourly", min_hour), ("daily", min_day)):
+            rows = []
+            for kind in Statistics.KINDS:
+                buckets = await self.backend.hgetall(f"stats:{table}:{kind}")
+                rows.extend(
+                    (kind, int(bucket), int(n))
+                    for bucket, n in buckets.items() if int(bucket) >= min_bucket
+                )
+            data[table] = rows
+        
+        names = list(await self.backend.hgetall("stats:usage"))
+        hashes = await asyncio.gather(*(self.backend.hgetall(f"stats:usage:{name}") for name in names))
+        data["usage"] = []
+        for name, values in zip(names, hashes):
+            scope, key = self._parse_usage_name(name)
+            if scope == "daily" and key[0] < min_day:
+                continue
+            data["usage"].append(
+                (scope, key, tuple(int(values.get(f, 0)) for f in Statistics.USAGE_FIELDS))
+            )
+        return data
+    
+    async def close(self) -> None:
+        pass
+
+
 # Класс для статистики
 class Statistics:
-    def __init__(self):
+    """Статистика с постоянным объемом памяти относительно трафика.
+    
+    Запросы и изображения считаются в кольцевых буферах по часам (для
+    периодов до STATS_HOURLY_DAYS) и по дням, топ пользователей ведется
+    инкрементально, активные за сутки считаются через HyperLogLog.
+    Изменения копятся в буфере и пачками пишутся в StatsStore.
+    """
+    
+    KINDS = ("requests", "images", "new_users")
+    # Счетчики расхода моделей (стоимость в миллионных долях кредита)
+    USAGE_FIELDS = (
+        "requests", "prompt_tokens", "completion_tokens", "cost_micros", "latency_ms", "duration_ms",
+        "cached_tokens",
+    )
+    
+    def __init__(self, store: Optional[Any] = None):
+        self.store = store
+        
         self.user_first_seen: Dict[int, float] = {}  # user_id: timestamp
         self.user_last_seen: Dict[int, float] = {}   # user_id: timestamp
-        self.requests: List[Tuple[int, float]] = []  # (user_id, timestamp)
-        self.images_sent: List[Tuple[int, float]] = []  # (user_id, timestamp)
+        self.user_requests: Dict[int, int] = {}      # user_id: количество запросов
+        
+        self.totals: Dict[str, int] = {kind: 0 for kind in self.KINDS}
+        self.hourly = {kind: RingCounter(config.STATS_HOURLY_DAYS * 24 + 1) for kind in self.KINDS}
+        self.daily = {kind: RingCounter(config.STATS_DAILY_DAYS + 1) for kind in self.KINDS}
+        
+        # Уникальные активные пользователи по часам за последние сутки
+        self.active_sketches = [HyperLogLog(config.STATS_HLL_PRECISION) for _ in range(25)]
+        self.active_sketch_ids: List[int] = [-1] * 25
+        
+        # Топ пользователей: точен, так как счетчики только растут
+        self.top_users: Dict[int, int] = {}
+        self.top_min = 0
+        
+        # Расход по моделям, пользователям и дням: (scope, ключ) -> счетчики USAGE_FIELDS
+        self.usage: Dict[str, Dict[Any, List[int]]] = {"models": {}, "users": {}, "daily": {}}
+        
+        self._pending = self._empty_batch()
+    
+    @staticmethod
+    def _empty_batch() -> Dict[str, Any]:
+        return {
+            "users": {},
+            "hourly": defaultdict(int),
+            "daily": defaultdict(int),
+            "totals": defaultdict(int),
+            "usage": {},
+        }
+    
+    @staticmethod
+    def _hour(ts: float) -> int:
+        return int(ts // 3600)
+    
+    @staticmethod
+    def _day(ts: float) -> int:
+        return datetime.fromtimestamp(ts).toordinal()
+    
+    def _mark_active(self, user_id: int, ts: float) -> None:
+        hour = self._hour(ts)
+        i = hour % len(self.active_sketches)
+        if self.active_sketch_ids[i] != hour:
+            self.active_sketch_ids[i] = hour
+            self.active_sketches[i].clear()
+        self.active_sketches[i].add(user_id)
+    
+    def _update_top(self, user_id: int, count: int) -> None:
+        if user_id in self.top_users:
+            was_min = self.top_users[user_id] == self.top_min
+            self.top_users[user_id] = count
+            if was_min:
+                self.top_min = min(self.top_users.values())
+        elif len(self.top_users) < config.STATS_TOP_K:
+            self.top_users[user_id] = count
+            self.top_min = min(self.top_users.values())
+        elif count > self.top_min:
+            weakest = min(self.top_users, key=self.top_users.get)
+            del self.top_users[weakest]
+            self.top_users[user_id] = count
+            self.top_min = min(self.top_users.values())
+    
+    def _count(self, kind: str, ts: float) -> None:
+        hour, day = self._hour(ts), self._day(ts)
+        self.totals[kind] += 1
+        self.hourly[kind].add(hour)
+        self.daily[kind].add(day)
+        
+        self._pending["totals"][kind] += 1
+        self._pending["hourly"][(kind, hour)] += 1
+        self._pending["daily"][(kind, day)] += 1
+    
+    def _touch_pending_user(self, user_id: int, ts: float, requests: int = 0) -> None:
+        entry = self._pending["users"].get(user_id)
+        if entry is None:
+            self._pending["users"][user_id] = [self.user_first_seen[user_id], ts, requests]
+        else:
+            entry[1] = ts
+            entry[2] += requests
     
     def add_user(self, user_id: int):
         now = time.time()
         if user_id not in self.user_first_seen:
             self.user_first_seen[user_id] = now
+            self._count("new_users", now)
         self.user_last_seen[user_id] = now
+        self._mark_active(user_id, now)
+        self._touch_pending_user(user_id, now)
     
     def add_request(self, user_id: int):
         self.add_user(user_id)
-        self.requests.append((user_id, time.time()))
+        self._count("requests", time.time())
+        
+        count = self.user_requests.get(user_id, 0) + 1
+        self.user_requests[user_id] = count
+        self._update_top(user_id, count)
+        self._pending["users"][user_id][2] += 1
     
     def add_image(self, user_id: int):
         self.add_user(user_id)
-        self.images_sent.append((user_id, time.time()))
+        self._count("images", time.time())
+    
+    def add_usage(
+        self,
+        user_id: int,
+        model_key: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cost: float,
+        latency: float,
+        duration: float,
+        cached_tokens: int = 0
+    ) -> None:
+        """Учет одного ответа модели по данным usage от OpenRouter"""
+        values = (
+            1, prompt_tokens, completion_tokens,
+            round(cost * 1_000_000), round(latency * 1000), round(duration * 1000),
+            cached_tokens
+        )
+        day = self._day(time.time())
+        for scope, key in (("models", model_key), ("users", user_id), ("daily", (day, model_key))):
+            for target in (
+                self.usage[scope].setdefault(key, [0] * len(values)),
+                self._pending["usage"].setdefault((scope, key), [0] * len(values)),
+            ):
+                for i, value in enumerate(values):
+                    target[i] += value
+    
+    @staticmethod
+    def _usage_summary(values: List[int]) -> Dict[str, float]:
+        requests, prompt, completion, cost_micros, latency_ms, duration_ms, cached = values
+        return {
+            "requests": requests,
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "cached_tokens": cached,
+            "cache_ratio": cached / prompt if prompt else 0.0,
+            "cost": cost_micros / 1_000_000,
+            "cost_per_request": cost_micros / 1_000_000 / requests if requests else 0.0,
+            "avg_latency": latency_ms / 1000 / requests if requests else 0.0,
+            "tokens_per_second": completion * 1000 / duration_ms if duration_ms else 0.0,
+        }
+    
+    def get_usage_by_model(self) -> Dict[str, Dict[str, float]]:
+        return {
+            model_key: self._usage_summary(values)
+            for model_key, values in self.usage["models"].items()
+        }
+    
+    def get_usage_total(self, period_days: Optional[int] = None) -> Dict[str, float]:
+        """Суммарный расход за все время или за последние period_days дней"""
+        if period_days:
+            first_day = self._day(time.time()) - period_days + 1
+            rows = [v for (day, _), v in self.usage["daily"].items() if day >= first_day]
+        else:
+            rows = list(self.usage["models"].values())
+        return self._usage_summary(
+            [sum(column) for column in zip(*rows)] if rows else [0] * len(self.USAGE_FIELDS)
+        )
+    
+    def get_top_spenders(self, limit: int = 10) -> List[Tuple[int, Dict[str, float]]]:
+        top = heapq.nlargest(limit, self.usage["users"].items(), key=lambda item: item[1][3])
+        return [(user_id, self._usage_summary(values)) for user_id, values in top]
+    
+    def _period_count(self, kind: str, period_days: int) -> int:
+        cutoff = time.time() - (period_days * 24 * 3600)
+        if period_days <= config.STATS_HOURLY_DAYS:
+            return self.hourly[kind].total(self._hour(cutoff))
+        return self.daily[kind].total(self._day(cutoff))
     
     def get_users_count(self, period_days: Optional[int] = None) -> int:
         if not period_days:
             return len(self.user_first_seen)
-        
-        cutoff = time.time() - (period_days * 24 * 3600)
-        return len([uid for uid, ts in self.user_first_seen.items() if ts >= cutoff])
+        return self._period_count("new_users", period_days)
     
     def get_requests_count(self, period_days: Optional[int] = None) -> int:
         if not period_days:
-            return len(self.requests)
-        
-        cutoff = time.time() - (period_days * 24 * 3600)
-        return len([req for req in self.requests if req[1] >= cutoff])
+            return self.totals["requests"]
+        return self._period_count("requests", period_days)
     
     def get_images_count(self, period_days: Optional[int] = None) -> int:
         if not period_days:
-            return len(self.images_sent)
-        
-        cutoff = time.time() - (period_days * 24 * 3600)
-        return len([img for img in self.images_sent if img[1] >= cutoff])
+            return self.totals["images"]
+        return self._period_count("images", period_days)
     
     def get_active_users_today(self) -> int:
-        cutoff = time.time() - (24 * 3600)
-        return len([uid for uid, ts in self.user_last_seen.items() if ts >= cutoff])
+        first_hour = self._hour(time.time() - (24 * 3600))
+        merged = HyperLogLog(config.STATS_HLL_PRECISION)
+        for hour, sketch in zip(self.active_sketch_ids, self.active_sketches):
+            if hour >= first_hour:
+                merged.merge(sketch)
+        return merged.count()
     
     def get_daily_stats(self) -> Dict[str, int]:
-        stats = defaultdict(int)
-        cutoff = time.time() - (30 * 24 * 3600)  # 30 дней
+        first_day = self._day(time.time() - (30 * 24 * 3600))  # 30 дней
+        return {
+            date.fromordinal(day).strftime('%Y-%m-%d'): count
+            for day, count in self.daily["requests"].items(first_day)
+        }
+    
+    def get_top_users(self, limit: int = 10) -> List[Tuple[int, int]]:
+        if limit > config.STATS_TOP_K:
+            return heapq.nlargest(limit, self.user_requests.items(), key=lambda x: x[1])
+        return sorted(self.top_users.items(), key=lambda x: x[1], reverse=True)[:limit]
+    
+    def _retention_bounds(self) -> Tuple[int, int]:
+        now = time.time()
+        min_hour = self._hour(now - config.STATS_HOURLY_DAYS * 24 * 3600)
+        min_day = self._day(now - config.STATS_RETENTION_DAYS * 24 * 3600)
+        return min_hour, min_day
+    
+    async def load(self) -> None:
+        """Восстановление статистики из хранилища"""
+        if self.store is None:
+            return
         
-        for user_id, timestamp in self.requests:
-            if timestamp >= cutoff:
-                date = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
-                stats[date] += 1
+        min_hour, min_day = self._retention_bounds()
+        data = await self.store.load(
+            min_hour,
+            self._day(time.time() - config.STATS_DAILY_DAYS * 24 * 3600),
+            time.time() - 24 * 3600,
+            config.STATS_TOP_K
+        )
         
-        return dict(stats)
+        for user_id, first_seen, last_seen, requests in data["users"]:
+            self.user_first_seen[user_id] = first_seen
+            self.user_last_seen[user_id] = last_seen
+            if requests:
+                self.user_requests[user_id] = requests
+        self.top_users = dict(data["top"])
+        self.top_min = min(self.top_users.values(), default=0)
+        for user_id, last_seen in data["active"]:
+            self._mark_active(user_id, last_seen)
+        for kind, bucket, count in data["hourly"]:
+            if kind in self.hourly:
+                self.hourly[kind].add(bucket, count)
+        for kind, bucket, count in data["daily"]:
+            if kind in self.daily:
+                self.daily[kind].add(bucket, count)
+        for kind, count in data["totals"]:
+            if kind in self.totals:
+                self.totals[kind] = count
+        for scope, key, values in data.get("usage", []):
+            self.usage[scope][key] = [int(value or 0) for value in values]
+        
+        logger.info("Статистика загружена: %s пользователей", len(self.user_first_seen))
     
-    def get_top_users(self, limit: int = 10) -> List[Tuple[int, int]]:
-        user_counts = defaultdict(int)
-        for user_id, _ in self.requests:
-            user_counts[user_id] += 1
+    async def flush(self) -> None:
+        """Запись накопленного буфера в хранилище"""
+        if self.store is None:
+            return
+        
+        batch, self._pending = self._pending, self._empty_batch()
+        if not (batch["users"] or batch["totals"] or batch["usage"]):
+            return
+        
+        try:
+            await self.store.write_batch(batch)
+        except Exception as e:
+            logger.error("Ошибка записи статистики: %s", e)
+            # Возвращаем несохраненные данные в буфер
+            for user_id, (first, last, reqs) in batch["users"].items():
+                entry = self._pending["users"].setdefault(user_id, [first, last, 0])
+                entry[0] = min(entry[0], first)
+                entry[1] = max(entry[1], last)
+                entry[2] += reqs
+            for key in ("hourly", "daily", "totals"):
+                for k, n in batch[key].items():
+                    self._pending[key][k] += n
+            for k, values in batch["usage"].items():
+                target = self._pending["usage"].setdefault(k, [0] * len(values))
+                for i, value in enumerate(values):
+                    target[i] += value
+    
+    async def run_flusher(self) -> None:
+        """Фоновая запись и очистка старых данных"""
+        if self.store is None:
+            return
         
-        return sorted(user_counts.items(), key=lambda x: x[1], reverse=True)[:limit]
+        last_compact = 0.0
+        while True:
+            await asyncio.sleep(config.STATS_FLUSH_INTERVAL)
+            await self.flush()
+            
+            if time.monotonic() - last_compact >= config.STATS_COMPACT_INTERVAL:
+                last_compact = time.monotonic()
+                first_day = self._day(time.time() - config.STATS_DAILY_DAYS * 24 * 3600)
+                for key in [key for key in self.usage["daily"] if key[0] < first_day]:
+                    del self.usage["daily"][key]
+                try:
+                    await self.store.compact(*self._retention_bounds())
+                except Exception as e:
+                    logger.error("Ошибка очистки статистики: %s", e)
+    
+    async def close(self) -> None:
+        """Финальная запись и закрытие хранилища"""
+        if self.store is None:
+            return
+        await self.flush()
+        await self.store.close()
+        self.store = None
+
+# Инициализация статистики. Хранилище открывается в on_startup: к этому
+# времени применены настройки, а у каждого процесса-воркера свое соединение
+def create_stats_store() -> Optional[Any]:
+    if state_backend.shared:
+        return BackendStatsStore(state_backend)
+    if config.STATS_DB_PATH:
+        return StatsStore(config.STATS_DB_PATH)
+    return None
 
-# Инициализация статистики
 stats = Statistics()
 
-# Инициализация бота
-bot = Bot(
-    token=config.BOT_TOKEN,
-    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-)
-dp = Dispatcher()
-router = Router()
-dp.include_router(router)
+admin_view: Optional[Statistics] = None
+admin_view_expires = 0.0
+admin_view_lock = asyncio.Lock()
 
-# Хранилище данных
-user_conversations: Dict[int, List[Dict]] = {}
-user_last_images: Dict[int, Dict] = {}
-processing_messages: Dict[int, int] = {}
+async def admin_stats() -> Statistics:
+    """Статистика для админа.
+    
+    Воркеры пишут в общее хранилище, а в памяти у каждого только свои
+    обновления, поэтому в режиме воркеров сводка читается из хранилища.
+    Чтение проходит по всем пользователям, так что сводка живет
+    STATS_VIEW_TTL секунд.
+    """
+    global admin_view, admin_view_expires
+    if config.RUN_MODE != "worker" or stats.store is None:
+        return stats
+    async with admin_view_lock:
+        if admin_view is None or time.monotonic() >= admin_view_expires:
+            await stats.flush()
+            view = Statistics(stats.store)
+            await view.load()
+            admin_view = view
+            admin_view_expires = time.monotonic() + config.STATS_VIEW_TTL
+    return admin_view
 
-class AIService:
-    """Сервис для работы с AI"""
+def worker_stats_note() -> str:
+    """Пояснение к счетчикам, которые ведет каждый воркер отдельно"""
+    if config.RUN_MODE != "worker":
+        return ""
+    return (
+        f"\n\nℹ️ Воркеров: {config.WORKERS}. Счетчики пользователей и запросов общие, "
+        f"данные других воркеров приходят с задержкой до "
+        f"{config.STATS_FLUSH_INTERVAL + config.STATS_VIEW_TTL:g}с. "
+        "Чаты, кэши и нагрузка - только этого воркера."
+    )
+
+# Метрики
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+TELEGRAM_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    """Счетчик с метками"""
     
-    def __init__(self):
-        self.api_key = config.OPENROUTER_API_KEY
-        self.api_url = config.OPENROUTER_API_URL
-        self.current_model = config.DEFAULT_MODEL
-        self.model_info = config.MODELS[self.current_model]
-        
-        self.headers = {
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = defaultdict(float)
+        if not labels:
+            self.values[()] = 0.0
+    
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        self.values[label_values] += amount
+    
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], float]]:
+        return [(self.name, key, value) for key, value in self.values.items()]
+
+class Gauge(Counter):
+    """Текущее значение с метками"""
+    
+    kind = "gauge"
+    
+    def dec(self, *label_values: str, amount: float = 1.0) -> None:
+        self.values[label_values] -= amount
+    
+    def set(self, *label_values: str, value: float) -> None:
+        self.values[label_values] = value
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин"""
+    
+    kind = "histogram"
+    
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # метки: [счетчики корзин..., +Inf], сумма
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+    
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+    
+    @asynccontextmanager
+    async def time(self, *label_values: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+    
+    def count(self, *label_values: str) -> int:
+        series = self.values.get(label_values)
+        return sum(series[0]) if series else 0
+    
+    def quantile(self, q: float, *label_values: str) -> Optional[float]:
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        series = self.values.get(label_values)
+        if not series:
+            return None
+        counts = series[0]
+        rank = q * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return None
+    
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], float]]:
+        result = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                result.append((f"{self.name}_bucket", key + (le,), cumulative))
+            result.append((f"{self.name}_sum", key, total[0]))
+            result.append((f"{self.name}_count", key, cumulative))
+        return result
+
+class Metrics:
+    """Метрики горячего пути.
+    
+    Запись - обращение к словарю без блокировок и аллокаций; значения,
+    которые и так хранятся в других компонентах (очереди, кэши), читаются
+    только в момент выдачи /metrics.
+    """
+    
+    def __init__(self):
+        self.openrouter_seconds = Histogram(
+            "bot_openrouter_request_seconds",
+            "Время до получения статуса ответа OpenRouter",
+            ("model",)
+        )
+        self.openrouter_ttft = Histogram(
+            "bot_openrouter_ttft_seconds",
+            "Время от запроса пользователя до первого текста ответа",
+            ("model",)
+        )
+        self.openrouter_responses = Counter(
+            "bot_openrouter_responses_total",
+            "Ответы OpenRouter по статусу",
+            ("model", "status")
+        )
+        self.telegram_seconds = Histogram(
+            "bot_telegram_request_seconds",
+            "Длительность вызовов Telegram Bot API",
+            ("method",),
+            TELEGRAM_BUCKETS
+        )
+        self.telegram_errors = Counter(
+            "bot_telegram_errors_total",
+            "Ошибки вызовов Telegram Bot API",
+            ("method", "error")
+        )
+        self.telegram_in_flight = Gauge(
+            "bot_telegram_in_flight",
+            "Выполняющиеся вызовы Telegram Bot API"
+        )
+        self.handler_seconds = Histogram(
+            "bot_handler_seconds",
+            "Длительность обработки сообщения",
+            ("branch",)
+        )
+        self.handlers_in_flight = Gauge(
+            "bot_handlers_in_flight",
+            "Обрабатываемые сообщения"
+        )
+        self.log_dropped = Counter(
+            "bot_log_dropped_total",
+            "Записи журнала, отброшенные выборкой или при переполнении очереди",
+            ("reason",)
+        )
+        self.metrics = [
+            self.openrouter_seconds, self.openrouter_ttft, self.openrouter_responses,
+            self.telegram_seconds, self.telegram_errors, self.telegram_in_flight,
+            self.handler_seconds, self.handlers_in_flight, self.log_dropped,
+        ]
+    
+    def _snapshot(self) -> List[Gauge]:
+        """Показатели, которые уже хранятся в других компонентах"""
+        in_flight = Gauge("bot_openrouter_in_flight", "Выполняющиеся запросы к моделям", ("model",))
+        for model_key, count in scheduler.active.items():
+            in_flight.set(model_key, value=count)
+        queued = Gauge("bot_scheduler_queued", "Запросы в очереди планировщика")
+        queued.set(value=scheduler.queue_depth())
+        outgoing = Gauge("bot_telegram_send_queued", "Вызовы Bot API в очереди отправки")
+        outgoing.set(value=telegram_sender.queued)
+        chats = Gauge("bot_conversations_active", "Истории чатов в памяти")
+        chats.set(value=len(conversation_store))
+        cache = Gauge("bot_cache_bytes", "Объем кэшей", ("cache",))
+        cache.set("images", value=image_cache.bytes_used)
+        cache.set("responses", value=response_cache.bytes_used)
+        breakers = Gauge("bot_breaker_open", "Открытые предохранители моделей", ("model",))
+        for model_key, breaker in ai_service.breakers.items():
+            breakers.set(model_key, value=float(breaker.state != "closed"))
+        return [in_flight, queued, outgoing, chats, cache, breakers]
+    
+    @staticmethod
+    def _escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    
+    @staticmethod
+    def _format(value: float) -> str:
+        # :g оставляет 6 значащих цифр, и счетчики больше 1e6 теряют точность
+        return str(value) if isinstance(value, int) else repr(float(value))
+    
+    def render(self) -> str:
+        """Текстовый формат Prometheus"""
+        lines = []
+        for metric in self.metrics + self._snapshot():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            label_names = metric.labels + (("le",) if metric.kind == "histogram" else ())
+            for name, key, value in metric.samples():
+                if key:
+                    labels = ",".join(
+                        f'{label}="{self._escape(str(item))}"' for label, item in zip(label_names, key)
+                    )
+                    lines.append(f"{name}{{{labels}}} {self._format(value)}")
+                else:
+                    lines.append(f"{name} {self._format(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Замер вызовов Bot API (answer, delete_message, get_file и т.д.)"""
+    
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        metrics.telegram_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.telegram_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            metrics.telegram_in_flight.dec()
+            metrics.telegram_seconds.observe(time.perf_counter() - started, name)
+
+# Инициализация бота
+# Исходящие сообщения
+SEND_PRIORITY_REPLY = 0     # ответы пользователю
+SEND_PRIORITY_PROGRESS = 1  # промежуточные правки и служебные сообщения
+send_priority: ContextVar[int] = ContextVar("send_priority", default=SEND_PRIORITY_REPLY)
+
+@contextmanager
+def progress_sends():
+    """Вызовы Bot API внутри блока обслуживаются после ответов пользователям"""
+    token = send_priority.set(SEND_PRIORITY_PROGRESS)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+class SendJob:
+    __slots__ = ("make_request", "bot", "method", "priority", "future", "attempts", "queued_at")
+    
+    def __init__(self, make_request, bot, method, priority: int):
+        self.make_request = make_request
+        self.bot = bot
+        self.method = method
+        self.priority = priority
+        self.future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+
+class TelegramSender(BaseRequestMiddleware):
+    """Очередь исходящих вызовов Bot API.
+    
+    Вызовы с chat_id проходят через общий лимит бота и лимит чата
+    (token bucket), в каждый чат одновременно идет один вызов, поэтому
+    части ответа приходят по порядку. Ответы пользователям обслуживаются
+    раньше промежуточных правок (progress_sends). После
+    TelegramRetryAfter вызов возвращается в начало очереди чата, а чат
+    ждет указанное время. Вызовы без чата (getFile, getUpdates)
+    выполняются сразу.
+    """
+    
+    def __init__(self):
+        self.queues: Dict[Any, Tuple[deque, deque]] = {}
+        self.busy: set = set()
+        self.chat_buckets: Dict[Any, List[float]] = {}  # chat_id: [токены, время]
+        self.blocked_until: Dict[Any, float] = {}
+        self.scheduled: Dict[Any, Tuple[int, int]] = {}  # chat_id: (приоритет, порядок) актуальной записи
+        self.ready: List[Tuple[int, int, Any]] = []  # (приоритет, порядок, chat_id)
+        self.delayed: List[Tuple[float, int, Any]] = []  # (время, порядок, chat_id)
+        self.global_tokens = float(config.SEND_GLOBAL_RATE)
+        self.global_updated = time.monotonic()
+        self.seq = 0
+        self.queued = 0
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.last_prune = time.monotonic()
+        
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.wait_times: deque = deque(maxlen=500)
+    
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+        
+        job = SendJob(make_request, bot, method, send_priority.get())
+        self.queues.setdefault(chat_id, (deque(), deque()))[job.priority].append(job)
+        self.queued += 1
+        self._schedule(chat_id, time.monotonic())
+        self.wakeup.set()
+        return await job.future
+    
+    def _chat_ready_at(self, chat_id: Any, now: float) -> float:
+        bucket = self.chat_buckets.get(chat_id)
+        ready_at = self.blocked_until.get(chat_id, 0.0)
+        if bucket is not None:
+            tokens = min(config.SEND_CHAT_BURST, bucket[0] + (now - bucket[1]) * config.SEND_CHAT_RATE)
+            if tokens < 1:
+                ready_at = max(ready_at, now + (1 - tokens) / config.SEND_CHAT_RATE)
+        return max(ready_at, now)
+    
+    def _take_chat_token(self, chat_id: Any, now: float) -> None:
+        bucket = self.chat_buckets.setdefault(chat_id, [float(config.SEND_CHAT_BURST), now])
+        bucket[0] = min(config.SEND_CHAT_BURST, bucket[0] + (now - bucket[1]) * config.SEND_CHAT_RATE) - 1
+        bucket[1] = now
+    
+    def _take_global_token(self, now: float) -> float:
+        """Списание токена бота, возвращает время ожидания (токены уходят в долг)"""
+        self.global_tokens = min(
+            config.SEND_GLOBAL_RATE,
+            self.global_tokens + (now - self.global_updated) * config.SEND_GLOBAL_RATE
+        )
+        self.global_updated = now
+        self.global_tokens -= 1
+        return max(0.0, -self.global_tokens / config.SEND_GLOBAL_RATE)
+    
+    def _schedule(self, chat_id: Any, now: float) -> None:
+        """Постановка чата в очередь готовых или отложенных"""
+        queues = self.queues.get(chat_id)
+        if chat_id in self.busy or queues is None:
+            return
+        priority = next((i for i, queue in enumerate(queues) if queue), None)
+        if priority is None:
+            del self.queues[chat_id]
+            return
+        current = self.scheduled.get(chat_id)
+        if current is not None and current[0] <= priority:
+            return
+        
+        # Прежние записи чата в кучах становятся устаревшими
+        self.seq += 1
+        self.scheduled[chat_id] = (priority, self.seq)
+        ready_at = self._chat_ready_at(chat_id, now)
+        if ready_at > now:
+            heapq.heappush(self.delayed, (ready_at, self.seq, chat_id))
+        else:
+            heapq.heappush(self.ready, (priority, self.seq, chat_id))
+    
+    def _pop_job(self, chat_id: Any) -> Optional[SendJob]:
+        for queue in self.queues.get(chat_id, ()):
+            while queue:
+                job = queue.popleft()
+                self.queued -= 1
+                if not job.future.done():  # вызывающий уже отменен
+                    return job
+        return None
+    
+    def _prune(self, now: float) -> None:
+        """Удаление лимитов чатов, которые давно ничего не отправляли"""
+        idle = config.SEND_CHAT_BURST / config.SEND_CHAT_RATE
+        for chat_id, (_, updated) in list(self.chat_buckets.items()):
+            if now - updated > idle and chat_id not in self.queues:
+                del self.chat_buckets[chat_id]
+        for chat_id, until in list(self.blocked_until.items()):
+            if until < now:
+                del self.blocked_until[chat_id]
+        self.last_prune = now
+    
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                _, seq, chat_id = heapq.heappop(self.delayed)
+                if self.scheduled.get(chat_id, (0, 0))[1] == seq:
+                    del self.scheduled[chat_id]
+                    self._schedule(chat_id, now)
+            
+            chat_id = None
+            while self.ready:
+                _, seq, candidate = heapq.heappop(self.ready)
+                if self.scheduled.get(candidate, (0, 0))[1] == seq:
+                    del self.scheduled[candidate]
+                    chat_id = candidate
+                    break
+            
+            if chat_id is None:
+                if now - self.last_prune > 60:
+                    self._prune(now)
+                self.wakeup.clear()
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            job = self._pop_job(chat_id)
+            if job is None:
+                self._schedule(chat_id, now)
+                continue
+            
+            # Чат занят уже на время ожидания токена бота, иначе новый
+            # вызов этого чата попадет в ready и уйдет параллельно
+            self.busy.add(chat_id)
+            delay = self._take_global_token(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            
+            self._take_chat_token(chat_id, time.monotonic())
+            asyncio.create_task(self._execute(chat_id, job))
+    
+    async def _execute(self, chat_id: Any, job: SendJob) -> None:
+        self.wait_times.append(time.monotonic() - job.queued_at)
+        try:
+            result = await job.make_request(job.bot, job.method)
+        except TelegramRetryAfter as e:
+            job.attempts += 1
+            if job.attempts > config.SEND_MAX_RETRIES:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                # Чат ждет, вызов остается первым в своей очереди
+                self.retried += 1
+                logger.warning("Flood limit в чате %s: ждем %sс", chat_id, e.retry_after)
+                self.blocked_until[chat_id] = time.monotonic() + e.retry_after
+                self.queues.setdefault(chat_id, (deque(), deque()))[job.priority].appendleft(job)
+                self.queued += 1
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self.busy.discard(chat_id)
+            self._schedule(chat_id, time.monotonic())
+            self.wakeup.set()
+    
+    async def close(self) -> None:
+        """Досылка очереди (не дольше SEND_DRAIN_TIMEOUT) и остановка"""
+        deadline = time.monotonic() + config.SEND_DRAIN_TIMEOUT
+        while (self.queued or self.busy) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        waits = sorted(self.wait_times)
+        return {
+            "queued": self.queued,
+            "in_flight": len(self.busy),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+        }
+
+telegram_sender = TelegramSender()
+
+bot = Bot(
+    token=config.BOT_TOKEN,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+)
+# Очередь снаружи: метрики замеряют сам вызов, без ожидания в очереди
+bot.session.middleware(telegram_sender)
+bot.session.middleware(TelegramMetricsMiddleware())
+dp = Dispatcher()
+router = Router()
+dp.include_router(router)
+
+class StoredConversation:
+    """История одного пользователя: горячая (кортежи) или сжатая"""
+    
+    __slots__ = ("messages", "summary", "blob", "size", "last_access", "synced_at")
+    
+    def __init__(self, messages: List[Tuple[str, str]]):
+        self.messages: Optional[List[Tuple[str, str]]] = messages
+        self.summary: Optional[str] = None
+        self.blob: Optional[bytes] = None
+        self.size = 0
+        self.last_access = time.monotonic()
+        self.synced_at = self.last_access
+        self.measure()
+    
+    @classmethod
+    def from_blob(cls, blob: bytes) -> "StoredConversation":
+        entry = cls([])
+        entry.messages = None
+        entry.blob = blob
+        entry.measure()
+        return entry
+    
+    def measure(self) -> None:
+        if self.messages is not None:
+            # Грубая оценка: символы + накладные расходы на кортеж/строку
+            self.size = sum(len(content) * 2 + 120 for _, content in self.messages)
+            self.size += len(self.summary or "") * 2
+        else:
+            self.size = len(self.blob) + 120
+    
+    def encode(self) -> bytes:
+        """Сжатое представление истории"""
+        if self.messages is None:
+            return self.blob
+        data = {"m": self.messages, "s": self.summary}
+        return zlib.compress(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+    
+    def freeze(self) -> None:
+        """Сжатие холодной истории"""
+        if self.messages is None:
+            return
+        self.blob = self.encode()
+        self.messages = None
+        self.summary = None
+        self.measure()
+    
+    def thaw(self) -> List[Tuple[str, str]]:
+        """Распаковка при обращении"""
+        if self.messages is None:
+            data = json.loads(zlib.decompress(self.blob))
+            if isinstance(data, list):  # формат без краткого содержания
+                data = {"m": data, "s": None}
+            self.messages = [tuple(m) for m in data["m"]]
+            self.summary = data["s"]
+            self.blob = None
+            self.measure()
+        return self.messages
+
+
+def estimate_tokens(content: Any) -> int:
+    """Грубая оценка числа токенов (около 3 символов на токен + служебные)"""
+    if isinstance(content, str):
+        return len(content) // 3 + 4
+    # Мультимодальное сообщение: изображения считаем фиксированной стоимостью
+    return sum(
+        estimate_tokens(part.get("text", "")) if part.get("type") == "text" else 1000
+        for part in content
+    )
+
+
+class ConversationStore:
+    """Хранилище истории диалогов с лимитом памяти.
+    
+    Истории лежат в LRU-порядке. Неактивные дольше CONV_COLD_AFTER
+    сжимаются, неактивные дольше CONV_IDLE_TTL (или при превышении
+    CONV_MEMORY_BUDGET_MB) выгружаются на диск и поднимаются обратно
+    при следующем сообщении пользователя.
+    
+    С общим хранилищем состояния (несколько реплик) изменения сразу
+    записываются в него, а локальная копия живет STATE_CACHE_TTL секунд.
+    """
+    
+    ROLES = {"user": "user", "assistant": "assistant", "system": "system"}
+    
+    def __init__(self, backend: Optional[StateBackend] = None):
+        self.backend = backend if backend is not None and backend.shared else None
+        self.entries: "OrderedDict[int, StoredConversation]" = OrderedDict()
+        self.memory_used = 0
+        self.memory_budget = config.CONV_MEMORY_BUDGET_MB * 1024 * 1024
+        self.spill_dir = config.CONV_SPILL_DIR
+        self.last_sweep: Optional[float] = None
+        
+        self.hits = 0
+        self.misses = 0
+        self.rehydrated = 0
+        self.evictions = 0
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def _spill_path(self, user_id: int) -> str:
+        return os.path.join(self.spill_dir, f"{user_id}.z")
+    
+    def _resize(self, entry: StoredConversation, action) -> None:
+        self.memory_used -= entry.size
+        action()
+        self.memory_used += entry.size
+    
+    @staticmethod
+    def _read_file(path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    
+    @staticmethod
+    def _write_file(path: str, blob: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+    
+    @staticmethod
+    def _remove_file(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    
+    def _sweep_files(self, max_age: float) -> int:
+        """Удаление выгруженных историй, не читавшихся max_age секунд"""
+        deadline = time.time() - max_age
+        removed = 0
+        try:
+            files = os.scandir(self.spill_dir)
+        except FileNotFoundError:
+            return 0
+        with files:
+            for item in files:
+                if not item.name.endswith((".z", ".tmp")):
+                    continue
+                try:
+                    if item.stat().st_mtime < deadline:
+                        os.remove(item.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+    
+    @staticmethod
+    def _key(user_id: int) -> str:
+        return f"conv:{user_id}"
+    
+    def _insert(self, user_id: int, entry: StoredConversation) -> None:
+        old = self.entries.pop(user_id, None)
+        if old is not None:
+            self.memory_used -= old.size
+        self.entries[user_id] = entry
+        self.memory_used += entry.size
+    
+    async def _load(self, user_id: int) -> Optional[StoredConversation]:
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            self.entries.move_to_end(user_id)
+            if self.backend is None or time.monotonic() - entry.synced_at < config.STATE_CACHE_TTL:
+                self.hits += 1
+                return entry
+        
+        if self.backend is not None:
+            blob = await self.backend.get(self._key(user_id), cached=False)
+            if blob is not None:
+                entry = StoredConversation.from_blob(blob)
+                self._insert(user_id, entry)
+                self.rehydrated += 1
+                return entry
+            if user_id in self.entries:
+                # История очищена другой репликой
+                self.memory_used -= self.entries.pop(user_id).size
+        
+        elif self.spill_dir:
+            path = self._spill_path(user_id)
+            blob = await asyncio.to_thread(self._read_file, path)
+            if blob is not None:
+                self._insert(user_id, StoredConversation.from_blob(blob))
+                await asyncio.to_thread(self._remove_file, path)
+                self.rehydrated += 1
+                return self.entries[user_id]
+        
+        self.misses += 1
+        return None
+    
+    async def _sync(self, user_id: int, entry: StoredConversation) -> None:
+        """Запись изменений в общее хранилище"""
+        if self.backend is None:
+            return
+        await self.backend.set(self._key(user_id), entry.encode(), ttl=config.CONV_SHARED_TTL)
+        entry.synced_at = time.monotonic()
+    
+    async def get_context(self, user_id: int) -> Tuple[Optional[str], List[Dict[str, str]]]:
+        """Краткое содержание и история пользователя в формате API"""
+        entry = await self._load(user_id)
+        if entry is None:
+            return None, []
+        
+        entry.last_access = time.monotonic()
+        if entry.messages is None:
+            self._resize(entry, entry.thaw)
+        return entry.summary, [{"role": role, "content": content} for role, content in entry.messages]
+    
+    async def get(self, user_id: int) -> List[Dict[str, str]]:
+        """История пользователя в формате API"""
+        _, messages = await self.get_context(user_id)
+        return messages
+    
+    async def _get_or_create(self, user_id: int) -> StoredConversation:
+        entry = await self._load(user_id)
+        if entry is None:
+            entry = StoredConversation([])
+            self.entries[user_id] = entry
+            self.memory_used += entry.size
+        entry.last_access = time.monotonic()
+        return entry
+    
+    async def append(self, user_id: int, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Добавление сообщений с обрезкой до MAX_HISTORY_LENGTH пар.
+        
+        Возвращает вытесненные из начала истории сообщения.
+        """
+        entry = await self._get_or_create(user_id)
+        overflow: List[Tuple[str, str]] = []
+        
+        def extend():
+            history = entry.thaw()
+            history.extend(
+                (self.ROLES.get(m["role"], m["role"]), m["content"]) for m in messages
+            )
+            if len(history) > config.MAX_HISTORY_LENGTH * 2:
+                overflow.extend(history[:-(config.MAX_HISTORY_LENGTH * 2)])
+                del history[:-(config.MAX_HISTORY_LENGTH * 2)]
+            entry.measure()
+        
+        self._resize(entry, extend)
+        await self._sync(user_id, entry)
+        await self._enforce_budget()
+        return [{"role": role, "content": content} for role, content in overflow]
+    
+    async def pop_oldest(self, user_id: int, count: int) -> List[Dict[str, str]]:
+        """Удаление первых count сообщений истории"""
+        entry = await self._get_or_create(user_id)
+        removed: List[Tuple[str, str]] = []
+        
+        def pop():
+            history = entry.thaw()
+            removed.extend(history[:count])
+            del history[:count]
+            entry.measure()
+        
+        self._resize(entry, pop)
+        await self._sync(user_id, entry)
+        return [{"role": role, "content": content} for role, content in removed]
+    
+    async def set_summary(self, user_id: int, summary: str) -> None:
+        """Сохранение краткого содержания старой части диалога"""
+        entry = await self._get_or_create(user_id)
+        
+        def update():
+            entry.thaw()
+            entry.summary = summary
+            entry.measure()
+        
+        self._resize(entry, update)
+        await self._sync(user_id, entry)
+    
+    async def clear(self, user_id: int) -> None:
+        """Удаление истории пользователя"""
+        entry = self.entries.pop(user_id, None)
+        if entry is not None:
+            self.memory_used -= entry.size
+        if self.backend is not None:
+            await self.backend.delete(self._key(user_id))
+        elif self.spill_dir:
+            await asyncio.to_thread(self._remove_file, self._spill_path(user_id))
+    
+    async def _evict(self, user_id: int) -> None:
+        entry = self.entries.pop(user_id)
+        self.memory_used -= entry.size
+        self.evictions += 1
+        # В общем хранилище история уже сохранена
+        if self.backend is None and self.spill_dir:
+            if entry.messages is not None:
+                entry.freeze()
+            await asyncio.to_thread(self._write_file, self._spill_path(user_id), entry.blob)
+    
+    async def _enforce_budget(self) -> None:
+        if self.memory_used <= self.memory_budget:
+            return
+        
+        # Сначала сжимаем самые старые, затем выгружаем
+        for user_id, entry in list(self.entries.items()):
+            if self.memory_used <= self.memory_budget:
+                return
+            if entry.messages is not None:
+                self._resize(entry, entry.freeze)
+        
+        while self.memory_used > self.memory_budget and len(self.entries) > 1:
+            await self._evict(next(iter(self.entries)))
+    
+    async def maintain(self) -> None:
+        """Сжатие и выгрузка неактивных историй, удаление старых файлов"""
+        now = time.monotonic()
+        for user_id, entry in list(self.entries.items()):
+            idle = now - entry.last_access
+            if idle >= config.CONV_IDLE_TTL:
+                await self._evict(user_id)
+            elif idle >= config.CONV_COLD_AFTER and entry.messages is not None:
+                self._resize(entry, entry.freeze)
+        await self._enforce_budget()
+        
+        # Файлы пользователей, которые не вернулись, иначе копятся без предела
+        if self.backend is None and self.spill_dir and (
+            self.last_sweep is None or now - self.last_sweep >= config.CONV_SPILL_SWEEP_INTERVAL
+        ):
+            self.last_sweep = now
+            removed = await asyncio.to_thread(self._sweep_files, config.CONV_SPILL_TTL)
+            if removed:
+                logger.info("Удалено выгруженных историй: %s", removed)
+    
+    async def run_maintenance(self) -> None:
+        """Фоновое обслуживание хранилища"""
+        while True:
+            await asyncio.sleep(config.CONV_MAINTENANCE_INTERVAL)
+            try:
+                await self.maintain()
+            except Exception as e:
+                logger.error("Ошибка обслуживания истории: %s", e)
+    
+    def export(self) -> Dict[int, bytes]:
+        """Сжатые истории из памяти (для снимка состояния)"""
+        return {user_id: entry.encode() for user_id, entry in self.entries.items()}
+    
+    def restore(self, user_id: int, blob: bytes) -> None:
+        """История из снимка состояния, если пользователь еще не писал"""
+        if user_id not in self.entries:
+            self._insert(user_id, StoredConversation.from_blob(blob))
+            self.rehydrated += 1
+    
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "active": len(self.entries),
+            "memory_kb": self.memory_used // 1024,
+            "hits": self.hits,
+            "misses": self.misses,
+            "rehydrated": self.rehydrated,
+            "evictions": self.evictions,
+        }
+
+class UserState:
+    """Небольшие записи пользователей в хранилище состояния"""
+    
+    # Записи, переживающие перезапуск через снимок состояния
+    SNAPSHOT_KEYS = ("img", "model")
+    
+    def __init__(self, backend: StateBackend):
+        self.backend = backend
+    
+    async def _get(self, key: str) -> Any:
+        raw = await self.backend.get(key)
+        return json.loads(raw) if raw is not None else None
+    
+    async def _set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await self.backend.set(key, json.dumps(value).encode("utf-8"), ttl)
+    
+    async def get_images(self, user_id: int) -> List[Dict[str, Any]]:
+        image_refs = await self._get(f"img:{user_id}")
+        if isinstance(image_refs, dict):
+            # Запись старого формата с одним фото
+            return [image_refs]
+        return image_refs or []
+    
+    async def set_images(self, user_id: int, image_refs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Сохранение ссылок на фото для следующего запроса, возвращает предыдущие"""
+        previous = await self.get_images(user_id)
+        await self._set(f"img:{user_id}", image_refs)
+        return previous
+    
+    async def pop_images(self, user_id: int) -> List[Dict[str, Any]]:
+        previous = await self.get_images(user_id)
+        if previous:
+            await self.backend.delete(f"img:{user_id}")
+        return previous
+    
+    async def set_processing(self, user_id: int, message_id: int) -> None:
+        await self._set(f"proc:{user_id}", message_id, ttl=config.HTTP_TIMEOUT * 5)
+    
+    async def pop_processing(self, user_id: int) -> Optional[int]:
+        message_id = await self._get(f"proc:{user_id}")
+        if message_id is not None:
+            await self.backend.delete(f"proc:{user_id}")
+        return message_id
+    
+    async def get_model(self, user_id: int) -> str:
+        """Выбранная пользователем модель (ключ MODELS или AUTO_MODEL)"""
+        model_key = await self._get(f"model:{user_id}")
+        if model_key == config.AUTO_MODEL or model_key in config.MODELS:
+            return model_key
+        return config.DEFAULT_MODEL
+    
+    async def set_model(self, user_id: int, model_key: str) -> None:
+        await self._set(f"model:{user_id}", model_key)
+    
+    def export(self) -> Dict[int, Dict[str, Any]]:
+        """Записи SNAPSHOT_KEYS по пользователям (только локальное хранилище)"""
+        users: Dict[int, Dict[str, Any]] = defaultdict(dict)
+        for prefix in self.SNAPSHOT_KEYS:
+            for key, raw in self.backend.items(f"{prefix}:"):
+                users[int(key.split(":", 1)[1])][prefix] = json.loads(raw)
+        return dict(users)
+    
+    async def restore(self, user_id: int, values: Dict[str, Any]) -> None:
+        for prefix, value in values.items():
+            if prefix in self.SNAPSHOT_KEYS:
+                await self._set(f"{prefix}:{user_id}", value)
+
+# Хранилище данных
+conversation_store = ConversationStore(state_backend)
+user_state = UserState(state_backend)
+
+def json_dumps(value: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """Компактный JSON в байтах кодеком из config.JSON_CODEC"""
+    if orjson is not None and config.JSON_CODEC != "json":
+        try:
+            return orjson.dumps(value, default=default)
+        except TypeError:  # одиночные суррогаты и прочее, что orjson не кодирует
+            pass
+    return json.dumps(value, separators=(",", ":"), default=default).encode("ascii")
+
+
+def json_loads(data: Any) -> Any:
+    if orjson is not None and config.JSON_CODEC != "json":
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class ImageData:
+    """Изображение для запроса: исходные байты, base64 пишется при отправке"""
+    
+    __slots__ = ("data", "mime_type", "_digest")
+    
+    def __init__(self, data: bytes, mime_type: str):
+        self.data = data
+        self.mime_type = mime_type
+        self._digest: Optional[str] = None
+    
+    @property
+    def prefix(self) -> bytes:
+        return f"data:{self.mime_type};base64,".encode("ascii")
+    
+    @property
+    def uri_size(self) -> int:
+        """Длина data URI без его построения"""
+        return len(self.prefix) + 4 * ((len(self.data) + 2) // 3)
+    
+    def chunks(self, size: int):
+        """base64 блоками; size кратен 3, поэтому блоки склеиваются без паддинга"""
+        size = max(3, size - size % 3)
+        view = memoryview(self.data)
+        for start in range(0, len(view), size):
+            yield base64.b64encode(view[start:start + size])
+    
+    def digest(self) -> str:
+        if self._digest is None:
+            hasher = hashlib.blake2b(self.mime_type.encode("ascii"), digest_size=16)
+            hasher.update(self.data)
+            self._digest = hasher.hexdigest()
+        return self._digest
+    
+    def __str__(self) -> str:
+        return self.prefix.decode("ascii") + base64.b64encode(self.data).decode("ascii")
+
+
+class JsonStreamPayload(aiohttp.payload.Payload):
+    """Тело запроса, записываемое по частям.
+    
+    Каркас JSON кодируется целиком, а вместо строк data URI на месте
+    ImageData пишется base64 блоками прямо из исходных байтов. Длина
+    известна заранее, поэтому запрос уходит с Content-Length.
+    """
+    
+    _autoclose = True
+    
+    def __init__(self, value: Dict[str, Any]):
+        super().__init__(value, content_type="application/json")
+        token = os.urandom(6).hex()
+        images: List[ImageData] = []
+        
+        def placeholder(obj: Any) -> str:
+            if not isinstance(obj, ImageData):
+                raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+            images.append(obj)
+            return f"\x00{token}:{len(images) - 1}\x00"
+        
+        framing = json_dumps(value, default=placeholder)
+        marker = re.compile(rb'"\\u0000' + token.encode("ascii") + rb':(\d+)\\u0000"')
+        self.parts: List[Any] = []
+        for index, piece in enumerate(marker.split(framing)):
+            self.parts.append(piece if index % 2 == 0 else images[int(piece)])
+        self._size = sum(
+            len(part) if isinstance(part, bytes) else part.uri_size + 2
+            for part in self.parts
+        )
+    
+    async def write(self, writer) -> None:
+        chunk_size = config.REQUEST_CHUNK_KB * 1024
+        for part in self.parts:
+            if isinstance(part, bytes):
+                await writer.write(part)
+                continue
+            await writer.write(b'"' + part.prefix)
+            for chunk in part.chunks(chunk_size):
+                await writer.write(chunk)
+            await writer.write(b'"')
+    
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        return "".join(
+            part.decode(encoding, errors) if isinstance(part, bytes) else f'"{part}"'
+            for part in self.parts
+        )
+
+
+def prepare_image(image_bytes: bytes, mime_type: str, max_side: int, quality: int) -> Tuple[bytes, str]:
+    """Уменьшение и перекодирование (выполняется в пуле)"""
+    if Image is not None and max_side:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            if max(img.size) > max_side:
+                img.thumbnail((max_side, max_side), Image.LANCZOS)
+                if img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                out = io.BytesIO()
+                img.save(out, format="JPEG", quality=quality, optimize=True)
+                image_bytes = out.getvalue()
+                mime_type = "image/jpeg"
+    
+    return image_bytes, mime_type
+
+
+class ImageProcessor:
+    """Подготовка изображений вне event loop"""
+    
+    def __init__(self):
+        self.executor: Optional[Executor] = None
+    
+    def start(self) -> None:
+        if self.executor is not None:
+            return
+        if config.IMAGE_USE_PROCESSES:
+            self.executor = ProcessPoolExecutor(max_workers=config.IMAGE_WORKERS)
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers=config.IMAGE_WORKERS,
+                thread_name_prefix="image"
+            )
+    
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+    
+    @staticmethod
+    def max_side(model_info: Dict[str, Any]) -> int:
+        return model_info.get("max_image_side") or config.IMAGE_MAX_SIDE
+    
+    @staticmethod
+    def pick_photo_size(photos: List[PhotoSize], max_side: int) -> PhotoSize:
+        """Наименьший размер фото, покрывающий max_side (иначе самый большой)"""
+        for photo in sorted(photos, key=lambda p: p.width * p.height):
+            if max(photo.width, photo.height) >= max_side:
+                return photo
+        return photos[-1]
+    
+    async def prepare(self, image_bytes: bytes, mime_type: str, max_side: int) -> ImageData:
+        """Изображение, подготовленное в пуле"""
+        loop = asyncio.get_running_loop()
+        data, mime_type = await loop.run_in_executor(
+            self.executor,
+            prepare_image,
+            image_bytes,
+            mime_type,
+            max_side,
+            config.IMAGE_JPEG_QUALITY
+        )
+        return ImageData(data, mime_type)
+
+image_processor = ImageProcessor()
+
+class CachedImage:
+    """Готовая к отправке часть сообщения с изображением"""
+    
+    __slots__ = ("part", "size", "last_access")
+    
+    def __init__(self, part: Dict[str, Any]):
+        self.part = part
+        self.size = len(part["image_url"]["url"].data)
+        self.last_access = time.monotonic()
+
+
+class ImageCache:
+    """Кэш подготовленных изображений по file_unique_id.
+    
+    Хранит готовые image_url части с лимитом по байтам, LRU и TTL.
+    Изображения, на которые ссылаются пользователи, вытесняются в
+    последнюю очередь.
+    """
+    
+    def __init__(self):
+        self.entries: "OrderedDict[Tuple[str, int], CachedImage]" = OrderedDict()
+        self.refs: Dict[str, int] = defaultdict(int)
+        self.inflight: Dict[Tuple[str, int], asyncio.Future] = {}
+        self.bytes_used = 0
+        self.budget = config.IMAGE_CACHE_MB * 1024 * 1024
+        
+        self.hits = 0
+        self.misses = 0
+    
+    def acquire(self, file_unique_id: str) -> None:
+        self.refs[file_unique_id] += 1
+    
+    def release(self, file_unique_id: str) -> None:
+        self.refs[file_unique_id] -= 1
+        if self.refs[file_unique_id] <= 0:
+            del self.refs[file_unique_id]
+    
+    def _drop(self, key: Tuple[str, int]) -> None:
+        entry = self.entries.pop(key)
+        self.bytes_used -= entry.size
+    
+    def _expire(self) -> None:
+        deadline = time.monotonic() - config.IMAGE_CACHE_TTL
+        for key, entry in list(self.entries.items()):
+            if entry.last_access >= deadline:
+                break
+            if key[0] not in self.refs:
+                self._drop(key)
+    
+    def _enforce_budget(self) -> None:
+        for protect_referenced in (True, False):
+            for key in list(self.entries):
+                if self.bytes_used <= self.budget:
+                    return
+                if protect_referenced and key[0] in self.refs:
+                    continue
+                self._drop(key)
+    
+    def get(self, file_unique_id: str, max_side: int) -> Optional[Dict[str, Any]]:
+        key = (file_unique_id, max_side)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        entry.last_access = time.monotonic()
+        self.entries.move_to_end(key)
+        return entry.part
+    
+    def put(self, file_unique_id: str, max_side: int, part: Dict[str, Any]) -> None:
+        key = (file_unique_id, max_side)
+        if key in self.entries:
+            self._drop(key)
+        entry = CachedImage(part)
+        self.entries[key] = entry
+        self.bytes_used += entry.size
+        self._expire()
+        self._enforce_budget()
+    
+    async def get_or_load(self, file_unique_id: str, max_side: int, loader) -> Dict[str, Any]:
+        """Изображение из кэша или через loader() с объединением параллельных загрузок"""
+        part = self.get(file_unique_id, max_side)
+        if part is not None:
+            self.hits += 1
+            return part
+        
+        key = (file_unique_id, max_side)
+        while key in self.inflight:
+            part = await asyncio.shield(self.inflight[key])
+            if part is not None:
+                self.hits += 1
+                return part
+            # Загружавший отменен: первый проснувшийся загружает сам
+        
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            part = await loader()
+            self.put(file_unique_id, max_side, part)
+            future.set_result(part)
+            return part
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение получит вызывающий, ожидающих может не быть
+            future.exception()
+            raise
+        except BaseException:
+            # Отмена касается только этого вызова, а не ожидающих
+            future.set_result(None)
+            raise
+        finally:
+            del self.inflight[key]
+    
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "size_kb": self.bytes_used // 1024,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+image_cache = ImageCache()
+
+class StateSnapshot:
+    """Снимок состояния пользователей для теплого перезапуска.
+    
+    При остановке истории диалогов и записи UserState (фото, выбранная
+    модель) пишутся в один файл: заголовок, отсортированный индекс
+    записей фиксированного размера (user_id, смещение, длина) и сами
+    записи. При запуске файл только отображается в память, а запись
+    пользователя находится двоичным поиском и поднимается перед его
+    первым обновлением, поэтому запуск не зависит от числа
+    пользователей. Снимок используется один раз: после аварийной
+    остановки бот стартует без него, а не с устаревшим состоянием.
+    Статистика сохраняется отдельно (StatsStore).
+    """
+    
+    MAGIC = b"BOTSNAP1"
+    HEADER = struct.Struct("<8sIQ")   # сигнатура, число записей, время создания
+    ENTRY = struct.Struct("<qQI")     # user_id, смещение, длина
+    LENGTH = struct.Struct("<I")      # длина сжатой истории в начале записи
+    
+    def __init__(self, conversations: ConversationStore, users: UserState):
+        self.conversations = conversations
+        self.users = users
+        self.mm: Optional[mmap.mmap] = None
+        self.count = 0
+        self.paged: set = set()
+        self.restored = 0
+    
+    @property
+    def enabled(self) -> bool:
+        # В общем хранилище состояние и так переживает перезапуск
+        return bool(config.SNAPSHOT_PATH) and not self.users.backend.shared
+    
+    def open(self) -> None:
+        """Подключение снимка, оставшегося от прошлой остановки"""
+        if not self.enabled:
+            return
+        try:
+            with open(config.SNAPSHOT_PATH, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):  # ValueError - пустой файл
+            return
+        
+        if len(mm) < self.HEADER.size or mm[:len(self.MAGIC)] != self.MAGIC:
+            logger.warning("Снимок состояния %s поврежден, пропускаю", config.SNAPSHOT_PATH)
+            mm.close()
+            return
+        _, self.count, created = self.HEADER.unpack_from(mm)
+        self.mm = mm
+        try:
+            os.remove(config.SNAPSHOT_PATH)
+        except OSError:
+            pass
+        logger.info(
+            "Снимок состояния: %s пользователей от %s",
+            self.count, f"{datetime.fromtimestamp(created):%Y-%m-%d %H:%M:%S}"
+        )
+    
+    def _entry(self, index: int) -> Tuple[int, int, int]:
+        return self.ENTRY.unpack_from(self.mm, self.HEADER.size + index * self.ENTRY.size)
+    
+    def _find(self, user_id: int) -> Optional[bytes]:
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            key, offset, length = self._entry(middle)
+            if key < user_id:
+                low = middle + 1
+            elif key > user_id:
+                high = middle
+            else:
+                return self.mm[offset:offset + length]
+        return None
+    
+    def _encode(self, blob: Optional[bytes], values: Optional[Dict[str, Any]]) -> bytes:
+        record = self.LENGTH.pack(len(blob or b"")) + (blob or b"")
+        if values:
+            record += json.dumps(values, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return record
+    
+    def _decode(self, record: bytes) -> Tuple[Optional[bytes], Dict[str, Any]]:
+        (length,) = self.LENGTH.unpack_from(record)
+        start = self.LENGTH.size
+        blob = record[start:start + length] or None
+        rest = record[start + length:]
+        return blob, json.loads(rest) if rest else {}
+    
+    async def page_in(self, user_id: int) -> None:
+        """Подъем записи пользователя из снимка (один раз)"""
+        if self.mm is None or user_id in self.paged:
+            return
+        self.paged.add(user_id)
+        record = self._find(user_id)
+        if record is None:
+            return
+        
+        blob, values = self._decode(record)
+        if blob is not None:
+            self.conversations.restore(user_id, blob)
+        await self.users.restore(user_id, values)
+        for image_ref in values.get("img", []):
+            image_cache.acquire(image_ref["file_unique_id"])
+        self.restored += 1
+    
+    async def __call__(self, handler, event, data):
+        """Middleware обновлений: состояние пользователя до обработчиков"""
+        user = data.get("event_from_user")
+        if self.mm is not None and user is not None:
+            await self.page_in(user.id)
+        return await handler(event, data)
+    
+    async def save(self) -> None:
+        """Запись снимка при остановке"""
+        if not self.enabled:
+            return
+        
+        records: Dict[int, bytes] = {}
+        # Кто не писал с прошлого запуска, переносится из старого снимка как есть
+        if self.mm is not None:
+            for index in range(self.count):
+                user_id, offset, length = self._entry(index)
+                if user_id not in self.paged:
+                    records[user_id] = self.mm[offset:offset + length]
+        
+        conversations = self.conversations.export()
+        values = self.users.export()
+        for user_id in set(conversations) | set(values):
+            records[user_id] = self._encode(conversations.get(user_id), values.get(user_id))
+        
+        await asyncio.to_thread(self._write, config.SNAPSHOT_PATH, records)
+        logger.info("Снимок состояния сохранен: %s пользователей", len(records))
+    
+    def _write(self, path: str, records: Dict[int, bytes]) -> None:
+        user_ids = sorted(records)
+        offset = self.HEADER.size + self.ENTRY.size * len(user_ids)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(user_ids), int(time.time())))
+            for user_id in user_ids:
+                f.write(self.ENTRY.pack(user_id, offset, len(records[user_id])))
+                offset += len(records[user_id])
+            for user_id in user_ids:
+                f.write(records[user_id])
+        os.replace(tmp_path, path)
+    
+    def close(self) -> None:
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+state_snapshot = StateSnapshot(conversation_store, user_state)
+
+class InFlightUpdates:
+    """Middleware обновлений: учет обрабатываемых, чтобы дождаться их при остановке"""
+    
+    def __init__(self):
+        self.tasks: set = set()
+    
+    def __len__(self) -> int:
+        return len(self.tasks)
+    
+    async def __call__(self, handler, event, data):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self.tasks.discard(task)
+    
+    async def drain(self, timeout: float) -> int:
+        """Ожидание начатых обновлений; возвращает число недождавшихся"""
+        if not self.tasks:
+            return 0
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        return len(pending)
+
+in_flight = InFlightUpdates()
+dp.update.outer_middleware(in_flight)
+dp.update.outer_middleware(state_snapshot)
+
+
+class AIServiceError(Exception):
+    """Ошибка запроса к нейросети, текст предназначен пользователю"""
+    
+    def __init__(self, text: str, retryable: bool = False, retry_after: Optional[float] = None):
+        super().__init__(text)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Предохранитель модели: closed -> open -> half-open -> closed"""
+    
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+    
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < config.BREAKER_RESET_TIMEOUT:
+                return False
+            self.state = "half-open"
+        # В полуоткрытом состоянии пропускаем один пробный запрос
+        if self.trial_in_flight:
+            return False
+        self.trial_in_flight = True
+        return True
+    
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self.trial_in_flight = False
+    
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == "half-open" or self.failures >= config.BREAKER_FAILURE_THRESHOLD:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+    
+    def record_cancel(self) -> None:
+        self.trial_in_flight = False
+    
+    @property
+    def available(self) -> bool:
+        """Пропустит ли предохранитель запрос (без изменения состояния)"""
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= config.BREAKER_RESET_TIMEOUT
+        return self.state == "closed" or not self.trial_in_flight
+
+
+class RequestScheduler:
+    """Ограничение нагрузки на модели.
+    
+    У каждой модели есть лимит одновременных запросов (max_concurrency
+    в Config.MODELS). Ожидающие запросы обслуживаются по кругу между
+    пользователями, админ обслуживается вне очереди. Частота запросов
+    пользователя ограничена token bucket, при переполнении очереди
+    новые запросы отклоняются.
+    """
+    
+    def __init__(self):
+        self.active: Dict[str, int] = defaultdict(int)
+        self.waiting: Dict[str, "OrderedDict[int, deque]"] = defaultdict(OrderedDict)
+        self.priority: Dict[str, deque] = defaultdict(deque)
+        self.buckets: Dict[int, List[float]] = {}  # user_id: [токены, время]
+        self.wait_times: deque = deque(maxlen=500)
+        
+        self.rejected = 0
+        self.rate_limited = 0
+    
+    @staticmethod
+    def _limit(model_key: str) -> int:
+        return config.MODELS[model_key].get("max_concurrency", config.SCHED_MODEL_CONCURRENCY)
+    
+    def queue_depth(self, model_key: Optional[str] = None) -> int:
+        keys = [model_key] if model_key else set(self.waiting) | set(self.priority)
+        return sum(
+            len(self.priority[key]) + sum(len(q) for q in self.waiting[key].values())
+            for key in keys
+        )
+    
+    def position(self, model_key: str, user_id: int, future: asyncio.Future) -> int:
+        """Номер ожидающего запроса (с 1) с учетом обслуживания по кругу"""
+        priority = self.priority[model_key]
+        if future in priority:
+            return priority.index(future) + 1
+        position = len(priority)
+        waiting = self.waiting[model_key]
+        own = waiting.get(user_id)
+        if own is None or future not in own:
+            return position
+        rounds = own.index(future)
+        before = True
+        for other, queue in waiting.items():
+            if other == user_id:
+                before = False
+                position += rounds + 1
+            else:
+                # Пользователи раньше по кругу обслуживаются и в раунде запроса
+                position += min(len(queue), rounds + 1 if before else rounds)
+        return position
+    
+    def admit(self, user_id: int) -> None:
+        """Проверка лимита частоты запросов пользователя"""
+        if user_id == config.ADMIN_ID:
+            return
+        
+        now = time.monotonic()
+        rate = config.SCHED_USER_RATE / 60.0
+        tokens, updated = self.buckets.get(user_id, (config.SCHED_USER_BURST, now))
+        tokens = min(config.SCHED_USER_BURST, tokens + (now - updated) * rate)
+        
+        if tokens < 1:
+            self.rate_limited += 1
+            wait = math.ceil((1 - tokens) / rate)
+            raise AIServiceError(f"⚠️ Слишком много запросов. Подождите {wait} сек.")
+        
+        self.buckets[user_id] = [tokens - 1, now]
+        
+        if len(self.buckets) > 10000:
+            # Полные корзины ничего не помнят - их можно забыть
+            full_after = config.SCHED_USER_BURST / rate
+            self.buckets = {
+                uid: bucket for uid, bucket in self.buckets.items()
+                if now - bucket[1] < full_after
+            }
+    
+    def _next_waiter(self, model_key: str) -> Optional[asyncio.Future]:
+        if self.priority[model_key]:
+            return self.priority[model_key].popleft()
+        
+        waiting = self.waiting[model_key]
+        if not waiting:
+            return None
+        
+        user_id, queue = next(iter(waiting.items()))
+        future = queue.popleft()
+        del waiting[user_id]
+        if queue:
+            # Пользователь уходит в конец круга
+            waiting[user_id] = queue
+        return future
+    
+    def _grant(self, model_key: str) -> None:
+        while self.active[model_key] < self._limit(model_key):
+            future = self._next_waiter(model_key)
+            if future is None:
+                return
+            if future.done():
+                continue
+            self.active[model_key] += 1
+            future.set_result(None)
+    
+    def _remove(self, model_key: str, user_id: int, future: asyncio.Future) -> None:
+        if future in self.priority[model_key]:
+            self.priority[model_key].remove(future)
+            return
+        queue = self.waiting[model_key].get(user_id)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self.waiting[model_key][user_id]
+    
+    async def acquire(
+        self,
+        user_id: int,
+        model_key: str,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> None:
+        if self.active[model_key] < self._limit(model_key) and not self.queue_depth(model_key):
+            self.active[model_key] += 1
+            self.wait_times.append(0.0)
+            return
+        
+        is_admin = user_id == config.ADMIN_ID
+        depth = self.queue_depth()
+        if not is_admin and depth >= config.SCHED_MAX_QUEUE:
+            self.rejected += 1
+            raise AIServiceError(
+                f"⚠️ Сервис перегружен: в очереди {depth} запросов. Попробуйте через минуту."
+            )
+        
+        future = asyncio.get_running_loop().create_future()
+        if is_admin:
+            self.priority[model_key].append(future)
+        else:
+            self.waiting[model_key].setdefault(user_id, deque()).append(future)
+        
+        started = time.monotonic()
+        try:
+            if on_queued is not None:
+                try:
+                    await on_queued(self.position(model_key, user_id, future))
+                except Exception as e:
+                    logger.warning(
+                        "Не удалось сообщить позицию в очереди: %s", e,
+                        extra={"user_id": user_id, "model": model_key}
+                    )
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(model_key)
+            else:
+                future.cancel()
+                self._remove(model_key, user_id, future)
+            raise
+        
+        self.wait_times.append(time.monotonic() - started)
+    
+    def release(self, model_key: str) -> None:
+        self.active[model_key] -= 1
+        self._grant(model_key)
+    
+    @asynccontextmanager
+    async def slot(
+        self,
+        user_id: int,
+        model_key: str,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ):
+        """Слот для запроса к модели"""
+        await self.acquire(user_id, model_key, on_queued)
+        try:
+            yield
+        finally:
+            self.release(model_key)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        waits = list(self.wait_times)
+        return {
+            "queued": self.queue_depth(),
+            "active": {key: n for key, n in self.active.items() if n},
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "max_wait": max(waits, default=0.0),
+            "rejected": self.rejected,
+            "rate_limited": self.rate_limited,
+        }
+
+scheduler = RequestScheduler()
+
+# Подпись фото, вынесенного в начало запроса моделей с prompt_cache
+PINNED_PHOTO_TEXT = "Фото к текущему вопросу (сам вопрос - в последнем сообщении):"
+
+class ResponseCache:
+    """Кэш ответов на запросы без истории.
+    
+    Ключ - модель, нормализованные сообщения и параметры генерации
+    (изображения входят в ключ хэшем). Одинаковые одновременные
+    запросы ждут один вызов API.
+    """
+    
+    def __init__(self):
+        self.entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.bytes_used = 0
+        self.budget = config.RESPONSE_CACHE_MB * 1024 * 1024
+        
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+    
+    @staticmethod
+    def _normalize(content: Any) -> Any:
+        if isinstance(content, str):
+            return " ".join(content.split())
+        parts = []
+        for part in content:
+            if part.get("type") == "image_url":
+                parts.append({"image": part["image_url"]["url"].digest()})
+            else:
+                parts.append({"text": " ".join(part.get("text", "").split())})
+        return parts
+    
+    @staticmethod
+    def _unpin_photo(messages: List[Dict]) -> List[Dict]:
+        """Закрепленное фото и текущий вопрос - как один ход с фото.
+        
+        Так запрос с фото в начале (модели с prompt_cache) получает тот
+        же ключ, что и обычный ход с фото внутри сообщения.
+        """
+        if len(messages) != 2:
+            return messages
+        pinned, current = messages
+        content = pinned["content"]
+        if (
+            pinned["role"] != "user"
+            or isinstance(content, str)
+            or not content
+            or content[0].get("text") != PINNED_PHOTO_TEXT
+        ):
+            return messages
+        question = current["content"]
+        if not isinstance(question, str):
+            # После _mark_cache_breakpoints текст разбит на части
+            question = "".join(part.get("text", "") for part in question)
+        return [{"role": "user", "content": [{"type": "text", "text": question}] + content[1:]}]
+    
+    def make_key(self, model_key: str, messages: List[Dict], payload: Dict[str, Any]) -> Optional[str]:
+        """Ключ кэша или None, если запрос зависит от истории"""
+        if not config.RESPONSE_CACHE_ENABLED:
+            return None
+        messages = self._unpin_photo(messages)
+        if len(messages) != 1:
+            return None
+        normalized = {
+            "model": model_key,
+            "messages": [(m["role"], self._normalize(m["content"])) for m in messages],
+            "temperature": payload.get("temperature"),
+            "max_tokens": payload.get("max_tokens"),
+        }
+        raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+    
+    def _get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        text, expires = entry
+        if expires < time.monotonic():
+            self._drop(key)
+            return None
+        self.entries.move_to_end(key)
+        return text
+    
+    def _drop(self, key: str) -> None:
+        text, _ = self.entries.pop(key)
+        self.bytes_used -= len(text) * 2
+    
+    async def lookup(self, key: str) -> Optional[str]:
+        """Ответ из кэша или от такого же запроса, который уже выполняется.
+        
+        None - вызывающий становится ведущим и должен завершить запрос
+        через complete() или abort().
+        """
+        text = self._get(key)
+        if text is not None:
+            self.hits += 1
+            return text
+        
+        future = self.inflight.get(key)
+        while future is not None:
+            text = await asyncio.shield(future)
+            if text is not None:
+                self.shared += 1
+                return text
+            # Ведущий не получил ответа: первый проснувшийся ожидающий
+            # занимает его место, остальные ждут уже его
+            future = self.inflight.get(key)
+        
+        self.misses += 1
+        self.inflight[key] = asyncio.get_running_loop().create_future()
+        return None
+    
+    def complete(self, key: str, text: str) -> None:
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (text, time.monotonic() + config.RESPONSE_CACHE_TTL)
+        self.bytes_used += len(text) * 2
+        while self.bytes_used > self.budget and self.entries:
+            self._drop(next(iter(self.entries)))
+        self._finish(key, text)
+    
+    def abort(self, key: str) -> None:
+        """Запрос не удался - ведущим становится один из ожидающих"""
+        self._finish(key, None)
+    
+    def _finish(self, key: str, text: Optional[str]) -> None:
+        future = self.inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(text)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.shared + self.misses
+        return {
+            "entries": len(self.entries),
+            "size_kb": self.bytes_used // 1024,
+            "hits": self.hits,
+            "shared": self.shared,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.shared) / lookups * 100 if lookups else 0.0,
+        }
+
+response_cache = ResponseCache()
+
+class ModelRouter:
+    """Выбор модели в автоматическом режиме.
+    
+    Для каждой модели ведутся скользящие средние (EWMA) времени до
+    первого текста ответа и доли ошибок. Запрос уходит в модель с
+    наименьшей ожидаемой задержкой с учетом ошибок; небольшая доля
+    запросов идет в случайную модель, чтобы оценки не устаревали.
+    """
+    
+    def __init__(self):
+        self.latency: Dict[str, Optional[float]] = {key: None for key in config.MODELS}
+        self.errors: Dict[str, float] = {key: 0.0 for key in config.MODELS}
+        self.samples: Dict[str, deque] = {
+            key: deque(maxlen=config.ROUTER_SAMPLES) for key in config.MODELS
+        }
+        self.routed: Dict[str, int] = defaultdict(int)
+        self.hedged = 0
+        self.hedge_wins = 0
+    
+    def record_latency(self, model_key: str, seconds: float) -> None:
+        previous = self.latency[model_key]
+        if previous is None:
+            self.latency[model_key] = seconds
+        else:
+            self.latency[model_key] = previous + config.ROUTER_EWMA_ALPHA * (seconds - previous)
+        self.samples[model_key].append(seconds)
+    
+    def record_result(self, model_key: str, ok: bool) -> None:
+        error = 0.0 if ok else 1.0
+        self.errors[model_key] += config.ROUTER_EWMA_ALPHA * (error - self.errors[model_key])
+    
+    def score(self, model_key: str) -> float:
+        """Ожидаемая задержка модели с поправкой на ошибки"""
+        latency = self.latency[model_key]
+        if latency is None:
+            latency = config.ROUTER_DEFAULT_LATENCY
+        return latency * (1 + config.ROUTER_ERROR_PENALTY * self.errors[model_key])
+    
+    def p95(self, model_key: str) -> Optional[float]:
+        samples = self.samples[model_key]
+        if len(samples) < config.HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    
+    def rank(self, need_images: bool, available: Callable[[str], bool]) -> List[str]:
+        """Подходящие модели от лучшей к худшей; недоступные - в конце"""
+        candidates = [
+            key for key, info in config.MODELS.items()
+            if info["supports_images"] or not need_images
+        ]
+        candidates.sort(key=lambda key: (not available(key), self.score(key)))
+        
+        healthy = [key for key in candidates if available(key)]
+        if len(healthy) > 1 and random.random() < config.ROUTER_EXPLORE:
+            explored = random.choice(healthy[1:])
+            candidates.remove(explored)
+            candidates.insert(0, explored)
+        return candidates
+    
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            key: {
+                "latency": self.latency[key],
+                "p95": self.p95(key),
+                "error_rate": self.errors[key] * 100,
+                "routed": self.routed[key],
+            }
+            for key in config.MODELS
+        }
+
+model_router = ModelRouter()
+
+
+class AIService:
+    """Сервис для работы с AI"""
+    
+    def __init__(self):
+        self.api_key = config.OPENROUTER_API_KEY
+        self.api_url = config.OPENROUTER_API_URL
+        
+        self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.balance: Optional[Dict[str, Any]] = None
+        self.balance_updated = 0.0
+        self.breakers: Dict[str, CircuitBreaker] = {
+            model_key: CircuitBreaker() for model_key in config.MODELS
+        }
+    
+    async def start(self) -> None:
+        """Создание общей HTTP-сессии с пулом соединений"""
+        if self._session is not None and not self._session.closed:
+            return
+        
+        connector = aiohttp.TCPConnector(
+            limit=config.HTTP_POOL_LIMIT,
+            limit_per_host=config.HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=config.HTTP_DNS_CACHE_TTL,
+            enable_cleanup_closed=True
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                total=config.HTTP_TIMEOUT,
+                connect=config.HTTP_CONNECT_TIMEOUT
+            )
+        )
+    
+    async def close(self) -> None:
+        """Закрытие HTTP-сессии"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
     
-    def set_model(self, model_id: str):
-        """Установка модели"""
-        if model_id in config.MODELS:
-            self.current_model = model_id
-            self.model_info = config.MODELS[model_id]
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Общая HTTP-сессия для всех исходящих запросов"""
+        if self._session is None or self._session.closed:
+            raise RuntimeError("AIService не запущен: вызовите start()")
+        return self._session
+    
+    async def set_model(self, user_id: int, model_id: str) -> bool:
+        """Установка модели пользователя"""
+        if model_id == config.AUTO_MODEL or model_id in config.MODELS:
+            await user_state.set_model(user_id, model_id)
             return True
         return False
     
-    def get_model_info(self) -> Dict[str, Any]:
-        """Информация о текущей модели"""
-        return self.model_info
+    def get_model_info(self, model_id: str) -> Dict[str, Any]:
+        """Информация о модели (или об автоматическом выборе)"""
+        if model_id == config.AUTO_MODEL:
+            return {
+                "name": "Авто",
+                "supports_images": any(info["supports_images"] for info in config.MODELS.values()),
+                "description": "Самая быстрая доступная модель"
+            }
+        return config.MODELS[model_id]
+    
+    def pick_model(self, model_id: str, need_images: bool) -> str:
+        """Модель для запроса: выбранная пользователем или лучшая по замерам"""
+        if model_id != config.AUTO_MODEL:
+            return model_id
+        return model_router.rank(need_images, self._available)[0]
+    
+    def _available(self, model_key: str) -> bool:
+        return self.breakers[model_key].available
     
     def get_all_models(self) -> Dict[str, Dict[str, Any]]:
         """Все доступные модели"""
         return config.MODELS
     
-    async def encode_image_to_base64(self, image_bytes: bytes) -> str:
-        """Кодирование изображения в base64"""
-        return base64.b64encode(image_bytes).decode('utf-8')
-    
-    async def process_image(self, image_bytes: bytes, mime_type: str = "image/jpeg") -> Dict[str, str]:
+    async def process_image(
+        self,
+        image_bytes: bytes,
+        mime_type: str = "image/jpeg",
+        max_side: Optional[int] = None
+    ) -> Dict[str, Any]:
         """Подготовка изображения для API"""
         if len(image_bytes) > config.MAX_IMAGE_SIZE_MB * 1024 * 1024:
             raise ValueError(f"Максимальный размер {config.MAX_IMAGE_SIZE_MB}MB")
         
-        base64_image = await self.encode_image_to_base64(image_bytes)
+        if max_side is None:
+            max_side = config.IMAGE_MAX_SIDE
+        
+        image = await image_processor.prepare(image_bytes, mime_type, max_side)
         
         return {
             "type": "image_url",
             "image_url": {
-                "url": f"data:{mime_type};base64,{base64_image}"
+                "url": image
             }
         }
     
-    async def generate_response(
-        self, 
+    async def _build_messages(
+        self,
         user_id: int,
+        model_key: str,
         message: str,
         images: Optional[List[Dict]] = None
-    ) -> str:
-        """Генерация ответа"""
+    ) -> List[Dict]:
+        """Сборка списка сообщений для запроса в пределах бюджета токенов"""
+        summary, history = await conversation_store.get_context(user_id)
+        prompt_cache = config.MODELS[model_key].get("prompt_cache", False)
+        pinned = []
+        
+        if summary:
+            pinned.append({
+                "role": "system",
+                "content": f"Краткое содержание предыдущей части диалога:\n{summary}"
+            })
         
-        if user_id not in user_conversations:
-            user_conversations[user_id] = []
+        # Самые новые сообщения, помещающиеся в бюджет модели
+        budget = self._history_budget(model_key) - estimate_tokens(message)
+        if summary:
+            budget -= estimate_tokens(summary)
         
-        messages = user_conversations[user_id].copy()
+        start = len(history)
+        while start > 0 and budget - estimate_tokens(history[start - 1]["content"]) >= 0:
+            start -= 1
+            budget -= estimate_tokens(history[start]["content"])
         
-        if not self.model_info["supports_images"] or not images:
-            messages.append({"role": "user", "content": message})
+        if not self._has_images(images, model_key):
+            current = {"role": "user", "content": message}
+        elif prompt_cache and (summary or start < len(history)):
+            # Фото, о котором спрашивают несколько раз подряд, стоит в
+            # неизменном начале запроса и читается из кэша провайдера.
+            # Без истории выносить нечего: фото остается в текущем ходе
+            current = {"role": "user", "content": message}
+            pinned.append({
+                "role": "user",
+                "content": [{"type": "text", "text": PINNED_PHOTO_TEXT}] + list(images)
+            })
         else:
             content = [{"type": "text", "text": message}]
             for image_data in images:
                 content.append(image_data)
             
-            messages.append({
+            current = {
                 "role": "user",
                 "content": content
-            })
+            }
+        
+        messages = pinned + history[start:]
+        messages.append(current)
+        if prompt_cache and len(messages) > 1:
+            self._mark_cache_breakpoints(messages, len(pinned))
+        return messages
+    
+    @staticmethod
+    def _mark_cache_breakpoints(messages: List[Dict], pinned: int) -> None:
+        """Точки cache_control (не больше 4 у Anthropic).
+        
+        Конец постоянного начала (краткое содержание, фото), конец
+        прошлых ходов и текущее сообщение: с этой точки следующий ход
+        прочитает всю нынешнюю историю из кэша.
+        """
+        for index in sorted({pinned - 1, len(messages) - 2, len(messages) - 1}):
+            if index < 0:
+                continue
+            message = messages[index]
+            content = message["content"]
+            parts = [{"type": "text", "text": content}] if isinstance(content, str) else list(content)
+            # Части с фото общие с кэшем изображений - копируем, а не меняем
+            parts[-1] = {**parts[-1], "cache_control": {"type": "ephemeral"}}
+            messages[index] = {**message, "content": parts}
+    
+    @staticmethod
+    def _strip_cache_breakpoints(messages: List[Dict]) -> List[Dict]:
+        """Сообщения без cache_control для резервной модели без кэша"""
+        stripped = []
+        for message in messages:
+            content = message["content"]
+            if not isinstance(content, str) and any("cache_control" in part for part in content):
+                content = [
+                    {key: value for key, value in part.items() if key != "cache_control"}
+                    for part in content
+                ]
+                message = {**message, "content": content}
+            stripped.append(message)
+        return stripped
+    
+    def _history_budget(self, model_key: str) -> int:
+        return config.MODELS[model_key].get("context_tokens", config.HISTORY_TOKEN_BUDGET)
+    
+    def _build_payload(self, messages: List[Dict], stream: bool) -> Dict[str, Any]:
+        """Тело запроса к OpenRouter (model подставляется в _request)"""
+        return {
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": 2000,
+            "stream": stream,
+            "usage": {"include": True}
+        }
+    
+    async def _commit_history(
+        self,
+        user_id: int,
+        model_key: str,
+        message: str,
+        assistant_message: str
+    ) -> None:
+        """Сохранение завершенного обмена в историю.
+        
+        Старые сообщения, не помещающиеся в лимиты, уходят в фоновое
+        сжатие в краткое содержание.
+        """
+        folded = await conversation_store.append(user_id, [
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": assistant_message}
+        ])
+        
+        history = await conversation_store.get(user_id)
+        tokens = sum(estimate_tokens(m["content"]) for m in history)
+        budget = self._history_budget(model_key)
+        if tokens > budget:
+            # Сворачиваем с запасом, чтобы не суммировать на каждом ходу
+            target = budget * config.SUMMARY_TARGET_RATIO
+            count = 0
+            while count < len(history) - 2 and tokens > target:
+                tokens -= estimate_tokens(history[count]["content"])
+                tokens -= estimate_tokens(history[count + 1]["content"])
+                count += 2
+            folded.extend(await conversation_store.pop_oldest(user_id, count))
+        
+        if folded:
+            summarizer.fold(user_id, folded)
+    
+    async def summarize(self, user_id: int, summary: Optional[str], messages: List[Dict[str, str]]) -> str:
+        """Обновление краткого содержания дешевой моделью"""
+        dialog = "\n".join(
+            f"{'Пользователь' if m['role'] == 'user' else 'Ассистент'}: {m['content']}"
+            for m in messages
+        )
+        prompt = (
+            "Обнови краткое содержание диалога. Сохрани факты, договоренности, "
+            "имена и незакрытые вопросы, отбрось повторы. Ответь только текстом "
+            "краткого содержания.\n\n"
+            f"Текущее краткое содержание:\n{summary or '(нет)'}\n\n"
+            f"Новые сообщения:\n{dialog}"
+        )
+        payload = {
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0.2,
+            "max_tokens": config.SUMMARY_MAX_TOKENS,
+            "stream": False,
+            "usage": {"include": True}
+        }
+        
+        chain = self._fallback_chain(False, config.SUMMARY_MODEL)
+        started = time.monotonic()
+        async with self._request(user_id, payload, chain) as (served, response):
+            data = await response.json()
+            elapsed = time.monotonic() - started
+            self._record_usage(user_id, served, data.get("usage"), elapsed, elapsed)
+            return data["choices"][0]["message"]["content"].strip()
+    
+    @staticmethod
+    def _record_usage(
+        user_id: int,
+        model_key: str,
+        usage: Optional[Dict[str, Any]],
+        latency: float,
+        duration: float
+    ) -> None:
+        """Запись токенов и стоимости ответа в статистику расхода"""
+        logger.info(
+            "Ответ модели",
+            extra={
+                "user_id": user_id,
+                "model": model_key,
+                "latency": round(latency, 3),
+                "duration": round(duration, 3),
+                "tokens": usage.get("total_tokens") if usage else None,
+            }
+        )
+        if not usage:
+            return
+        details = usage.get("prompt_tokens_details") or {}
+        stats.add_usage(
+            user_id,
+            model_key,
+            int(usage.get("prompt_tokens") or 0),
+            int(usage.get("completion_tokens") or 0),
+            float(usage.get("cost") or 0.0),
+            latency,
+            duration,
+            cached_tokens=int(details.get("cached_tokens") or 0)
+        )
+    
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+    
+    async def _check_response(self, response: aiohttp.ClientResponse, model_key: str) -> None:
+        """Проверка статуса ответа API"""
+        if response.status == 200:
+            return
+        
+        if response.status == 402:
+            raise AIServiceError("⚠️ Нейросеть недоступна. Используйте другую модель.")
+        
+        error_text = await response.text()
+        logger.error(
+            "Ошибка API: %s - %s", response.status, error_text,
+            extra={"model": model_key, "status": response.status}
+        )
+        raise AIServiceError(
+            "⚠️ Ошибка. Попробуйте еще раз.",
+            retryable=response.status in config.RETRY_STATUSES,
+            retry_after=self._parse_retry_after(response.headers.get("Retry-After"))
+        )
+    
+    def _has_images(self, images: Optional[List[Dict]], model_key: str) -> bool:
+        return bool(images) and config.MODELS[model_key]["supports_images"]
+    
+    def _fallback_chain(self, has_images: bool, model_key: str) -> List[str]:
+        """Запрошенная модель и резервные, подходящие для запроса"""
+        chain = [model_key]
+        for model_key in config.FALLBACK_ORDER:
+            if model_key in chain or model_key not in config.MODELS:
+                continue
+            if has_images and not config.MODELS[model_key]["supports_images"]:
+                continue
+            chain.append(model_key)
+        return chain
+    
+    def _route_chain(self, model_key: str, has_images: bool, auto: bool) -> List[str]:
+        """Цепочка моделей: в авторежиме резервные идут по замерам, а не по FALLBACK_ORDER"""
+        if not auto:
+            return self._fallback_chain(has_images, model_key)
+        ranked = model_router.rank(has_images, self._available)
+        return [model_key] + [key for key in ranked if key != model_key]
+    
+    async def _open(
+        self,
+        user_id: int,
+        model_key: str,
+        payload: Dict[str, Any],
+        on_queued: Optional[Callable[[int], Awaitable[None]]],
+        first_event: bool = False
+    ) -> aiohttp.ClientResponse:
+        """Один запрос к модели; при ошибке слот планировщика освобождается.
+        
+        first_event=True - для потока дождаться и первой строки data:
+        (прочитанное остается в response.sse_head, см. _sse_lines).
+        """
+        await scheduler.acquire(user_id, model_key, on_queued)
+        response = None
+        try:
+            # Поток может идти дольше общего таймаута - ограничиваем паузы чтения
+            timeout = (
+                aiohttp.ClientTimeout(
+                    total=None,
+                    connect=config.HTTP_CONNECT_TIMEOUT,
+                    sock_read=config.HTTP_TIMEOUT
+                )
+                if payload.get("stream") else None
+            )
+            body = {**payload, "model": config.MODELS[model_key]["id"]}
+            if not config.MODELS[model_key].get("prompt_cache"):
+                body["messages"] = self._strip_cache_breakpoints(payload["messages"])
+            started = time.perf_counter()
+            response = await self.session.post(
+                self.api_url,
+                headers=self.headers,
+                data=JsonStreamPayload(body),
+                timeout=timeout
+            )
+            metrics.openrouter_seconds.observe(time.perf_counter() - started, model_key)
+            metrics.openrouter_responses.inc(model_key, str(response.status))
+            await self._check_response(response, model_key)
+            if first_event:
+                response.sse_head = await self._read_first_event(response)
+            return response
+        except BaseException as e:
+            if response is None and isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+                metrics.openrouter_responses.inc(model_key, type(e).__name__)
+            if response is not None:
+                response.release()
+            scheduler.release(model_key)
+            raise
+    
+    @staticmethod
+    async def _read_first_event(response: aiohttp.ClientResponse) -> List[bytes]:
+        """Строки потока до первой data: включительно (комментарии SSE приходят раньше)"""
+        lines = []
+        async for raw_line in response.content:
+            lines.append(raw_line)
+            if raw_line.startswith(b"data:"):
+                break
+        return lines
+    
+    @staticmethod
+    async def _sse_lines(response: aiohttp.ClientResponse) -> AsyncIterator[bytes]:
+        for raw_line in getattr(response, "sse_head", ()):
+            yield raw_line
+        async for raw_line in response.content:
+            yield raw_line
+    
+    async def _open_hedged(
+        self,
+        user_id: int,
+        primary: str,
+        secondary: str,
+        delay: float,
+        payload: Dict[str, Any],
+        on_queued: Optional[Callable[[int], Awaitable[None]]]
+    ) -> Optional[Tuple[str, aiohttp.ClientResponse]]:
+        """Запрос к основной модели, дублируемый во вторую после задержки.
+        
+        Побеждает первый успешный ответ, второй запрос отменяется. Для
+        потока ответ считается полученным с первым событием, а не со
+        статусом: OpenRouter отдает заголовки сразу.
+        None - обе попытки не удались, дальше работают обычные повторы.
+        """
+        stream = bool(payload.get("stream"))
+        tasks: Dict[asyncio.Task, str] = {
+            asyncio.create_task(self._open(user_id, primary, payload, on_queued, stream)): primary
+        }
+        pending = set(tasks)
+        winner: Optional[asyncio.Task] = None
+        try:
+            try:
+                while pending and winner is None:
+                    hedging = len(tasks) == 1
+                    done, pending = await asyncio.wait(
+                        pending,
+                        timeout=delay if hedging else None,
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        if winner is None and task.exception() is None:
+                            winner = task
+                            continue
+                        error = task.exception()
+                        if error is None:
+                            continue
+                        if not isinstance(error, (AIServiceError, aiohttp.ClientError, asyncio.TimeoutError)):
+                            raise error
+                        breaker = self.breakers[tasks[task]]
+                        if getattr(error, "retryable", True):
+                            breaker.record_failure()
+                            model_router.record_result(tasks[task], ok=False)
+                        else:
+                            breaker.record_cancel()
+                
+                    if hedging and not done and self.breakers[secondary].allow():
+                        model_router.hedged += 1
+                        task = asyncio.create_task(self._open(user_id, secondary, payload, None, stream))
+                        tasks[task] = secondary
+                        pending.add(task)
+            finally:
+                losers = [task for task in tasks if task is not winner]
+                for task in losers:
+                    task.cancel()
+                await asyncio.gather(*losers, return_exceptions=True)
+                for task in losers:
+                    self.breakers[tasks[task]].record_cancel()
+                    if not task.cancelled() and task.exception() is None:
+                        # Ответ пришел одновременно с победителем
+                        task.result().release()
+                        scheduler.release(tasks[task])
+        except BaseException:
+            # Неожиданная ошибка или отмена после выбора победителя:
+            # его ответ и слот планировщика иначе не освобождаются
+            if winner is not None:
+                winner.result().release()
+                scheduler.release(tasks[winner])
+                self.breakers[tasks[winner]].record_cancel()
+            raise
+        
+        if winner is None:
+            return None
+        if tasks[winner] == secondary:
+            model_router.hedge_wins += 1
+        return tasks[winner], winner.result()
+    
+    @asynccontextmanager
+    async def _request(
+        self,
+        user_id: int,
+        payload: Dict[str, Any],
+        chain: List[str],
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+        hedge: bool = False
+    ):
+        """Запрос с повторами, предохранителями и резервными моделями.
+        
+        Отдает пару (модель, ответ). Повторяется только установка
+        соединения и получение статуса: после начала чтения ответа
+        ошибки передаются вызывающему. С hedge=True запрос дублируется во
+        вторую модель цепочки, если ответ (для потока - первое событие)
+        задерживается дольше p95 задержки основной модели.
+        """
+        last_error = AIServiceError("⚠️ Нейросеть временно недоступна. Попробуйте позже.")
+        served: Optional[Tuple[str, aiohttp.ClientResponse]] = None
+        
+        delay = model_router.p95(chain[0])
+        if (
+            hedge and config.HEDGE_ENABLED
+            and delay is not None and len(chain) > 1
+            and self.breakers[chain[0]].allow()
+        ):
+            served = await self._open_hedged(
+                user_id, chain[0], chain[1], max(delay, config.HEDGE_MIN_DELAY), payload, on_queued
+            )
+        
+        for model_key in chain if served is None else []:
+            breaker = self.breakers[model_key]
+            if not breaker.allow():
+                continue
+            
+            response = None
+            for attempt in range(config.RETRY_ATTEMPTS + 1):
+                try:
+                    response = await self._open(user_id, model_key, payload, on_queued)
+                    break
+                except AIServiceError as e:
+                    last_error = e
+                except aiohttp.ClientError:
+                    last_error = AIServiceError("⚠️ Ошибка подключения.", retryable=True)
+                except asyncio.TimeoutError:
+                    last_error = AIServiceError("⚠️ Превышено время ожидания.", retryable=True)
+                except BaseException:
+                    breaker.record_cancel()
+                    raise
+                
+                if not last_error.retryable:
+                    # Ошибка не связана со здоровьем модели - сразу к резервной
+                    breaker.record_cancel()
+                    break
+                
+                breaker.record_failure()
+                model_router.record_result(model_key, ok=False)
+                if attempt == config.RETRY_ATTEMPTS or not breaker.allow():
+                    break
+                
+                delay = min(config.RETRY_MAX_DELAY, config.RETRY_BASE_DELAY * 2 ** attempt)
+                delay *= random.uniform(0.5, 1.0)
+                if last_error.retry_after is not None:
+                    if last_error.retry_after > config.RETRY_MAX_DELAY:
+                        break
+                    delay = max(delay, last_error.retry_after)
+                await asyncio.sleep(delay)
+            
+            if response is None:
+                logger.warning(
+                    "Модель %s недоступна: %s", model_key, last_error,
+                    extra={"user_id": user_id, "model": model_key}
+                )
+                continue
+            
+            served = (model_key, response)
+            break
+        
+        if served is None:
+            raise last_error
+        
+        model_key, response = served
+        if model_key != chain[0]:
+            logger.info(
+                "Запрос %s обслужен резервной моделью %s", user_id, model_key,
+                extra={"user_id": user_id, "model": model_key}
+            )
+        
+        breaker = self.breakers[model_key]
+        try:
+            yield model_key, response
+        except (aiohttp.ClientError, asyncio.TimeoutError, AIServiceError):
+            breaker.record_failure()
+            model_router.record_result(model_key, ok=False)
+            raise
+        except BaseException:
+            breaker.record_cancel()
+            raise
+        else:
+            breaker.record_success()
+            model_router.record_result(model_key, ok=True)
+        finally:
+            response.release()
+            scheduler.release(model_key)
+    
+    async def generate_response(
+        self, 
+        user_id: int,
+        model_key: str,
+        message: str,
+        images: Optional[List[Dict]] = None,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+        auto: bool = False
+    ) -> str:
+        """Генерация ответа.
+        
+        model_key - конкретная модель (см. pick_model), auto - модель
+        выбрана автоматически и запрос можно дублировать в другую.
+        """
+        
+        messages = await self._build_messages(user_id, model_key, message, images)
+        payload = self._build_payload(messages, stream=False)
+        # В авторежиме подходит ответ любой модели
+        cache_key = response_cache.make_key(config.AUTO_MODEL if auto else model_key, messages, payload)
+        
+        if cache_key is not None:
+            cached = await response_cache.lookup(cache_key)
+            if cached is not None:
+                await self._commit_history(user_id, model_key, message, cached)
+                return cached
+        
+        chain = self._route_chain(model_key, self._has_images(images, model_key), auto)
+        started = time.monotonic()
+        try:
+            async with self._request(user_id, payload, chain, on_queued, hedge=auto) as (served, response):
+                data = await response.json(loads=json_loads)
+                assistant_message = data["choices"][0]["message"]["content"]
+                elapsed = time.monotonic() - started
+                model_router.record_latency(served, elapsed)
+                metrics.openrouter_ttft.observe(elapsed, served)
+                model_router.routed[served] += 1
+                self._record_usage(user_id, served, data.get("usage"), elapsed, elapsed)
+                
+                if cache_key is not None:
+                    response_cache.complete(cache_key, assistant_message)
+                await self._commit_history(user_id, served, message, assistant_message)
+                return assistant_message
+                        
+        except AIServiceError as e:
+            return str(e)
+        except aiohttp.ClientError:
+            return "⚠️ Ошибка подключения."
+        except asyncio.TimeoutError:
+            return "⚠️ Превышено время ожидания."
+        except Exception as e:
+            logger.error("Ошибка: %s", e, exc_info=True, extra={"user_id": user_id, "model": model_key})
+            return "⚠️ Внутренняя ошибка."
+        finally:
+            if cache_key is not None:
+                response_cache.abort(cache_key)
+    
+    async def stream_response(
+        self,
+        user_id: int,
+        model_key: str,
+        message: str,
+        images: Optional[List[Dict]] = None,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+        auto: bool = False
+    ) -> AsyncIterator[str]:
+        """Потоковая генерация ответа (SSE), отдает фрагменты текста.
         
-        if len(messages) > config.MAX_HISTORY_LENGTH * 2:
-            messages = messages[-(config.MAX_HISTORY_LENGTH * 2):]
+        История сохраняется только после успешного завершения потока,
+        при ошибке выбрасывается AIServiceError.
+        """
         
-        payload = {
-            "model": self.model_info["id"],
-            "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": 2000,
-            "stream": False
-        }
+        messages = await self._build_messages(user_id, model_key, message, images)
+        payload = self._build_payload(messages, stream=True)
+        parts: List[str] = []
+        usage: Optional[Dict[str, Any]] = None
+        first_text = 0.0
+        cache_key = response_cache.make_key(config.AUTO_MODEL if auto else model_key, messages, payload)
+        
+        if cache_key is not None:
+            cached = await response_cache.lookup(cache_key)
+            if cached is not None:
+                yield cached
+                await self._commit_history(user_id, model_key, message, cached)
+                return
         
+        chain = self._route_chain(model_key, self._has_images(images, model_key), auto)
+        started = time.monotonic()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.api_url,
-                    headers=self.headers,
-                    json=payload,
-                    timeout=60
-                ) as response:
+            async with self._request(user_id, payload, chain, on_queued, hedge=auto) as (served, response):
+                model_router.routed[served] += 1
+                async for raw_line in self._sse_lines(response):
+                    line = raw_line.decode("utf-8").strip()
+                    # Пустые строки и комментарии SSE (": OPENROUTER PROCESSING")
+                    if not line.startswith("data:"):
+                        continue
                     
-                    if response.status == 200:
-                        data = await response.json()
-                        assistant_message = data["choices"][0]["message"]["content"]
-                        
-                        user_conversations[user_id].extend([
-                            {"role": "user", "content": message},
-                            {"role": "assistant", "content": assistant_message}
-                        ])
-                        
-                        if len(user_conversations[user_id]) > config.MAX_HISTORY_LENGTH * 2:
-                            user_conversations[user_id] = user_conversations[user_id][-(config.MAX_HISTORY_LENGTH * 2):]
-                        
-                        return assistant_message
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
                     
-                    elif response.status == 402:
-                        return "⚠️ Нейросеть недоступна. Используйте другую модель."
+                    chunk = json_loads(data)
+                    if "error" in chunk:
+                        logger.error(
+                            "Ошибка потока API: %s", chunk["error"],
+                            extra={"user_id": user_id, "model": served}
+                        )
+                        raise AIServiceError("⚠️ Ошибка. Попробуйте еще раз.")
                     
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка API: {response.status} - {error_text}")
-                        return f"⚠️ Ошибка. Попробуйте еще раз."
-                        
+                    # usage приходит в последнем фрагменте, обычно без choices
+                    if chunk.get("usage"):
+                        usage = chunk["usage"]
+                    
+                    choices = chunk.get("choices") or []
+                    if not choices:
+                        continue
+                    
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        if not parts:
+                            first_text = time.monotonic() - started
+                            model_router.record_latency(served, first_text)
+                            metrics.openrouter_ttft.observe(first_text, served)
+                        parts.append(delta)
+                        yield delta
+            
+            assistant_message = "".join(parts)
+            if not assistant_message:
+                raise AIServiceError("⚠️ Пустой ответ. Попробуйте еще раз.")
+            
+            if cache_key is not None:
+                response_cache.complete(cache_key, assistant_message)
+        
+        except AIServiceError:
+            raise
         except aiohttp.ClientError:
-            return "⚠️ Ошибка подключения."
+            raise AIServiceError("⚠️ Ошибка подключения.")
         except asyncio.TimeoutError:
-            return "⚠️ Превышено время ожидания."
+            raise AIServiceError("⚠️ Превышено время ожидания.")
         except Exception as e:
-            logger.error(f"Ошибка: {e}")
-            return "⚠️ Внутренняя ошибка."
+            logger.error("Ошибка: %s", e, exc_info=True, extra={"user_id": user_id, "model": model_key})
+            raise AIServiceError("⚠️ Внутренняя ошибка.")
+        finally:
+            if cache_key is not None:
+                response_cache.abort(cache_key)
+        
+        self._record_usage(user_id, served, usage, first_text, time.monotonic() - started)
+        await self._commit_history(user_id, served, message, assistant_message)
+    
+    async def get_balance(self) -> Optional[Dict[str, Any]]:
+        """Баланс ключа OpenRouter из кэша (запрос к API - только если кэш пуст)"""
+        if self.balance is None:
+            await self.refresh_balance()
+        return self.balance
+    
+    async def refresh_balance(self) -> None:
+        try:
+            data = await self._fetch_balance()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Не удалось обновить баланс: %r", e)
+            return
+        if data is not None:
+            self.balance = data
+            self.balance_updated = time.time()
+    
+    async def run_balance_refresher(self) -> None:
+        """Фоновое обновление баланса"""
+        while True:
+            await self.refresh_balance()
+            await asyncio.sleep(config.BALANCE_REFRESH_INTERVAL)
+    
+    async def _fetch_balance(self) -> Optional[Dict[str, Any]]:
+        """Запрос баланса ключа OpenRouter"""
+        async with self.session.get(
+            urllib.parse.urljoin(self.api_url, "/api/v1/auth/key"),
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            timeout=aiohttp.ClientTimeout(total=10)
+        ) as response:
+            if response.status != 200:
+                return None
+            data = await response.json()
+            return data.get("data", {})
     
     async def clear_history(self, user_id: int) -> None:
         """Очистка истории"""
-        if user_id in user_conversations:
-            user_conversations[user_id] = []
-        if user_id in user_last_images:
-            del user_last_images[user_id]
+        summarizer.discard(user_id)
+        await conversation_store.clear(user_id)
+        for image_ref in await user_state.pop_images(user_id):
+            image_cache.release(image_ref["file_unique_id"])
+    
+    async def get_image_part(self, image_ref: Dict[str, Any], model_key: str) -> Dict[str, Any]:
+        """Изображение пользователя, готовое для API (из кэша или Telegram)"""
+        max_side = image_processor.max_side(config.MODELS[model_key])
+        
+        async def load() -> Dict[str, Any]:
+            file_info = await bot.get_file(image_ref["file_id"])
+            # Скачивание идет мимо middleware Bot API - замеряем отдельно
+            async with metrics.telegram_seconds.time("downloadFile"):
+                file_bytes = await bot.download_file(file_info.file_path)
+            return await self.process_image(file_bytes.read(), image_ref["mime_type"], max_side)
+        
+        return await image_cache.get_or_load(image_ref["file_unique_id"], max_side, load)
+
+class HistorySummarizer:
+    """Фоновое сворачивание старых сообщений в краткое содержание"""
+    
+    def __init__(self):
+        self.pending: Dict[int, List[Dict[str, str]]] = {}
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.generations: Dict[int, int] = defaultdict(int)
+        self.failures = 0
+    
+    def fold(self, user_id: int, messages: List[Dict[str, str]]) -> None:
+        """Постановка сообщений в очередь на сворачивание"""
+        self.pending.setdefault(user_id, []).extend(messages)
+        if user_id not in self.tasks:
+            self.tasks[user_id] = asyncio.create_task(self._run(user_id))
+    
+    def discard(self, user_id: int) -> None:
+        """Сброс при очистке истории"""
+        self.pending.pop(user_id, None)
+        self.generations[user_id] += 1
+    
+    async def _run(self, user_id: int) -> None:
+        try:
+            while self.pending.get(user_id):
+                batch = self.pending.pop(user_id)
+                generation = self.generations[user_id]
+                summary, _ = await conversation_store.get_context(user_id)
+                
+                try:
+                    summary = await ai_service.summarize(user_id, summary, batch)
+                except Exception as e:
+                    self.failures += 1
+                    logger.error("Ошибка сворачивания истории %s: %s", user_id, e, extra={"user_id": user_id})
+                    # Вернем сообщения в очередь до следующего хода
+                    if generation == self.generations[user_id]:
+                        pending = batch + self.pending.get(user_id, [])
+                        self.pending[user_id] = pending[-config.SUMMARY_MAX_PENDING:]
+                    return
+                
+                if generation == self.generations[user_id]:
+                    await conversation_store.set_summary(user_id, summary)
+        finally:
+            self.tasks.pop(user_id, None)
+            if user_id not in self.pending:
+                self.generations.pop(user_id, None)
+
+summarizer = HistorySummarizer()
 
 # Инициализация сервиса
 ai_service = AIService()
 
+HTML_TOKEN_RE = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^<>]*>|&#?\w+;")
+HTML_TAG_RE = re.compile(r"</?[a-zA-Z][\w-]*[^<>]*>")
+SPLIT_SEPARATORS = ("\n\n", "\n", ". ", "! ", "? ", "; ", ", ", " ")
+
+def split_html(text: str, limit: int) -> Tuple[str, str]:
+    """Отделение начала текста длиной не больше limit.
+    
+    Граница ищется по абзацам, строкам, предложениям и словам (не раньше
+    середины лимита), никогда внутри тега или HTML-сущности. Открытые на
+    границе теги закрываются в первой части (закрывающие теги входят в
+    limit) и открываются заново во второй. Если разметка не оставляет
+    места для текста, теги отбрасываются.
+    """
+    if len(text) <= limit:
+        return text, ""
+    
+    tokens = []
+    for match in HTML_TOKEN_RE.finditer(text):
+        if match.start() >= limit:
+            break
+        tokens.append(match)
+    
+    # Теги в самом начале (открытые заново после прошлого разбиения):
+    # часть должна содержать хотя бы один символ после них
+    lead = 0
+    for m in tokens:
+        if m.start() != lead:
+            break
+        lead = m.end()
+    
+    def allowed(cut: int) -> bool:
+        return cut > lead and not any(m.start() < cut < m.end() for m in tokens)
+    
+    def open_tags(cut: int) -> List[Tuple[str, str]]:
+        stack: List[Tuple[str, str]] = []
+        for m in tokens:
+            if m.end() > cut:
+                break
+            if not m.group(2) or m.group(0).endswith("/>"):
+                continue
+            name = m.group(2).lower()
+            if not m.group(1):
+                stack.append((name, m.group(0)))
+            elif any(tag == name for tag, _ in stack):
+                while stack.pop()[0] != name:
+                    pass
+        return stack
+    
+    def find_cut(end: int) -> Optional[int]:
+        for separator in SPLIT_SEPARATORS:
+            pos = text.rfind(separator, end // 2, end)
+            while pos > 0 and not allowed(pos + len(separator)):
+                pos = text.rfind(separator, end // 2, pos)
+            if pos > 0:
+                return pos + len(separator)
+        cut = end
+        while cut > lead and not allowed(cut):
+            cut -= 1
+        return cut if allowed(cut) else None
+    
+    end = limit
+    while end > lead:
+        cut = find_cut(end)
+        if cut is None:
+            break
+        stack = open_tags(cut)
+        closing = "".join(f"</{name}>" for name, _ in reversed(stack))
+        head = text[:cut].rstrip()
+        if head and len(head) + len(closing) <= limit:
+            rest = "".join(tag for _, tag in stack) + text[cut:].lstrip()
+            return head + closing, rest
+        end = min(cut - 1, limit - len(closing))
+    
+    # Разметка длиннее лимита (или тег длиннее сообщения)
+    plain = HTML_TAG_RE.sub("", text)
+    if plain != text:
+        return split_html(plain, limit)
+    return text[:limit], text[limit:]
+
+def split_message(text: str, limit: int) -> List[str]:
+    """Разбиение ответа на сообщения Telegram с сохранением HTML-разметки"""
+    parts = []
+    while text:
+        head, text = split_html(text, limit)
+        parts.append(head)
+    return parts
+
+class StreamingReply:
+    """Прогрессивный вывод ответа правкой сообщения в Telegram"""
+    
+    def __init__(self, message: Message, status_msg: Message):
+        self.message = message
+        self.current = status_msg
+        self.buffer = ""
+        self.shown = ""
+        self.last_edit = 0.0
+        self.progress: Optional[asyncio.Task] = None
+    
+    async def _edit(self, text: str, final: bool = False) -> None:
+        if not text or text == self.shown:
+            return
+        try:
+            if final:
+                try:
+                    await self.current.edit_text(text)
+                except TelegramBadRequest:
+                    # Незакрытые HTML-теги - показываем как обычный текст
+                    await self.current.edit_text(text, parse_mode=None)
+            else:
+                # Промежуточный текст может обрывать HTML-теги
+                await self.current.edit_text(text, parse_mode=None)
+            self.shown = text
+        except TelegramBadRequest as e:
+            logger.warning("Не удалось обновить сообщение: %s", e)
+        self.last_edit = time.monotonic()
+    
+    async def _edit_progress(self, text: str) -> None:
+        with progress_sends():
+            await self._edit(text)
+    
+    async def _settle(self) -> None:
+        """Ожидание фоновой правки перед финальной"""
+        if self.progress is not None:
+            await asyncio.gather(self.progress, return_exceptions=True)
+            self.progress = None
+    
+    async def feed(self, delta: str) -> None:
+        """Добавление фрагмента ответа"""
+        self.buffer += delta
+        
+        while len(self.buffer) > config.MAX_MESSAGE_LENGTH:
+            head, self.buffer = split_html(self.buffer, config.MAX_MESSAGE_LENGTH)
+            await self._settle()
+            await self._edit(head, final=True)
+            self.current = await self.message.answer("⏳ ...")
+            self.shown = ""
+        
+        # Промежуточная правка идет в фоне: чтение потока не ждет очередь
+        # отправки, а пока правка не ушла, следующие пропускаются
+        if (
+            time.monotonic() - self.last_edit >= config.STREAM_EDIT_INTERVAL
+            and (self.progress is None or self.progress.done())
+        ):
+            self.last_edit = time.monotonic()
+            self.progress = asyncio.create_task(self._edit_progress(self.buffer))
+    
+    async def finish(self) -> None:
+        """Финальная отрисовка"""
+        await self._settle()
+        await self._edit(self.buffer, final=True)
+    
+    async def fail(self, error_text: str) -> None:
+        """Завершение с ошибкой"""
+        await self._settle()
+        if self.buffer:
+            await self._edit(self.buffer, final=True)
+            await self.message.answer(error_text)
+        else:
+            await self._edit(error_text, final=True)
+
 # Клавиатуры
 def get_main_keyboard() -> ReplyKeyboardMarkup:
     buttons = [
@@ -303,6 +4311,7 @@ def get_models_keyboard() -> ReplyKeyboardMarkup:
         text = f"{emoji} {model_info['name']}"
         buttons.append([KeyboardButton(text=text)])
     
+    buttons.append([KeyboardButton(text="🤖 Авто")])
     buttons.append([KeyboardButton(text="🔙 Назад")])
     return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
@@ -310,17 +4319,89 @@ def get_admin_keyboard() -> ReplyKeyboardMarkup:
     buttons = [
         [KeyboardButton(text="📊 Статистика"), KeyboardButton(text="💰 Баланс API")],
         [KeyboardButton(text="👥 Топ пользователей"), KeyboardButton(text="📈 Активность")],
+        [KeyboardButton(text="📉 Метрики"), KeyboardButton(text="💸 Расходы")],
         [KeyboardButton(text="🔙 Главное меню")]
     ]
     return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
+def format_usage_report(view: Statistics) -> str:
+    """Расход токенов и кредитов по данным usage от OpenRouter"""
+    usage_by_model = view.get_usage_by_model()
+    if not usage_by_model:
+        return "📭 Нет данных о расходе"
+    
+    text = "💸 <b>Расход моделей</b>\n\n"
+    for model_key, item in sorted(usage_by_model.items(), key=lambda x: -x[1]["cost"]):
+        name = config.MODELS[model_key]["name"] if model_key in config.MODELS else model_key
+        text += (
+            f"<b>{name}</b>\n"
+            f"• Запросов: {item['requests']}, токенов: {item['prompt_tokens']} → {item['completion_tokens']}\n"
+            f"• Из кэша: {item['cached_tokens']} токенов ({item['cache_ratio']:.0%} промпта)\n"
+            f"• Стоимость: {item['cost']:.4f} (за запрос {item['cost_per_request']:.5f})\n"
+            f"• Скорость: {item['tokens_per_second']:.1f} ток/с, первый текст через {item['avg_latency']:.1f}с\n\n"
+        )
+    
+    text += "<b>📅 Итого:</b>\n"
+    for title, period in (("Сегодня", 1), ("За неделю", 7), ("За месяц", 30), ("Всего", None)):
+        total = view.get_usage_total(period)
+        text += (
+            f"• {title}: {total['cost']:.4f} кредитов, {total['requests']} запросов, "
+            f"кэш {total['cache_ratio']:.0%}\n"
+        )
+    
+    top = view.get_top_spenders(5)
+    if top:
+        text += "\n<b>👥 Больше всего тратят:</b>\n"
+        for i, (user_id, item) in enumerate(top, 1):
+            text += f"{i}. ID: {user_id} - {item['cost']:.4f} ({item['requests']} запросов)\n"
+    return text
+
+def format_metrics_report() -> str:
+    """Краткая сводка метрик для админа"""
+    def timing(histogram: Histogram, *labels: str) -> str:
+        p50 = histogram.quantile(0.5, *labels)
+        p95 = histogram.quantile(0.95, *labels)
+        return f"{histogram.count(*labels)} шт., p50 {p50:.2f}с, p95 {p95:.2f}с"
+    
+    text = "📉 <b>Метрики</b>\n\n<b>🤖 OpenRouter (до статуса / до первого текста):</b>\n"
+    for model_key, model_info in config.MODELS.items():
+        if not metrics.openrouter_seconds.count(model_key):
+            continue
+        text += f"• {model_info['name']}: {timing(metrics.openrouter_seconds, model_key)}\n"
+        if metrics.openrouter_ttft.count(model_key):
+            text += f"  первый текст: {timing(metrics.openrouter_ttft, model_key)}\n"
+    
+    errors = {
+        key: count for key, count in metrics.openrouter_responses.values.items() if key[1] != "200"
+    }
+    if errors:
+        text += "• Ошибки: " + ", ".join(
+            f"{config.MODELS[model_key]['name']} {status}: {int(count)}"
+            for (model_key, status), count in sorted(errors.items())
+        ) + "\n"
+    
+    text += "\n<b>✈️ Telegram API:</b>\n"
+    for (method,) in sorted(metrics.telegram_seconds.values):
+        text += f"• {method}: {timing(metrics.telegram_seconds, method)}\n"
+    telegram_errors = sum(metrics.telegram_errors.values.values())
+    text += f"• Ошибок: {int(telegram_errors)}, выполняется: {int(metrics.telegram_in_flight.values[()])}\n"
+    
+    text += "\n<b>⏱️ Обработка сообщений:</b>\n"
+    for (branch,) in sorted(metrics.handler_seconds.values):
+        text += f"• {branch}: {timing(metrics.handler_seconds, branch)}\n"
+    text += f"• Обрабатывается: {int(metrics.handlers_in_flight.values[()])}\n"
+    
+    if config.METRICS_ENABLED:
+        text += f"\n🔗 http://{config.METRICS_HOST}:{config.METRICS_PORT}/metrics"
+    return text
+
 # Обработчики команд
 @router.message(CommandStart())
 async def cmd_start(message: Message):
     """Команда /start"""
     stats.add_user(message.from_user.id)
     
-    model_info = ai_service.get_model_info()
+    model_info = ai_service.get_model_info(await user_state.get_model(message.from_user.id))
     
     # Проверяем, админ ли это
     is_admin = message.from_user.id == config.ADMIN_ID
@@ -358,17 +4439,19 @@ async def cmd_stats(message: Message):
     if message.from_user.id != config.ADMIN_ID:
         return
     
-    total_users = stats.get_users_count()
-    requests_today = stats.get_requests_count(1)
-    active_today = stats.get_active_users_today()
+    view = await admin_stats()
+    total_users = view.get_users_count()
+    requests_today = view.get_requests_count(1)
+    active_today = view.get_active_users_today()
     
     quick_stats = (
         "📊 <b>Быстрая статистика</b>\n\n"
         f"👥 Пользователей: {total_users}\n"
         f"📨 Запросов сегодня: {requests_today}\n"
         f"🟢 Активных сегодня: {active_today}\n"
-        f"💾 Активных чатов: {len(user_conversations)}\n\n"
-        f"🤖 Модель: {ai_service.get_model_info()['name']}"
+        f"💾 Активных чатов: {len(conversation_store)}\n\n"
+        f"🤖 Модель по умолчанию: {ai_service.get_model_info(config.DEFAULT_MODEL)['name']}"
+        f"{worker_stats_note()}"
     )
     
     await message.answer(quick_stats)
@@ -404,7 +4487,7 @@ async def cmd_clear(message: Message):
 async def cmd_model(message: Message):
     """Команда /model"""
     models = ai_service.get_all_models()
-    current_model = ai_service.current_model
+    current_model = await user_state.get_model(message.from_user.id)
     
     model_text = "🤖 <b>Выберите модель:</b>\n\n"
     
@@ -414,56 +4497,171 @@ async def cmd_model(message: Message):
         model_text += f"{emoji} <b>{model_info['name']}</b>{current}\n"
         model_text += f"   {model_info['description']}\n\n"
     
+    current = " ✅" if current_model == config.AUTO_MODEL else ""
+    model_text += f"🤖 <b>Авто</b>{current}\n"
+    model_text += "   Самая быстрая доступная модель для каждого запроса\n\n"
+    
     await message.answer(model_text, reply_markup=get_models_keyboard())
 
-# Обработчик фотографий
-@router.message(F.photo)
-async def handle_photo(message: Message):
-    """Обработка фотографий"""
+async def save_photos(messages: List[Message]) -> None:
+    """Сохранение фото (одного или всего альбома) для следующего запроса"""
+    message = messages[0]
     user_id = message.from_user.id
     
     try:
-        stats.add_image(user_id)
+        choice = await user_state.get_model(user_id)
+        model_key = ai_service.pick_model(choice, need_images=True)
+        max_side = image_processor.max_side(config.MODELS[model_key])
         
-        photo = message.photo[-1]
-        file_info = await bot.get_file(photo.file_id)
-        file_bytes = await bot.download_file(file_info.file_path)
-        image_bytes = file_bytes.read()
+        # Лимиты на один запрос: лишние фото альбома не сохраняются
+        image_refs = []
+        total_size = 0
+        skipped = 0
+        for part in messages:
+            stats.add_image(user_id)
+            photo = image_processor.pick_photo_size(part.photo, max_side)
+            size = photo.file_size or 0
+            if (
+                size > config.MAX_IMAGE_SIZE_MB * 1024 * 1024
+                or len(image_refs) >= config.MAX_IMAGES_PER_REQUEST
+                or total_size + size > config.MAX_IMAGES_TOTAL_MB * 1024 * 1024
+            ):
+                skipped += 1
+                continue
+            total_size += size
+            image_refs.append({
+                "file_id": photo.file_id,
+                "file_unique_id": photo.file_unique_id,
+                "mime_type": "image/jpeg"
+            })
         
-        if len(image_bytes) > config.MAX_IMAGE_SIZE_MB * 1024 * 1024:
+        if not image_refs:
             await message.answer(f"⚠️ Максимальный размер {config.MAX_IMAGE_SIZE_MB}MB")
             return
         
-        user_last_images[user_id] = {
-            "bytes": image_bytes,
-            "mime_type": "image/jpeg"
-        }
+        for image_ref in image_refs:
+            image_cache.acquire(image_ref["file_unique_id"])
+        for image_ref in await user_state.set_images(user_id, image_refs):
+            image_cache.release(image_ref["file_unique_id"])
         
-        model_info = ai_service.get_model_info()
+        model_info = ai_service.get_model_info(choice)
+        
+        if len(image_refs) == 1:
+            saved = f"🖼️ <b>Фото сохранено</b> ({total_size//1024}KB)"
+        else:
+            saved = f"🖼️ <b>Сохранено фото: {len(image_refs)}</b> ({total_size//1024}KB)"
+        if skipped:
+            saved += (
+                f"\n⚠️ Не вошло фото: {skipped} (не больше {config.MAX_IMAGES_PER_REQUEST} шт. "
+                f"и {config.MAX_IMAGES_TOTAL_MB}MB на запрос)"
+            )
         
         if model_info["supports_images"]:
+            # Загружаем и кодируем сразу и параллельно, чтобы следующий запрос не ждал
+            results = await asyncio.gather(
+                *(ai_service.get_image_part(image_ref, model_key) for image_ref in image_refs),
+                return_exceptions=True
+            )
+            errors = [result for result in results if isinstance(result, Exception)]
+            if len(errors) == len(results):
+                raise errors[0]
+            for error in errors:
+                logger.error("Ошибка загрузки фото: %s", error, extra={"user_id": user_id})
+            
             await message.answer(
-                f"🖼️ <b>Фото сохранено</b> ({len(image_bytes)//1024}KB)\n\n"
+                f"{saved}\n\n"
                 f"Теперь напишите запрос к фото\n\n"
                 f"<i>Модель:</i> {model_info['name']}",
                 reply_markup=get_main_keyboard()
             )
         else:
             await message.answer(
-                f"🖼️ <b>Фото сохранено</b>\n\n"
+                f"{saved}\n\n"
                 f"⚠️ Текущая модель не поддерживает фото\n"
                 f"Используйте /model для смены",
                 reply_markup=get_main_keyboard()
             )
         
     except Exception as e:
-        logger.error(f"Ошибка фото: {e}")
+        logger.error("Ошибка фото: %s", e, exc_info=True, extra={"user_id": user_id})
         await message.answer("⚠️ Ошибка обработки фото")
 
+class AlbumCollector:
+    """Сборка альбома (media_group_id) в один набор фото.
+    
+    Telegram присылает каждое фото альбома отдельным сообщением. Части
+    копятся, пока следующая приходит не позже чем через ALBUM_WAIT
+    секунд, после чего весь альбом передается обработчику одним вызовом.
+    """
+    
+    def __init__(self, handler):
+        self.handler = handler
+        self.pending: Dict[Tuple[int, str], List[Message]] = {}
+        self.arrived: Dict[Tuple[int, str], float] = {}
+        self.workers: Dict[Tuple[int, str], asyncio.Task] = {}
+    
+    async def submit(self, message: Message) -> None:
+        """Добавление части альбома; завершается после обработки альбома"""
+        key = (message.from_user.id, message.media_group_id)
+        self.pending.setdefault(key, []).append(message)
+        self.arrived[key] = time.monotonic()
+        
+        if key not in self.workers:
+            self.workers[key] = asyncio.create_task(self._run(key))
+        
+        await asyncio.shield(self.workers[key])
+    
+    async def wait(self, user_id: int) -> None:
+        """Ожидание альбомов пользователя, которые еще собираются"""
+        tasks = [task for (owner, _), task in self.workers.items() if owner == user_id]
+        if tasks:
+            await asyncio.wait(tasks)
+    
+    async def _run(self, key: Tuple[int, str]) -> None:
+        try:
+            while True:
+                delay = self.arrived[key] + config.ALBUM_WAIT - time.monotonic()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            
+            # Части обрабатываются параллельно и могут прийти не по порядку
+            messages = sorted(self.pending.pop(key), key=lambda m: m.message_id)
+            try:
+                await self.handler(messages)
+            except Exception as e:
+                logger.error("Ошибка обработки альбома: %s", e, exc_info=True, extra={"user_id": key[0]})
+        finally:
+            self.pending.pop(key, None)
+            self.arrived.pop(key, None)
+            self.workers.pop(key, None)
+
+album_collector = AlbumCollector(save_photos)
+
+# Обработчик фотографий
+@router.message(F.photo)
+async def handle_photo(message: Message):
+    """Обработка фотографий"""
+    if message.media_group_id:
+        await album_collector.submit(message)
+    else:
+        await save_photos([message])
+
 # Обработчик текстовых сообщений
 @router.message(F.text)
 async def handle_message(message: Message):
-    """Обработка текстовых сообщений"""
+    """Обработка текстовых сообщений с замером по веткам"""
+    branch = "error"
+    metrics.handlers_in_flight.inc()
+    started = time.perf_counter()
+    try:
+        branch = await handle_text(message)
+    finally:
+        metrics.handlers_in_flight.dec()
+        metrics.handler_seconds.observe(time.perf_counter() - started, branch)
+
+async def handle_text(message: Message) -> str:
+    """Обработка текста, возвращает название сработавшей ветки"""
     
     user_id = message.from_user.id
     user_message = message.text.strip()
@@ -471,36 +4669,59 @@ async def handle_message(message: Message):
     # Обработка кнопок
     if user_message == "💬 Задать вопрос":
         await message.answer("✍️ Напишите ваш вопрос")
-        return
+        return "ask"
     
     elif user_message == "📸 Отправить фото":
         await message.answer("📸 Отправьте изображение")
-        return
+        return "photo_hint"
     
     elif user_message == "🗑️ Очистить чат":
         await ai_service.clear_history(user_id)
         await message.answer("✅ Чат очищен", reply_markup=get_main_keyboard())
-        return
+        return "clear"
     
     elif user_message == "🔄 Сменить модель":
         await cmd_model(message)
-        return
+        return "model_menu"
     
     # Кнопки админки
     if user_id == config.ADMIN_ID:
         if user_message == "📊 Статистика":
-            total_users = stats.get_users_count()
-            users_today = stats.get_users_count(1)
-            users_week = stats.get_users_count(7)
+            view = await admin_stats()
+            total_users = view.get_users_count()
+            users_today = view.get_users_count(1)
+            users_week = view.get_users_count(7)
             
-            total_requests = stats.get_requests_count()
-            requests_today = stats.get_requests_count(1)
-            requests_week = stats.get_requests_count(7)
+            total_requests = view.get_requests_count()
+            requests_today = view.get_requests_count(1)
+            requests_week = view.get_requests_count(7)
             
-            total_images = stats.get_images_count()
-            images_today = stats.get_images_count(1)
+            total_images = view.get_images_count()
+            images_today = view.get_images_count(1)
             
-            active_today = stats.get_active_users_today()
+            active_today = view.get_active_users_today()
+            
+            conv_stats = conversation_store.get_stats()
+            image_stats = image_cache.get_stats()
+            sched_stats = scheduler.get_stats()
+            cache_stats = response_cache.get_stats()
+            send_stats = telegram_sender.get_stats()
+            breaker_icons = {"closed": "✅", "open": "⛔", "half-open": "⚠️"}
+            breakers_text = "".join(
+                f"• {config.MODELS[key]['name']}: {breaker_icons[breaker.state]} "
+                f"{breaker.state} (ошибок: {breaker.failures})\n"
+                for key, breaker in ai_service.breakers.items()
+            )
+            router_text = "".join(
+                f"• {config.MODELS[key]['name']}: "
+                + (f"{item['latency']:.1f}с" if item["latency"] is not None else "нет замеров")
+                + (f", p95 {item['p95']:.1f}с" if item["p95"] is not None else "")
+                + f", ошибок {item['error_rate']:.0f}%, запросов {item['routed']}\n"
+                for key, item in model_router.get_stats().items()
+            )
+            active_models = ", ".join(
+                f"{config.MODELS[key]['name']}: {n}" for key, n in sched_stats["active"].items()
+            ) or "нет"
             
             stat_text = (
                 "📊 <b>Статистика бота</b>\n\n"
@@ -520,84 +4741,119 @@ async def handle_message(message: Message):
                 f"• За сегодня: {images_today}\n\n"
                 
                 f"<b>💾 История чатов:</b>\n"
-                f"• Активных чатов: {len(user_conversations)}\n"
+                f"• Активных чатов: {conv_stats['active']} ({conv_stats['memory_kb']}KB)\n"
+                f"• Попаданий/промахов: {conv_stats['hits']}/{conv_stats['misses']}\n"
+                f"• Поднято с диска: {conv_stats['rehydrated']}, вытеснено: {conv_stats['evictions']}\n"
                 f"• Макс. история: {config.MAX_HISTORY_LENGTH} сообщений\n\n"
                 
+                f"<b>🗂️ Кэш изображений:</b>\n"
+                f"• Записей: {image_stats['entries']} ({image_stats['size_kb']}KB)\n"
+                f"• Попаданий/промахов: {image_stats['hits']}/{image_stats['misses']}\n\n"
+                
+                f"<b>⚡ Кэш ответов:</b>\n"
+                f"• Записей: {cache_stats['entries']} ({cache_stats['size_kb']}KB)\n"
+                f"• Попаданий: {cache_stats['hits']}, общих запросов: {cache_stats['shared']}, "
+                f"промахов: {cache_stats['misses']}\n"
+                f"• Доля попаданий: {cache_stats['hit_rate']:.1f}%\n\n"
+                
+                f"<b>⚙️ Нагрузка:</b>\n"
+                f"• В очереди: {sched_stats['queued']}\n"
+                f"• Выполняется: {active_models}\n"
+                f"• Ожидание: ср. {sched_stats['avg_wait']:.1f}с, макс. {sched_stats['max_wait']:.1f}с\n"
+                f"• Отклонено: {sched_stats['rejected']}, лимит частоты: {sched_stats['rate_limited']}\n"
+                f"• Исходящие: в очереди {send_stats['queued']}, отправлено {send_stats['sent']}, "
+                f"RetryAfter {send_stats['retried']}, p95 ожидания {send_stats['p95_wait']:.1f}с\n\n"
+                
+                f"<b>🛡️ Состояние моделей:</b>\n"
+                f"{breakers_text}\n"
+                
                 f"<b>🤖 Модели:</b>\n"
                 f"• Доступно: {len(config.MODELS)}\n"
-                f"• Текущая: {ai_service.get_model_info()['name']}"
+                f"• По умолчанию: {ai_service.get_model_info(config.DEFAULT_MODEL)['name']}\n"
+                f"{router_text}"
+                f"• Дублировано запросов: {model_router.hedged}, "
+                f"быстрее основной модели: {model_router.hedge_wins}"
+                f"{worker_stats_note()}"
             )
             
             await message.answer(stat_text)
-            return
+            return "admin_stats"
         
         elif user_message == "💰 Баланс API":
-            await message.answer("⏳ Проверяю баланс OpenRouter...")
+            view = await admin_stats()
+            if ai_service.balance is None:
+                await message.answer("⏳ Проверяю баланс OpenRouter...")
             
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                        "https://openrouter.ai/api/v1/auth/key",
-                        headers={"Authorization": f"Bearer {config.OPENROUTER_API_KEY}"},
-                        timeout=10
-                    ) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            balance = data.get("data", {}).get("credits", 0)
-                            usage = data.get("data", {}).get("usage", {})
-                            total_used = usage.get("total", 0)
-                            
-                            balance_text = (
-                                "💰 <b>Баланс OpenRouter</b>\n\n"
-                                f"• <b>Доступно:</b> {balance:.4f} кредитов\n"
-                                f"• <b>Использовано:</b> {total_used:.4f} кредитов\n\n"
-                                
-                                "<b>💸 Примерные цены:</b>\n"
-                                "• Gemini 3 Flash: ~0.001-0.01 кредита/запрос\n"
-                                "• GPT-4o Mini: ~0.002 кредита/запрос\n"
-                                "• Claude 4.5: ~0.015 кредита/запрос\n\n"
-                                
-                                "<b>📊 Прогноз:</b>\n"
-                            )
-                            
-                            if balance > 0:
-                                avg_cost = 0.003
-                                estimated_requests = int(balance / avg_cost)
-                                balance_text += f"• Примерно {estimated_requests} запросов осталось\n"
-                            
-                            balance_text += "\n🔗 Пополнить: https://openrouter.ai/account"
-                            
-                            await message.answer(balance_text)
-                        else:
-                            await message.answer("⚠️ Не удалось получить баланс")
+                data = await ai_service.get_balance()
+                if data is not None:
+                    balance = data.get("credits", 0)
+                    usage = data.get("usage", {})
+                    total_used = usage.get("total", 0) if isinstance(usage, dict) else usage
+                    
+                    balance_text = (
+                        "💰 <b>Баланс OpenRouter</b>\n\n"
+                        f"• <b>Доступно:</b> {balance:.4f} кредитов\n"
+                        f"• <b>Использовано:</b> {total_used:.4f} кредитов\n\n"
+                        
+                        "<b>💸 Средняя цена запроса:</b>\n"
+                    )
+                    
+                    usage_by_model = view.get_usage_by_model()
+                    for model_key, item in usage_by_model.items():
+                        name = config.MODELS[model_key]["name"] if model_key in config.MODELS else model_key
+                        balance_text += (
+                            f"• {name}: {item['cost_per_request']:.5f} кредита/запрос "
+                            f"({item['requests']} запросов)\n"
+                        )
+                    if not usage_by_model:
+                        balance_text += "• Пока нет данных\n"
+                    
+                    balance_text += "\n<b>📊 Прогноз:</b>\n"
+                    avg_cost = view.get_usage_total(7)["cost_per_request"] or view.get_usage_total()["cost_per_request"]
+                    if balance > 0 and avg_cost > 0:
+                        estimated_requests = int(balance / avg_cost)
+                        balance_text += f"• Примерно {estimated_requests} запросов осталось\n"
+                    else:
+                        balance_text += "• Недостаточно данных о расходе\n"
+                    
+                    age = int((time.time() - ai_service.balance_updated) // 60)
+                    balance_text += f"\n<i>Обновлено {age} мин назад</i>"
+                    balance_text += "\n🔗 Пополнить: https://openrouter.ai/account"
+                    
+                    await message.answer(balance_text)
+                else:
+                    await message.answer("⚠️ Не удалось получить баланс")
             except Exception as e:
-                logger.error(f"Ошибка проверки баланса: {e}")
+                logger.error("Ошибка проверки баланса: %s", e)
                 await message.answer("⚠️ Ошибка при проверке баланса")
-            return
+            return "admin_balance"
         
         elif user_message == "👥 Топ пользователей":
-            top_users = stats.get_top_users(15)
+            view = await admin_stats()
+            top_users = view.get_top_users(15)
             
             if not top_users:
                 await message.answer("📭 Нет данных о пользователях")
-                return
+                return "admin_top"
             
             users_text = "👥 <b>Топ пользователей по запросам</b>\n\n"
             
             for i, (user_id, count) in enumerate(top_users, 1):
                 users_text += f"{i}. ID: {user_id} - {count} запросов\n"
             
-            users_text += f"\n📈 Всего уникальных пользователей: {stats.get_users_count()}"
+            users_text += f"\n📈 Всего уникальных пользователей: {view.get_users_count()}"
             
             await message.answer(users_text)
-            return
+            return "admin_top"
         
         elif user_message == "📈 Активность":
-            daily_stats = stats.get_daily_stats()
+            view = await admin_stats()
+            daily_stats = view.get_daily_stats()
             
             if not daily_stats:
                 await message.answer("📭 Нет данных для графика")
-                return
+                return "admin_activity"
             
             dates = sorted(daily_stats.keys())
             graph_text = "📈 <b>Активность по дням</b>\n\n"
@@ -608,79 +4864,189 @@ async def handle_message(message: Message):
                 graph_text += f"{date}: {bar} {count}\n"
             
             await message.answer(graph_text)
-            return
+            return "admin_activity"
+        
+        elif user_message == "💸 Расходы":
+            await message.answer(format_usage_report(await admin_stats()))
+            return "admin_usage"
+        
+        elif user_message == "📉 Метрики":
+            await message.answer(format_metrics_report())
+            return "admin_metrics"
         
         elif user_message == "🔙 Главное меню":
             await message.answer("Главное меню", reply_markup=get_main_keyboard())
-            return
+            return "admin_menu"
     
     # Выбор модели
     models = ai_service.get_all_models()
     for model_id, model_info in models.items():
         emoji = "🖼️" if model_info["supports_images"] else "📝"
         if user_message == f"{emoji} {model_info['name']}":
-            if ai_service.set_model(model_id):
+            if await ai_service.set_model(user_id, model_id):
                 await message.answer(
                     f"✅ Модель: <b>{model_info['name']}</b>\n"
                     f"{model_info['description']}",
                     reply_markup=get_main_keyboard()
                 )
-            return
+            return "model_select"
+    
+    if user_message == "🤖 Авто":
+        await ai_service.set_model(user_id, config.AUTO_MODEL)
+        await message.answer(
+            "✅ Модель: <b>Авто</b>\n"
+            "Каждый запрос уйдет в самую быструю доступную модель",
+            reply_markup=get_main_keyboard()
+        )
+        return "model_select"
     
     if user_message == "🔙 Назад":
         await message.answer("Главное меню", reply_markup=get_main_keyboard())
-        return
+        return "back"
     
     # Проверки
     if not user_message:
         await message.answer("✍️ Напишите сообщение")
-        return
+        return "invalid"
     
     if len(user_message) > config.MAX_MESSAGE_LENGTH:
         await message.answer(f"⚠️ Максимум {config.MAX_MESSAGE_LENGTH} символов")
+        return "invalid"
+    
+    await user_mailbox.submit(message, user_message)
+    return "ai"
+
+async def process_turn(message: Message, user_message: str):
+    """Один запрос к нейросети (вызывается из очереди пользователя)"""
+    user_id = message.from_user.id
+    
+    try:
+        scheduler.admit(user_id)
+    except AIServiceError as e:
+        await message.answer(str(e))
         return
     
     # Добавляем статистику запроса
     stats.add_request(user_id)
     
-    # Подготовка изображений
+    # Выбор модели и подготовка изображений (альбом мог еще собираться)
+    await album_collector.wait(user_id)
     images = []
-    if user_id in user_last_images:
-        model_info = ai_service.get_model_info()
+    image_refs = await user_state.get_images(user_id)
+    choice = await user_state.get_model(user_id)
+    auto = choice == config.AUTO_MODEL
+    model_key = ai_service.pick_model(choice, need_images=bool(image_refs))
+    if image_refs:
+        model_info = ai_service.get_model_info(model_key)
         if model_info["supports_images"]:
-            try:
-                image_data = user_last_images[user_id]
-                processed_image = await ai_service.process_image(
-                    image_data["bytes"], 
-                    image_data["mime_type"]
-                )
-                images.append(processed_image)
-            except Exception as e:
-                logger.error(f"Ошибка обработки фото: {e}")
+            results = await asyncio.gather(
+                *(ai_service.get_image_part(image_ref, model_key) for image_ref in image_refs),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error("Ошибка обработки фото: %s", result, extra={"user_id": user_id})
+                else:
+                    images.append(result)
     
     # Отправка статуса
     status_msg = await message.answer("⏳ Нейросеть генерирует ответ...")
-    processing_messages[user_id] = status_msg.message_id
+    await user_state.set_processing(user_id, status_msg.message_id)
+    
+    async def on_queued(position: int) -> None:
+        with progress_sends():
+            await status_msg.edit_text(f"⏳ Вы в очереди: {position}", parse_mode=None)
+    
+    if config.STREAM_RESPONSES:
+        reply = StreamingReply(message, status_msg)
+        try:
+            async for delta in ai_service.stream_response(
+                user_id, model_key, user_message, images, on_queued, auto=auto
+            ):
+                await reply.feed(delta)
+            await reply.finish()
+        except AIServiceError as e:
+            await reply.fail(str(e))
+        finally:
+            await user_state.pop_processing(user_id)
+        return
     
     # Получение ответа
-    response = await ai_service.generate_response(user_id, user_message, images)
+    response = await ai_service.generate_response(
+        user_id, model_key, user_message, images, on_queued, auto=auto
+    )
     
     # Удаление статуса
-    if user_id in processing_messages:
+    status_id = await user_state.pop_processing(user_id)
+    if status_id is not None:
         try:
-            await bot.delete_message(user_id, processing_messages[user_id])
-            del processing_messages[user_id]
+            with progress_sends():
+                await bot.delete_message(user_id, status_id)
         except:
             pass
     
     # Отправка ответа
     if len(response) > config.MAX_MESSAGE_LENGTH:
-        parts = [response[i:i+config.MAX_MESSAGE_LENGTH] for i in range(0, len(response), config.MAX_MESSAGE_LENGTH)]
+        # Запас под подпись "[Часть i/n]"
+        parts = split_message(response, config.MAX_MESSAGE_LENGTH - 20)
         for i, part in enumerate(parts, 1):
             await message.answer(f"{part}\n\n[Часть {i}/{len(parts)}]")
     else:
         await message.answer(response)
 
+class UserMailbox:
+    """Очередь сообщений пользователя.
+    
+    Запросы одного пользователя выполняются строго по очереди, а
+    сообщения, пришедшие в пределах MESSAGE_DEBOUNCE секунд (или пока
+    обрабатывается предыдущий запрос), объединяются в один запрос.
+    Разные пользователи обрабатываются параллельно.
+    """
+    
+    def __init__(self, handler):
+        self.handler = handler
+        self.pending: Dict[int, List[Tuple[Message, str, asyncio.Future]]] = {}
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.coalesced = 0
+    
+    async def submit(self, message: Message, text: str) -> None:
+        """Постановка сообщения в очередь; завершается после ответа на него"""
+        user_id = message.from_user.id
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(user_id, []).append((message, text, future))
+        
+        if user_id not in self.workers:
+            self.workers[user_id] = asyncio.create_task(self._run(user_id))
+        
+        await future
+    
+    async def _run(self, user_id: int) -> None:
+        try:
+            while self.pending.get(user_id):
+                if config.MESSAGE_DEBOUNCE > 0:
+                    await asyncio.sleep(config.MESSAGE_DEBOUNCE)
+                
+                batch = self.pending.pop(user_id)
+                self.coalesced += len(batch) - 1
+                message = batch[-1][0]
+                text = "\n\n".join(text for _, text, _ in batch)
+                
+                try:
+                    await self.handler(message, text)
+                except Exception as e:
+                    logger.error("Ошибка обработки запроса: %s", e, exc_info=True, extra={"user_id": user_id})
+                finally:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            self.workers.pop(user_id, None)
+    
+    def __len__(self) -> int:
+        return len(self.workers)
+
+user_mailbox = UserMailbox(process_turn)
+
 # Обработчик любых других типов сообщений
 @router.message()
 async def handle_other_messages(message: Message):
@@ -690,26 +5056,529 @@ async def handle_other_messages(message: Message):
         "📸 Отправьте фото или напишите текстовый вопрос."
     )
 
+# Запуск и остановка
+background_tasks: List[asyncio.Task] = []
+metrics_runner: Optional[web.AppRunner] = None
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Метрики в текстовом формате Prometheus"""
+    return web.Response(
+        body=metrics.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+async def start_metrics_server() -> None:
+    """Отдельный локальный порт для /metrics (в обоих режимах)"""
+    global metrics_runner
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, config.METRICS_HOST, config.METRICS_PORT).start()
+    except OSError as e:
+        # Занятый порт (вторая реплика на хосте) не должен мешать работе бота
+        logger.error(
+            "Метрики недоступны, порт %s:%s: %s", config.METRICS_HOST, config.METRICS_PORT, e
+        )
+        await runner.cleanup()
+        return
+    metrics_runner = runner
+    logger.info("Метрики: http://%s:%s/metrics", config.METRICS_HOST, config.METRICS_PORT)
+
+async def on_startup(bot: Bot):
+    """Инициализация ресурсов (вызывается диспетчером в обоих режимах)"""
+    await ai_service.start()
+    image_processor.start()
+    state_snapshot.open()
+    stats.store = create_stats_store()
+    await stats.load()
+    background_tasks.append(asyncio.create_task(stats.run_flusher()))
+    background_tasks.append(asyncio.create_task(conversation_store.run_maintenance()))
+    background_tasks.append(asyncio.create_task(ai_service.run_balance_refresher()))
+    if config.METRICS_ENABLED:
+        await start_metrics_server()
+    
+    if config.RUN_MODE == "webhook" and config.WEBHOOK_URL:
+        await bot.set_webhook(
+            config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info("Webhook установлен: %s", config.WEBHOOK_URL)
+
+async def on_shutdown(bot: Bot):
+    """Освобождение ресурсов"""
+    global metrics_runner
+    # Прием уже остановлен: дожидаемся начатых ответов и досылаем их
+    if in_flight:
+        logger.info("Ожидание обработки обновлений: %s", len(in_flight))
+        abandoned = await in_flight.drain(config.SHUTDOWN_DRAIN_TIMEOUT)
+        if abandoned:
+            logger.warning("Не дождались обработки обновлений: %s", abandoned)
+    await telegram_sender.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    try:
+        await state_snapshot.save()
+    except Exception as e:
+        logger.error("Ошибка сохранения снимка состояния: %s", e)
+    state_snapshot.close()
+    await stats.close()
+    await ai_service.close()
+    image_processor.close()
+    await state_backend.close()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+async def handle_health(request: web.Request) -> web.Response:
+    """Проверка работоспособности для балансировщика"""
+    return web.json_response({
+        "status": "ok",
+        "mode": config.RUN_MODE,
+        "active_chats": len(conversation_store),
+        "queued": scheduler.queue_depth(),
+    })
+
+def create_web_app() -> web.Application:
+    """aiohttp-приложение для режима webhook"""
+    app = web.Application()
+    app.router.add_get("/health", handle_health)
+    
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=config.WEBHOOK_SECRET or None
+    ).register(app, path=config.WEBHOOK_PATH)
+    
+    # Связывает startup/shutdown диспетчера с жизненным циклом приложения
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook():
+    """Прием обновлений через webhook"""
+    # SIGTERM (остановка сервиса) завершает так же мягко, как Ctrl+C
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    runner = web.AppRunner(create_web_app())
+    await runner.setup()
+    site = web.TCPSite(runner, config.WEBAPP_HOST, config.WEBAPP_PORT)
+    await site.start()
+    logger.info(
+        "Webhook сервер слушает %s:%s%s", config.WEBAPP_HOST, config.WEBAPP_PORT, config.WEBHOOK_PATH
+    )
+    
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def run_polling():
+    """Прием обновлений через long polling (для разработки)"""
+    await bot.delete_webhook()
+    await dp.start_polling(bot)
+
+# Несколько процессов
+def update_user_id(update: Dict[str, Any]) -> int:
+    """Пользователь, от которого пришло обновление (для выбора воркера)"""
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user") or value.get("chat")
+            if user:
+                return user["id"]
+    return update.get("update_id", 0)
+
+
+class HashRing:
+    """Консистентное хеширование пользователей по воркерам.
+    
+    У каждого воркера WORKER_VNODES точек на кольце, пользователь
+    достается ближайшей точке по часовой стрелке. При изменении числа
+    воркеров переезжает только доля пользователей, а не почти все.
+    """
+    
+    def __init__(self, nodes: int, vnodes: int):
+        points = sorted(
+            (self._hash(f"worker-{node}:{vnode}"), node)
+            for node in range(nodes)
+            for vnode in range(vnodes)
+        )
+        self.keys = [key for key, _ in points]
+        self.nodes = [node for _, node in points]
+    
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+    
+    def node(self, key: Any) -> int:
+        index = bisect.bisect(self.keys, self._hash(str(key)))
+        return self.nodes[index % len(self.nodes)]
+
+
+class WorkerPool:
+    """Супервизор процессов-воркеров.
+    
+    Воркеры получаются через fork и наследуют настройки супервизора.
+    Каждый слушает свой unix-сокет, обновления пересылаются ему пачками
+    по порядку поступления, поэтому все обновления пользователя
+    обрабатываются одним процессом с его историей и фото в памяти.
+    Упавший воркер перезапускается с растущей паузой, обновления для
+    него ждут в очереди.
+    """
+    
+    def __init__(self, count: int):
+        self.count = count
+        self.ring = HashRing(count, config.WORKER_VNODES)
+        self.context = multiprocessing.get_context("fork")
+        self.sockets = [
+            os.path.join(tempfile.gettempdir(), f"bot-{os.getpid()}-worker{index}.sock")
+            for index in range(count)
+        ]
+        self.processes: List[Optional[multiprocessing.process.BaseProcess]] = [None] * count
+        self.queues: List[asyncio.Queue] = []
+        self.tasks: List[asyncio.Task] = []
+        self.session: Optional[aiohttp.ClientSession] = None
+        
+        self.dispatched = 0
+        self.restarts = 0
+    
+    async def start(self) -> None:
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=config.HTTP_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT)
+        )
+        for index in range(self.count):
+            self.queues.append(asyncio.Queue(maxsize=config.WORKER_QUEUE_SIZE))
+            self.tasks.append(asyncio.create_task(self._supervise(index)))
+            self.tasks.append(asyncio.create_task(self._forward(index)))
+        logger.info("Запущено воркеров: %s", self.count)
+    
+    async def dispatch(self, update: Dict[str, Any], raw: Optional[bytes] = None) -> None:
+        """Постановка обновления в очередь воркера пользователя"""
+        if raw is None:
+            raw = json.dumps(update, ensure_ascii=False).encode("utf-8")
+        self.dispatched += 1
+        await self.queues[self.ring.node(update_user_id(update))].put(raw)
+    
+    def _spawn(self, index: int) -> multiprocessing.process.BaseProcess:
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, self.sockets[index]),
+            name=f"bot-worker-{index}"
+        )
+        process.start()
+        self.processes[index] = process
+        return process
+    
+    @staticmethod
+    async def _wait_exit(process: multiprocessing.process.BaseProcess) -> None:
+        loop = asyncio.get_running_loop()
+        exited = loop.create_future()
+        loop.add_reader(process.sentinel, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(process.sentinel)
+        process.join()
+    
+    async def _supervise(self, index: int) -> None:
+        delay = config.WORKER_RESTART_DELAY
+        while True:
+            process = self._spawn(index)
+            started = time.monotonic()
+            await self._wait_exit(process)
+            
+            # Долго проработавший воркер перезапускается без накопленной паузы
+            if time.monotonic() - started > config.WORKER_RESTART_MAX_DELAY * 2:
+                delay = config.WORKER_RESTART_DELAY
+            self.restarts += 1
+            logger.error(
+                "Воркер %s завершился (код %s), перезапуск через %.0f с", index, process.exitcode, delay
+            )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, config.WORKER_RESTART_MAX_DELAY)
+    
+    async def _forward(self, index: int) -> None:
+        queue = self.queues[index]
+        connector = aiohttp.UnixConnector(path=self.sockets[index])
+        async with aiohttp.ClientSession(connector=connector) as session:
+            while True:
+                batch = [await queue.get()]
+                while len(batch) < config.WORKER_BATCH and not queue.empty():
+                    batch.append(queue.get_nowait())
+                body = b"[" + b",".join(batch) + b"]"
+                
+                # Пока воркер запускается или перезапускается, пачка ждет
+                delay = 0.05
+                while True:
+                    try:
+                        async with session.post(
+                            "http://worker/updates",
+                            data=body,
+                            headers={"Content-Type": "application/json"}
+                        ) as response:
+                            if response.status == 200:
+                                break
+                            logger.error(
+                                "Воркер %s ответил %s", index, response.status,
+                                extra={"status": response.status}
+                            )
+                    except (aiohttp.ClientError, OSError):
+                        pass
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 1.0)
+                
+                for _ in batch:
+                    queue.task_done()
+    
+    async def close(self) -> None:
+        """Дослать очереди, остановить воркеры и дождаться их завершения"""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self.queues)),
+                timeout=config.WORKER_STOP_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Не все обновления переданы воркерам до остановки")
+        
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+        
+        alive = [process for process in self.processes if process is not None and process.is_alive()]
+        for process in alive:
+            process.terminate()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(self._wait_exit(process) for process in alive)),
+                timeout=config.WORKER_STOP_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            for process in alive:
+                if process.is_alive():
+                    logger.warning("Воркер %s не остановился, завершаю принудительно", process.name)
+                    process.kill()
+                    process.join()
+        
+        for path in self.sockets:
+            if os.path.exists(path):
+                os.unlink(path)
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+    
+    async def call(self, method: str, request_timeout: Optional[float] = None, **params) -> Any:
+        """Вызов Bot API без aiogram: сессия бота остается воркерам"""
+        url = bot.session.api.api_url(token=bot.token, method=method)
+        async with self.session.post(
+            url,
+            json={key: value for key, value in params.items() if value is not None},
+            timeout=aiohttp.ClientTimeout(total=request_timeout or config.HTTP_TIMEOUT)
+        ) as response:
+            data = await response.json()
+        if not data.get("ok"):
+            raise RuntimeError(f"{method}: {data.get('description')}")
+        return data["result"]
+    
+    async def poll(self) -> None:
+        """Long polling в супервизоре"""
+        await self.call("deleteWebhook")
+        allowed_updates = dp.resolve_used_update_types()
+        offset = 0
+        while True:
+            try:
+                updates = await self.call(
+                    "getUpdates",
+                    request_timeout=40,
+                    offset=offset,
+                    timeout=30,
+                    allowed_updates=allowed_updates
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+                logger.error("Ошибка getUpdates: %s", e)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update["update_id"] + 1
+                await self.dispatch(update)
+    
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        if config.WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != config.WEBHOOK_SECRET:
+            return web.Response(status=401)
+        raw = await request.read()
+        await self.dispatch(json.loads(raw), raw)
+        return web.Response()
+    
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response(self.get_stats())
+    
+    async def serve_webhook(self) -> None:
+        """Прием webhook в супервизоре"""
+        app = web.Application()
+        app.router.add_get("/health", self.handle_health)
+        app.router.add_post(config.WEBHOOK_PATH, self.handle_webhook)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, config.WEBAPP_HOST, config.WEBAPP_PORT).start()
+        logger.info(
+            "Webhook сервер слушает %s:%s%s", config.WEBAPP_HOST, config.WEBAPP_PORT, config.WEBHOOK_PATH
+        )
+        
+        if config.WEBHOOK_URL:
+            await self.call(
+                "setWebhook",
+                url=config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+                secret_token=config.WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            logger.info("Webhook установлен: %s", config.WEBHOOK_URL)
+        
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "status": "ok",
+            "mode": config.RUN_MODE,
+            "workers": [
+                {
+                    "pid": process.pid if process is not None else None,
+                    "alive": process is not None and process.is_alive(),
+                    "queued": queue.qsize(),
+                }
+                for process, queue in zip(self.processes, self.queues)
+            ],
+            "dispatched": self.dispatched,
+            "restarts": self.restarts,
+        }
+
+def configure_worker(index: int) -> None:
+    """Настройки воркера: доля общих лимитов бота и свои файлы"""
+    workers = config.WORKERS
+    config.RUN_MODE = "worker"
+    config.SEND_GLOBAL_RATE = config.SEND_GLOBAL_RATE / workers
+    config.SCHED_MODEL_CONCURRENCY = max(1, config.SCHED_MODEL_CONCURRENCY // workers)
+    for model_info in config.MODELS.values():
+        if "max_concurrency" in model_info:
+            model_info["max_concurrency"] = max(1, model_info["max_concurrency"] // workers)
+    config.METRICS_PORT += index
+    if config.SNAPSHOT_PATH:
+        config.SNAPSHOT_PATH += f".{index}"
+    # stats.store создается в on_startup уже в этом процессе: соединение
+    # SQLite супервизора через fork не переносится, база у воркеров общая
+    assert stats.store is None
+
+worker_tasks: set = set()
+
+async def feed_worker_update(update: Dict[str, Any]) -> None:
+    try:
+        await dp.feed_raw_update(bot, update)
+    except Exception as e:
+        logger.error("Ошибка обработки обновления: %s", e)
+
+async def handle_worker_updates(request: web.Request) -> web.Response:
+    """Пачка обновлений от супервизора; обработка идет в фоне"""
+    for update in await request.json():
+        task = asyncio.create_task(feed_worker_update(update))
+        worker_tasks.add(task)
+        task.add_done_callback(worker_tasks.discard)
+    return web.Response()
+
+async def run_worker(index: int, socket_path: str) -> None:
+    """Воркер: обновления от супервизора через unix-сокет"""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    supervisor_pid = os.getppid()
+    
+    await dp.emit_startup(bot=bot)
+    app = web.Application()
+    app.router.add_post("/updates", handle_worker_updates)
+    app.router.add_get("/health", handle_health)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    await web.UnixSite(runner, socket_path).start()
+    logger.info("Воркер %s запущен (pid %s)", index, os.getpid())
+    
+    try:
+        # Без супервизора воркер никому не нужен
+        while not stop.is_set() and os.getppid() == supervisor_pid:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # Начатые обновления дожидается on_shutdown
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+def worker_main(index: int, socket_path: str) -> None:
+    """Точка входа процесса-воркера"""
+    configure_worker(index)
+    log_pipeline.start()
+    try:
+        asyncio.run(run_worker(index, socket_path))
+    finally:
+        log_pipeline.stop()
+
+async def run_supervisor():
+    """Прием обновлений и раздача их воркерам"""
+    pool = WorkerPool(config.WORKERS)
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    await pool.start()
+    try:
+        if config.RUN_MODE == "webhook":
+            await pool.serve_webhook()
+        else:
+            await pool.poll()
+    finally:
+        await pool.close()
+
 # Основная функция
 async def main():
     """Запуск бота"""
     logger.info("Запуск AI Assistant...")
+    if config.WORKERS > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        logger.warning("Воркеры требуют fork, запуск в одном процессе")
+        config.WORKERS = 1
     
     print("\n" + "="*50)
     print("🤖 AI Assistant запущен!")
     print(f"👑 Админ ID: {config.ADMIN_ID}")
-    print(f"🤖 Модель: {ai_service.get_model_info()['name']}")
+    print(f"🤖 Модель по умолчанию: {ai_service.get_model_info(config.DEFAULT_MODEL)['name']}")
+    print(f"📡 Режим: {config.RUN_MODE}")
+    if config.WORKERS > 1:
+        print(f"⚙️ Воркеров: {config.WORKERS}")
     print("="*50 + "\n")
     
     # Запуск бота
-    await dp.start_polling(bot)
+    if config.WORKERS > 1:
+        await run_supervisor()
+    elif config.RUN_MODE == "webhook":
+        await run_webhook()
+    else:
+        await run_polling()
 
 if __name__ == "__main__":
+    log_pipeline.start()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Бот остановлен")
         print("\n👋 Бот остановлен")
     except Exception as e:
-        logger.error(f"Критическая ошибка: {e}")
-        print(f"❌ Ошибка: {e}")
\ No newline at end of file
+        logger.error("Критическая ошибка: %s", e, exc_info=True)
+        print(f"❌ Ошибка: {e}")
+    finally:
+        log_pipeline.stop()
\ No newline at end of file
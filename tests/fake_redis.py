@@ -0,0 +1,145 @@
+"""Заглушка сервера Redis (RESP2) с командами, которые использует бот"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class FakeRedis:
+    """Строки с TTL и хэши в памяти; считает чтения из сокета и команды.
+    
+    Базы (SELECT) общие, но у каждой команды записан номер базы
+    соединения, на котором она выполнена.
+    """
+    
+    def __init__(self, password: Optional[bytes] = None):
+        self.strings: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self.hashes: Dict[bytes, Dict[bytes, bytes]] = {}
+        self.commands: List[List[bytes]] = []
+        self.command_dbs: List[Tuple[int, bytes]] = []  # (база, команда)
+        self.password = password
+        self.reads = 0
+    
+    @staticmethod
+    def _bulk(value: Optional[bytes]) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    
+    def get_string(self, key: bytes) -> Optional[bytes]:
+        item = self.strings.get(key)
+        if item is None or (item[1] is not None and item[1] < time.monotonic()):
+            return None
+        return item[0]
+    
+    def run(self, args: List[bytes], session: Dict[str, Any]) -> bytes:
+        command, rest = args[0].upper(), args[1:]
+        self.commands.append(args)
+        if command == b"AUTH":
+            if rest[-1] != self.password:
+                return b"-WRONGPASS invalid password\r\n"
+            session["authed"] = True
+            return b"+OK\r\n"
+        if self.password is not None and not session["authed"]:
+            return b"-NOAUTH Authentication required.\r\n"
+        if command == b"SELECT":
+            session["db"] = int(rest[0])
+            return b"+OK\r\n"
+        self.command_dbs.append((session["db"], command))
+        if command == b"GET":
+            return self._bulk(self.get_string(rest[0]))
+        if command == b"SET":
+            expires = None
+            if len(rest) == 4 and rest[2].upper() == b"PX":
+                expires = time.monotonic() + int(rest[3]) / 1000
+            self.strings[rest[0]] = (rest[1], expires)
+            return b"+OK\r\n"
+        if command == b"DEL":
+            removed = 0
+            for key in rest:
+                removed += (self.strings.pop(key, None) is not None) + (self.hashes.pop(key, None) is not None)
+            return b":%d\r\n" % removed
+        if command == b"HSET":
+            self.hashes.setdefault(rest[0], {})[rest[1]] = rest[2]
+            return b":1\r\n"
+        if command == b"HSETNX":
+            fields = self.hashes.setdefault(rest[0], {})
+            if rest[1] in fields:
+                return b":0\r\n"
+            fields[rest[1]] = rest[2]
+            return b":1\r\n"
+        if command == b"HINCRBY":
+            fields = self.hashes.setdefault(rest[0], {})
+            value = int(fields.get(rest[1], b"0")) + int(rest[2])
+            fields[rest[1]] = str(value).encode()
+            return b":%d\r\n" % value
+        if command == b"HDEL":
+            fields = self.hashes.get(rest[0], {})
+            removed = sum(fields.pop(name, None) is not None for name in rest[1:])
+            return b":%d\r\n" % removed
+        if command == b"HGETALL":
+            fields = self.hashes.get(rest[0], {})
+            reply = [b"*%d\r\n" % (2 * len(fields))]
+            for name, value in fields.items():
+                reply += [self._bulk(name), self._bulk(value)]
+            return b"".join(reply)
+        return b"-ERR unknown command\r\n"
+    
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        buffer = b""
+        session = {"db": 0, "authed": False}
+        try:
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                self.reads += 1
+                buffer += chunk
+                replies = []
+                while True:
+                    parsed = self._parse(buffer)
+                    if parsed is None:
+                        break
+                    args, buffer = parsed
+                    replies.append(self.run(args, session))
+                writer.write(b"".join(replies))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    
+    @staticmethod
+    def _parse(buffer: bytes) -> Optional[Tuple[List[bytes], bytes]]:
+        """Одна команда из начала буфера или None, если она пришла не целиком"""
+        if not buffer.startswith(b"*"):
+            return None
+        end = buffer.find(b"\r\n")
+        if end < 0:
+            return None
+        count, pos, args = int(buffer[1:end]), end + 2, []
+        for _ in range(count):
+            end = buffer.find(b"\r\n", pos)
+            if end < 0:
+                return None
+            length = int(buffer[pos + 1:end])
+            start = end + 2
+            if len(buffer) < start + length + 2:
+                return None
+            args.append(buffer[start:start + length])
+            pos = start + length + 2
+        return args, buffer[pos:]
+
+
+@asynccontextmanager
+async def fake_redis_server(password: Optional[str] = None, db: int = 0) -> Any:
+    """Запущенная заглушка и URL для RedisBackend"""
+    fake = FakeRedis(password.encode() if password else None)
+    server = await asyncio.start_server(fake._handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    auth = f":{password}@" if password else ""
+    try:
+        yield fake, f"redis://{auth}127.0.0.1:{port}/{db}"
+    finally:
+        server.close()
+        await server.wait_closed()
@@ -0,0 +1,69 @@
+"""Заглушка OpenRouter: ответ выбирает функция теста по ключу модели"""
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict
+
+from aiohttp import web
+
+import bot
+
+Respond = Callable[[str, Dict[str, Any], web.Request], Awaitable[web.StreamResponse]]
+
+
+def completion(text: str) -> web.Response:
+    return web.json_response({"choices": [{"message": {"content": text}}]})
+
+
+async def stream(request: web.Request, text: str, first_event_delay: float = 0.0) -> web.StreamResponse:
+    """Поток SSE: комментарий сразу, первое событие через first_event_delay"""
+    response = web.StreamResponse()
+    response.content_type = "text/event-stream"
+    await response.prepare(request)
+    await response.write(b": OPENROUTER PROCESSING\n\n")
+    await asyncio.sleep(first_event_delay)
+    chunk = {"choices": [{"delta": {"content": text}}]}
+    try:
+        await response.write(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+        await response.write(b"data: [DONE]\n\n")
+    except ConnectionResetError:
+        pass  # проигравший дублированный запрос отменен клиентом
+    return response
+
+
+@asynccontextmanager
+async def openrouter_server(respond: Respond) -> Any:
+    """Запущенная заглушка; запросы по моделям считаются в server.requests"""
+    keys = {info["id"]: key for key, info in bot.config.MODELS.items()}
+    requests: Dict[str, int] = {}
+    
+    async def handle(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model_key = keys[body["model"]]
+        requests[model_key] = requests.get(model_key, 0) + 1
+        return await respond(model_key, body, request)
+    
+    application = web.Application()
+    application.router.add_post("/api/v1/chat/completions", handle)
+    runner = web.AppRunner(application, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        yield f"http://127.0.0.1:{port}/api/v1/chat/completions", requests
+    finally:
+        await runner.cleanup()
+
+
+@asynccontextmanager
+async def ai_service(respond: Respond) -> Any:
+    """AIService, который ходит в заглушку"""
+    async with openrouter_server(respond) as (url, requests):
+        service = bot.AIService()
+        service.api_url = url
+        await service.start()
+        try:
+            yield service, requests
+        finally:
+            await service.close()
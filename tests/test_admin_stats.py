@@ -0,0 +1,41 @@
+import asyncio
+
+import bot
+
+
+def test_worker_admin_view_is_reused_within_ttl(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot.config, "RUN_MODE", "worker")
+    monkeypatch.setattr(bot.config, "STATS_VIEW_TTL", 60.0)
+    monkeypatch.setattr(bot, "admin_view", None)
+    monkeypatch.setattr(bot, "admin_view_lock", asyncio.Lock())
+    
+    async def scenario():
+        store = bot.StatsStore(str(tmp_path / "stats.db"))
+        monkeypatch.setattr(bot, "stats", bot.Statistics(store))
+        loads = 0
+        load = bot.Statistics.load
+        
+        async def counting_load(self):
+            nonlocal loads
+            loads += 1
+            await load(self)
+        
+        monkeypatch.setattr(bot.Statistics, "load", counting_load)
+        try:
+            bot.stats.add_user(1)
+            first = await bot.admin_stats()
+            assert first is not bot.stats
+            assert first.get_users_count() == 1
+            
+            bot.stats.add_user(2)
+            views = await asyncio.gather(*(bot.admin_stats() for _ in range(5)))
+            assert all(view is first for view in views)
+            assert loads == 1
+            
+            monkeypatch.setattr(bot, "admin_view_expires", 0.0)
+            assert (await bot.admin_stats()).get_users_count() == 2
+            assert loads == 2
+        finally:
+            await store.close()
+    
+    asyncio.run(scenario())
@@ -0,0 +1,204 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+import bot
+from mock_openrouter import ai_service, completion, stream
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+PAYLOAD = {"messages": [{"role": "user", "content": "привет"}], "stream": False}
+
+
+@pytest.fixture(autouse=True)
+def fresh_routing(monkeypatch):
+    monkeypatch.setattr(bot, "scheduler", bot.RequestScheduler())
+    monkeypatch.setattr(bot, "model_router", bot.ModelRouter())
+    monkeypatch.setattr(bot.config, "RETRY_ATTEMPTS", 1)
+    monkeypatch.setattr(bot.config, "RETRY_BASE_DELAY", 0.0)
+
+
+def test_breaker_opens_and_lets_one_trial_through(monkeypatch):
+    monkeypatch.setattr(bot.config, "BREAKER_FAILURE_THRESHOLD", 2)
+    breaker = bot.CircuitBreaker()
+    
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow() and not breaker.available
+    
+    breaker.opened_at -= bot.config.BREAKER_RESET_TIMEOUT
+    assert breaker.available
+    assert breaker.allow()
+    assert breaker.state == "half-open"
+    assert not breaker.allow()  # пробный запрос уже идет
+    
+    breaker.record_failure()
+    assert breaker.state == "open"
+    
+    breaker.opened_at -= bot.config.BREAKER_RESET_TIMEOUT
+    assert breaker.allow()
+    breaker.record_cancel()
+    assert breaker.allow()  # отмененная проба не считается
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+
+
+def test_fallback_after_retries():
+    async def respond(model_key, body, request):
+        if model_key == "claude":
+            return web.json_response({"error": "overloaded"}, status=503)
+        return completion(f"ответ {model_key}")
+    
+    async def scenario():
+        async with ai_service(respond) as (service, requests):
+            chain = service._fallback_chain(False, "claude")
+            async with service._request(1, PAYLOAD, chain) as (served, response):
+                data = await response.json()
+            
+            assert served == chain[1]
+            assert data["choices"][0]["message"]["content"] == f"ответ {served}"
+            assert requests == {"claude": 2, served: 1}
+            assert service.breakers["claude"].failures == 2
+            assert service.breakers[served].state == "closed"
+            assert not any(bot.scheduler.active.values())
+    
+    run(scenario())
+
+
+def test_client_error_skips_retries_and_keeps_breaker_closed():
+    async def respond(model_key, body, request):
+        if model_key == "claude":
+            return web.json_response({"error": "bad request"}, status=400)
+        return completion("ok")
+    
+    async def scenario():
+        async with ai_service(respond) as (service, requests):
+            chain = service._fallback_chain(False, "claude")
+            async with service._request(1, PAYLOAD, chain) as (served, _):
+                pass
+            assert requests["claude"] == 1
+            assert service.breakers["claude"].failures == 0
+            assert served == chain[1]
+    
+    run(scenario())
+
+
+def test_open_breaker_is_skipped_and_all_failing_raises():
+    async def respond(model_key, body, request):
+        return web.json_response({"error": "down"}, status=502)
+    
+    async def scenario():
+        async with ai_service(respond) as (service, requests):
+            chain = service._fallback_chain(False, "claude")
+            breaker = service.breakers["claude"]
+            breaker.state, breaker.opened_at = "open", bot.time.monotonic()
+            
+            with pytest.raises(bot.AIServiceError):
+                async with service._request(1, PAYLOAD, chain):
+                    pass
+            assert "claude" not in requests
+            assert all(requests[key] == 2 for key in chain[1:])
+            assert not any(bot.scheduler.active.values())
+    
+    run(scenario())
+
+
+def test_error_while_reading_counts_against_the_model():
+    async def respond(model_key, body, request):
+        return completion("ok")
+    
+    async def scenario():
+        async with ai_service(respond) as (service, _):
+            with pytest.raises(bot.AIServiceError):
+                async with service._request(1, PAYLOAD, ["gpt4"]):
+                    raise bot.AIServiceError("оборванный ответ")
+            assert service.breakers["gpt4"].failures == 1
+            assert bot.model_router.errors["gpt4"] > 0
+    
+    run(scenario())
+
+
+def test_slow_request_is_hedged_to_the_second_model():
+    async def respond(model_key, body, request):
+        if model_key == "claude":
+            await asyncio.sleep(1.0)
+        return completion(model_key)
+    
+    async def scenario():
+        async with ai_service(respond) as (service, requests):
+            started = bot.time.monotonic()
+            served, response = await service._open_hedged(1, "claude", "gpt4", 0.05, PAYLOAD, None)
+            try:
+                assert served == "gpt4"
+                assert (await response.json())["choices"][0]["message"]["content"] == "gpt4"
+            finally:
+                response.release()
+                bot.scheduler.release(served)
+            
+            assert bot.time.monotonic() - started < 0.5
+            assert requests == {"claude": 1, "gpt4": 1}
+            assert (bot.model_router.hedged, bot.model_router.hedge_wins) == (1, 1)
+            assert not any(bot.scheduler.active.values())
+            assert not service.breakers["claude"].trial_in_flight
+    
+    run(scenario())
+
+
+def test_fast_request_is_not_hedged():
+    async def respond(model_key, body, request):
+        return completion(model_key)
+    
+    async def scenario():
+        async with ai_service(respond) as (service, requests):
+            served, response = await service._open_hedged(1, "claude", "gpt4", 0.5, PAYLOAD, None)
+            response.release()
+            bot.scheduler.release(served)
+            assert served == "claude"
+            assert requests == {"claude": 1}
+            assert bot.model_router.hedged == 0
+    
+    run(scenario())
+
+
+def test_stream_is_hedged_on_time_to_first_event():
+    async def respond(model_key, body, request):
+        # Заголовки и комментарий приходят сразу, событие у claude - нет
+        return await stream(request, model_key, 1.0 if model_key == "claude" else 0.0)
+    
+    async def scenario():
+        async with ai_service(respond) as (service, requests):
+            payload = {**PAYLOAD, "stream": True}
+            served, response = await service._open_hedged(1, "claude", "gpt4", 0.05, payload, None)
+            try:
+                lines = [line async for line in service._sse_lines(response)]
+            finally:
+                response.release()
+                bot.scheduler.release(served)
+            
+            assert served == "gpt4"
+            assert any(b'"gpt4"' in line for line in lines)
+            assert [line for line in lines if line.strip()][-1].strip() == b"data: [DONE]"
+            assert not any(bot.scheduler.active.values())
+    
+    run(scenario())
+
+
+def test_both_hedged_requests_failing_returns_none():
+    async def respond(model_key, body, request):
+        await asyncio.sleep(0.1 if model_key == "claude" else 0.0)
+        return web.json_response({"error": "down"}, status=503)
+    
+    async def scenario():
+        async with ai_service(respond) as (service, _):
+            assert await service._open_hedged(1, "claude", "gpt4", 0.05, PAYLOAD, None) is None
+            assert service.breakers["claude"].failures == 1
+            assert service.breakers["gpt4"].failures == 1
+            assert not any(bot.scheduler.active.values())
+    
+    run(scenario())
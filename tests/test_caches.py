@@ -0,0 +1,144 @@
+import asyncio
+
+import bot
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_image_waiter_loads_itself_when_loader_is_cancelled():
+    async def scenario():
+        cache = bot.ImageCache()
+        loads = []
+        
+        async def loader():
+            loads.append(asyncio.current_task())
+            await asyncio.sleep(0.05)
+            return {"type": "image_url", "image_url": {"url": bot.ImageData(b"jpeg", "image/jpeg")}}
+        
+        leader = asyncio.create_task(cache.get_or_load("f1", 1024, loader))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get_or_load("f1", 1024, loader))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        
+        part = await waiter
+        assert part["image_url"]["url"].data == b"jpeg"
+        assert leader.cancelled()
+        assert len(loads) == 2
+        assert cache.get("f1", 1024) is part
+    
+    run(scenario())
+
+
+def test_image_loader_error_reaches_waiters():
+    async def scenario():
+        cache = bot.ImageCache()
+        calls = 0
+        
+        async def loader():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            raise ValueError("broken file")
+        
+        results = await asyncio.gather(
+            *(cache.get_or_load("f2", 1024, loader) for _ in range(3)),
+            return_exceptions=True
+        )
+        assert calls == 1
+        assert all(isinstance(result, ValueError) for result in results)
+        assert not cache.inflight
+    
+    run(scenario())
+
+
+def test_image_cache_keeps_referenced_images_over_budget(monkeypatch):
+    monkeypatch.setattr(bot.config, "IMAGE_CACHE_MB", 1)
+    cache = bot.ImageCache()
+    cache.acquire("kept")
+    
+    def part(size):
+        return {"type": "image_url", "image_url": {"url": bot.ImageData(b"x" * size, "image/jpeg")}}
+    
+    cache.put("kept", 1024, part(600 * 1024))
+    cache.put("other", 1024, part(600 * 1024))
+    assert cache.get("kept", 1024) is not None
+    assert cache.get("other", 1024) is None
+    
+    cache.release("kept")
+    assert "kept" not in cache.refs
+
+
+def test_concurrent_lookups_share_one_request(monkeypatch):
+    monkeypatch.setattr(bot.config, "RESPONSE_CACHE_ENABLED", True)
+    
+    async def scenario():
+        cache = bot.ResponseCache()
+        assert await cache.lookup("k") is None  # ведущий
+        
+        waiters = [asyncio.create_task(cache.lookup("k")) for _ in range(3)]
+        await asyncio.sleep(0)
+        cache.complete("k", "ответ")
+        
+        assert await asyncio.gather(*waiters) == ["ответ"] * 3
+        assert await cache.lookup("k") == "ответ"
+        assert (cache.misses, cache.shared, cache.hits) == (1, 3, 1)
+    
+    run(scenario())
+
+
+def test_abort_promotes_exactly_one_waiter():
+    async def scenario():
+        cache = bot.ResponseCache()
+        assert await cache.lookup("k") is None
+        
+        waiters = [asyncio.create_task(cache.lookup("k")) for _ in range(3)]
+        await asyncio.sleep(0)
+        cache.abort("k")
+        await asyncio.wait(waiters, timeout=0.05)
+        
+        leaders = [task for task in waiters if task.done()]
+        assert len(leaders) == 1 and leaders[0].result() is None
+        
+        cache.complete("k", "со второй попытки")
+        results = await asyncio.gather(*waiters)
+        assert results.count(None) == 1
+        assert results.count("со второй попытки") == 2
+        assert not cache.inflight
+    
+    run(scenario())
+
+
+def test_cached_response_expires(monkeypatch):
+    monkeypatch.setattr(bot.config, "RESPONSE_CACHE_TTL", 0.05)
+    
+    async def scenario():
+        cache = bot.ResponseCache()
+        assert await cache.lookup("k") is None
+        cache.complete("k", "ответ")
+        assert await cache.lookup("k") == "ответ"
+        
+        await asyncio.sleep(0.06)
+        assert await cache.lookup("k") is None
+        assert cache.bytes_used == 0
+    
+    run(scenario())
+
+
+def test_cache_key_collapses_whitespace_but_keeps_case(monkeypatch):
+    monkeypatch.setattr(bot.config, "RESPONSE_CACHE_ENABLED", True)
+    cache = bot.ResponseCache()
+    payload = {"temperature": 0.7, "max_tokens": 1000}
+    
+    def key(text):
+        return cache.make_key("gpt4", [{"role": "user", "content": text}], payload)
+    
+    assert key("Что такое  IP?\n") == key("Что такое IP?")
+    assert key("Что такое IP?") != key("что такое ip?")
+    assert cache.make_key("gpt4", [
+        {"role": "user", "content": "раньше"},
+        {"role": "assistant", "content": "ответ"},
+        {"role": "user", "content": "Что такое IP?"},
+    ], payload) is None
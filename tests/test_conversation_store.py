@@ -0,0 +1,54 @@
+import asyncio
+import os
+import time
+
+import bot
+
+
+def test_maintain_removes_old_spill_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot.config, "CONV_SPILL_DIR", str(tmp_path))
+    monkeypatch.setattr(bot.config, "CONV_SPILL_TTL", 3600.0)
+    monkeypatch.setattr(bot.config, "CONV_IDLE_TTL", 0.0)
+    
+    async def scenario():
+        store = bot.ConversationStore()
+        await store.append(1, [{"role": "user", "content": "свежая история"}])
+        
+        old = tmp_path / "2.z"
+        old.write_bytes(b"old")
+        stale_tmp = tmp_path / "3.z.tmp"
+        stale_tmp.write_bytes(b"partial")
+        day_ago = time.time() - 24 * 3600
+        for path in (old, stale_tmp):
+            os.utime(path, (day_ago, day_ago))
+        
+        await store.maintain()
+        assert sorted(os.listdir(tmp_path)) == ["1.z"]
+        
+        # Выгруженная этим же проходом история поднимается обратно
+        _, history = await store.get_context(1)
+        assert [m["content"] for m in history] == ["свежая история"]
+        assert store.rehydrated == 1
+    
+    asyncio.run(scenario())
+
+
+def test_spill_sweep_runs_once_per_interval(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot.config, "CONV_SPILL_DIR", str(tmp_path))
+    monkeypatch.setattr(bot.config, "CONV_SPILL_TTL", 0.0)
+    
+    async def scenario():
+        store = bot.ConversationStore()
+        await store.maintain()
+        
+        (tmp_path / "5.z").write_bytes(b"x")
+        past = time.time() - 10
+        os.utime(tmp_path / "5.z", (past, past))
+        await store.maintain()
+        assert os.listdir(tmp_path) == ["5.z"]
+        
+        store.last_sweep -= bot.config.CONV_SPILL_SWEEP_INTERVAL
+        await store.maintain()
+        assert os.listdir(tmp_path) == []
+    
+    asyncio.run(scenario())
@@ -0,0 +1,82 @@
+import json
+import logging
+import queue
+import sys
+
+import pytest
+
+import bot
+
+
+def make_record(level=logging.ERROR, lineno=10, msg="Ошибка: %s", args=("x",), **extra):
+    record = logging.LogRecord("bot", level, "/app/bot.py", lineno, msg, args, None)
+    for name, value in extra.items():
+        setattr(record, name, value)
+    return record
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(bot.config, "LOG_SAMPLE_BURST", 2)
+    monkeypatch.setattr(bot.config, "LOG_SAMPLE_WINDOW", 60)
+    return now
+
+
+def test_sampler_passes_a_burst_per_window_and_counts_the_rest(clock):
+    sampler = bot.LogSampler()
+    passed = [sampler.filter(make_record()) for _ in range(5)]
+    assert passed == [True, True, False, False, False]
+    assert all(sampler.filter(make_record(level=logging.INFO)) for _ in range(5))
+    
+    clock[0] += 60
+    record = make_record()
+    assert sampler.filter(record)
+    assert record.suppressed == 3
+    assert not hasattr(make_record(), "suppressed")
+
+
+def test_sampler_keys_on_line_model_and_status(clock):
+    sampler = bot.LogSampler()
+    results = [sampler.filter(make_record(model="gpt4")) for _ in range(3)]
+    results += [sampler.filter(make_record(model="claude")) for _ in range(2)]
+    results += [sampler.filter(make_record(model="gpt4", status=503))]
+    results += [sampler.filter(make_record(lineno=11, model="gpt4"))]
+    assert results == [True, True, False, True, True, True, True]
+
+
+def test_queue_handler_truncates_and_drops_when_full(monkeypatch):
+    monkeypatch.setattr(bot.config, "LOG_MAX_FIELD", 20)
+    handler = bot.LogQueueHandler(queue.Queue(1))
+    
+    try:
+        raise ValueError("x" * 200)
+    except ValueError:
+        record = make_record(msg="Ответ: %s", args=("y" * 100,))
+        record.exc_info = sys.exc_info()
+    handler.handle(record)
+    
+    queued = handler.queue.get_nowait()
+    assert queued.getMessage().startswith("Ответ: yyyy")
+    assert queued.getMessage().endswith("(+87)")
+    assert queued.exc_info is None
+    assert queued.exc_text.startswith("... (+") and len(queued.exc_text) < 120
+    assert record.args == ("y" * 100,)  # исходная запись не меняется
+    
+    dropped = bot.metrics.log_dropped.values[("queue_full",)]
+    handler.handle(make_record())
+    handler.handle(make_record())
+    assert bot.metrics.log_dropped.values[("queue_full",)] == dropped + 1
+
+
+def test_json_formatter_writes_known_fields():
+    record = make_record(
+        level=logging.INFO, msg="Ответ модели", args=(),
+        user_id=7, model="gpt4", latency=0.25, tokens=None, password="secret"
+    )
+    entry = json.loads(bot.JsonFormatter().format(record))
+    assert entry["msg"] == "Ответ модели"
+    assert entry["level"] == "INFO"
+    assert (entry["user_id"], entry["model"], entry["latency"]) == (7, "gpt4", 0.25)
+    assert "tokens" not in entry and "password" not in entry
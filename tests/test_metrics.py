@@ -0,0 +1,19 @@
+import bot
+
+
+def test_render_keeps_large_values_exact():
+    registry = bot.Metrics()
+    counter = bot.Counter("test_responses_total", "Ответы", ("status",))
+    histogram = bot.Histogram("test_seconds", "Время", buckets=(1.0,))
+    registry.metrics = [counter, histogram]
+    
+    counter.inc("200", amount=1234567)
+    histogram.observe(0.5)
+    histogram.observe(1234567.25)
+    histogram.values[()][0][0] = 1234567  # столько же наблюдений, без цикла
+    
+    lines = registry.render().splitlines()
+    assert 'test_responses_total{status="200"} 1234567.0' in lines
+    assert 'test_seconds_bucket{le="1.0"} 1234567' in lines
+    assert 'test_seconds_count 1234568' in lines
+    assert 'test_seconds_sum 1234567.75' in lines
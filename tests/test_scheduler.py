@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def model(monkeypatch):
+    monkeypatch.setitem(bot.config.MODELS, "test", {"name": "Test", "max_concurrency": 1})
+    return "test"
+
+
+def test_waiters_are_served_round_robin_with_positions(model):
+    async def scenario():
+        scheduler = bot.RequestScheduler()
+        await scheduler.acquire(1, model)
+        served = []
+        positions = {}
+        
+        async def request(user_id, label):
+            async def on_queued(position):
+                positions[label] = position
+            
+            async with scheduler.slot(user_id, model, on_queued):
+                served.append(label)
+                await asyncio.sleep(0)
+        
+        tasks = []
+        for user_id, label in ((2, "a1"), (2, "a2"), (2, "a3"), (3, "b1")):
+            tasks.append(asyncio.create_task(request(user_id, label)))
+            await asyncio.sleep(0)
+        assert scheduler.queue_depth(model) == 4
+        
+        scheduler.release(model)
+        await asyncio.gather(*tasks)
+        
+        assert served == ["a1", "b1", "a2", "a3"]
+        assert positions == {"a1": 1, "a2": 2, "a3": 3, "b1": 2}
+        assert scheduler.active[model] == 0
+    
+    run(scenario())
+
+
+def test_admin_goes_before_the_queue(model, monkeypatch):
+    monkeypatch.setattr(bot.config, "ADMIN_ID", 99)
+    
+    async def scenario():
+        scheduler = bot.RequestScheduler()
+        await scheduler.acquire(1, model)
+        served = []
+        positions = []
+        
+        async def request(user_id):
+            async def on_queued(position):
+                positions.append((user_id, position))
+            
+            await scheduler.acquire(user_id, model, on_queued)
+            served.append(user_id)
+            scheduler.release(model)
+        
+        tasks = [asyncio.create_task(request(user_id)) for user_id in (2, 3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request(99)))
+        await asyncio.sleep(0)
+        
+        scheduler.release(model)
+        await asyncio.gather(*tasks)
+        assert served == [99, 2, 3]
+        assert (99, 1) in positions
+    
+    run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue(model):
+    async def scenario():
+        scheduler = bot.RequestScheduler()
+        await scheduler.acquire(1, model)
+        
+        waiter = asyncio.create_task(scheduler.acquire(2, model))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler.queue_depth(model) == 0
+        
+        scheduler.release(model)
+        assert scheduler.active[model] == 0
+    
+    run(scenario())
+
+
+def test_full_queue_rejects_new_requests(model, monkeypatch):
+    monkeypatch.setattr(bot.config, "SCHED_MAX_QUEUE", 1)
+    
+    async def scenario():
+        scheduler = bot.RequestScheduler()
+        await scheduler.acquire(1, model)
+        waiter = asyncio.create_task(scheduler.acquire(2, model))
+        await asyncio.sleep(0)
+        
+        with pytest.raises(bot.AIServiceError):
+            await scheduler.acquire(3, model)
+        assert scheduler.rejected == 1
+        
+        scheduler.release(model)
+        await waiter
+        scheduler.release(model)
+    
+    run(scenario())
+
+
+def test_rate_limit_allows_burst_then_refills(monkeypatch):
+    monkeypatch.setattr(bot.config, "SCHED_USER_BURST", 2)
+    monkeypatch.setattr(bot.config, "SCHED_USER_RATE", 60.0)
+    monkeypatch.setattr(bot.config, "ADMIN_ID", 99)
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    scheduler = bot.RequestScheduler()
+    
+    scheduler.admit(1)
+    scheduler.admit(1)
+    with pytest.raises(bot.AIServiceError, match="1 сек"):
+        scheduler.admit(1)
+    assert scheduler.rate_limited == 1
+    
+    scheduler.admit(2)  # у каждого пользователя своя корзина
+    for _ in range(5):
+        scheduler.admit(99)
+    
+    now[0] += 1.0
+    scheduler.admit(1)
+    with pytest.raises(bot.AIServiceError):
+        scheduler.admit(1)
@@ -0,0 +1,118 @@
+import asyncio
+import os
+
+import bot
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def make_snapshot():
+    backend = bot.MemoryBackend()
+    return bot.StateSnapshot(bot.ConversationStore(backend), bot.UserState(backend))
+
+
+def history(messages):
+    return [m["content"] for m in messages]
+
+
+def test_snapshot_restores_users_on_first_update(monkeypatch, tmp_path):
+    path = tmp_path / "state.snap"
+    monkeypatch.setattr(bot.config, "SNAPSHOT_PATH", str(path))
+    image = {"file_id": "f", "file_unique_id": "u-snap", "mime_type": "image/jpeg"}
+    
+    async def scenario():
+        before = make_snapshot()
+        await before.conversations.append(1, [
+            {"role": "user", "content": "вопрос"},
+            {"role": "assistant", "content": "ответ"},
+        ])
+        await before.conversations.append(2, [{"role": "user", "content": "второй"}])
+        await before.users.set_model(1, "gpt4")
+        await before.users.set_images(2, [image])
+        await before.save()
+        
+        after = make_snapshot()
+        after.open()
+        assert after.count == 2
+        assert not path.exists()  # снимок используется один раз
+        
+        await after.page_in(1)
+        await after.page_in(3)  # нет в снимке
+        assert history(await after.conversations.get(1)) == ["вопрос", "ответ"]
+        assert await after.users.get_model(1) == "gpt4"
+        assert await after.conversations.get(2) == []
+        assert after.restored == 1
+        
+        await after.page_in(2)
+        assert await after.users.get_images(2) == [image]
+        assert bot.image_cache.refs["u-snap"] == 1
+        bot.image_cache.release("u-snap")
+        after.close()
+    
+    run(scenario())
+
+
+def test_unvisited_users_carry_over_to_the_next_snapshot(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot.config, "SNAPSHOT_PATH", str(tmp_path / "state.snap"))
+    
+    async def scenario():
+        first = make_snapshot()
+        for user_id in (1, 2):
+            await first.conversations.append(user_id, [{"role": "user", "content": f"старое {user_id}"}])
+        await first.save()
+        
+        second = make_snapshot()
+        second.open()
+        await second.page_in(1)
+        await second.conversations.append(1, [{"role": "user", "content": "новое 1"}])
+        await second.save()
+        second.close()
+        
+        third = make_snapshot()
+        third.open()
+        for user_id in (1, 2):
+            await third.page_in(user_id)
+        assert history(await third.conversations.get(1)) == ["старое 1", "новое 1"]
+        assert history(await third.conversations.get(2)) == ["старое 2"]
+        third.close()
+    
+    run(scenario())
+
+
+def test_page_in_does_not_overwrite_newer_history(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot.config, "SNAPSHOT_PATH", str(tmp_path / "state.snap"))
+    
+    async def scenario():
+        before = make_snapshot()
+        await before.conversations.append(1, [{"role": "user", "content": "из снимка"}])
+        await before.save()
+        
+        after = make_snapshot()
+        after.open()
+        await after.conversations.append(1, [{"role": "user", "content": "уже после запуска"}])
+        await after.page_in(1)
+        await after.page_in(1)
+        assert history(await after.conversations.get(1)) == ["уже после запуска"]
+        after.close()
+    
+    run(scenario())
+
+
+def test_damaged_snapshot_is_skipped(monkeypatch, tmp_path):
+    path = tmp_path / "state.snap"
+    path.write_bytes(b"not a snapshot")
+    monkeypatch.setattr(bot.config, "SNAPSHOT_PATH", str(path))
+    
+    snapshot = make_snapshot()
+    snapshot.open()
+    assert snapshot.mm is None
+    assert path.exists()
+    run(snapshot.page_in(1))
+    assert snapshot.restored == 0
+    
+    os.remove(path)
+    path.write_bytes(b"")
+    snapshot.open()
+    assert snapshot.mm is None
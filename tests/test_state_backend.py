@@ -0,0 +1,196 @@
+import asyncio
+import time
+
+import pytest
+
+import bot
+from fake_redis import fake_redis_server
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_state_backend_is_abstract():
+    with pytest.raises(TypeError):
+        bot.StateBackend()
+
+
+def test_commands_of_one_iteration_share_a_write():
+    async def scenario():
+        async with fake_redis_server() as (fake, url):
+            backend = bot.RedisBackend(url)
+            try:
+                await backend.set("warmup", b"1")
+                batches, reads = backend.batches, fake.reads
+                
+                await asyncio.gather(*(backend.set(f"k{i}", str(i).encode()) for i in range(50)))
+                assert backend.batches == batches + 1
+                assert fake.reads == reads + 1
+                
+                counts = await asyncio.gather(*(backend.hincrby("h", "n") for _ in range(20)))
+                assert sorted(counts) == list(range(1, 21))
+                assert backend.batches == batches + 2
+                
+                values = await asyncio.gather(*(backend.get(f"k{i}", cached=False) for i in range(50)))
+                assert values == [str(i).encode() for i in range(50)]
+            finally:
+                await backend.close()
+    
+    run(scenario())
+
+
+def test_read_cache_expires(monkeypatch):
+    monkeypatch.setattr(bot.config, "STATE_CACHE_TTL", 0.05)
+    
+    async def scenario():
+        async with fake_redis_server() as (fake, url):
+            backend = bot.RedisBackend(url)
+            try:
+                await backend.set("model:1", b"gpt4")
+                assert await backend.get("model:1") == b"gpt4"
+                
+                fake.strings[b"model:1"] = (b"claude", None)  # запись другой реплики
+                assert await backend.get("model:1") == b"gpt4"
+                assert await backend.get("model:1", cached=False) == b"claude"
+                
+                fake.strings[b"model:1"] = (b"gemini", None)
+                await asyncio.sleep(0.06)
+                assert await backend.get("model:1") == b"gemini"
+                
+                await backend.delete("model:1")
+                assert await backend.get("model:1") is None
+            finally:
+                await backend.close()
+    
+    run(scenario())
+
+
+def test_ttl_is_sent_to_the_server():
+    async def scenario():
+        async with fake_redis_server() as (fake, url):
+            backend = bot.RedisBackend(url)
+            try:
+                await backend.set("img:1", b"[]", ttl=0.05)
+                assert await backend.get("img:1", cached=False) == b"[]"
+                await asyncio.sleep(0.06)
+                assert await backend.get("img:1", cached=False) is None
+            finally:
+                await backend.close()
+    
+    run(scenario())
+
+
+def test_replicas_share_conversation_history(monkeypatch):
+    monkeypatch.setattr(bot.config, "STATE_CACHE_TTL", 0.05)
+    
+    async def scenario():
+        async with fake_redis_server() as (fake, url):
+            first, second = bot.RedisBackend(url), bot.RedisBackend(url)
+            try:
+                store_a = bot.ConversationStore(first)
+                store_b = bot.ConversationStore(second)
+                
+                await store_a.append(7, [
+                    {"role": "user", "content": "привет"},
+                    {"role": "assistant", "content": "здравствуйте"},
+                ])
+                _, history = await store_b.get_context(7)
+                assert [m["content"] for m in history] == ["привет", "здравствуйте"]
+                
+                await store_b.append(7, [{"role": "user", "content": "еще вопрос"}])
+                await asyncio.sleep(0.06)
+                _, history = await store_a.get_context(7)
+                assert [m["content"] for m in history] == ["привет", "здравствуйте", "еще вопрос"]
+                
+                await store_a.clear(7)
+                await asyncio.sleep(0.06)
+                assert await store_b.get_context(7) == (None, [])
+            finally:
+                await first.close()
+                await second.close()
+    
+    run(scenario())
+
+
+def test_backend_stats_store_load_and_compact():
+    async def scenario():
+        async with fake_redis_server() as (fake, url):
+            backend = bot.RedisBackend(url)
+            try:
+                store = bot.BackendStatsStore(backend)
+                stats = bot.Statistics(store)
+                for user_id in (1, 2, 2, 3):
+                    stats.add_request(user_id)
+                stats.add_image(3)
+                stats.add_usage(2, "gpt4", 100, 20, 0.5, 1.0, 2.0, cached_tokens=40)
+                await stats.flush()
+                
+                loaded = bot.Statistics(store)
+                await loaded.load()
+                assert loaded.get_users_count() == 3
+                assert loaded.get_requests_count() == 4
+                assert loaded.get_requests_count(1) == 4
+                assert loaded.get_images_count() == 1
+                assert loaded.get_top_users(1) == [(2, 2)]
+                usage = loaded.get_usage_by_model()["gpt4"]
+                assert (usage["requests"], usage["prompt_tokens"], usage["cached_tokens"]) == (1, 100, 40)
+                
+                min_hour, min_day = stats._retention_bounds()
+                old_day = min_day - 1
+                await store.write_batch({
+                    "users": {},
+                    "hourly": {("requests", min_hour - 1): 5},
+                    "daily": {("requests", old_day): 5},
+                    "totals": {},
+                    "usage": {("daily", (old_day, "gpt4")): [1, 0, 0, 0, 0, 0, 0]},
+                })
+                await store.compact(min_hour, min_day)
+                
+                assert str(min_hour - 1).encode() not in fake.hashes[b"stats:hourly:requests"]
+                assert str(old_day).encode() not in fake.hashes[b"stats:daily:requests"]
+                assert f"daily:{old_day}:gpt4".encode() not in fake.hashes[b"stats:usage"]
+                assert f"stats:usage:daily:{old_day}:gpt4".encode() not in fake.hashes
+                
+                reloaded = bot.Statistics(store)
+                await reloaded.load()
+                assert reloaded.get_requests_count(1) == 4
+            finally:
+                await backend.close()
+    
+    run(scenario())
+
+
+def test_commands_wait_for_auth_and_select():
+    async def scenario():
+        async with fake_redis_server(password="secret", db=3) as (fake, url):
+            backend = bot.RedisBackend(url)
+            try:
+                first = asyncio.create_task(backend.set("k0", b"0"))
+                others = []
+                while not first.done():
+                    # Команды других корутин во время подключения
+                    others.append(asyncio.create_task(backend.set(f"k{len(others) + 1}", b"1")))
+                    await asyncio.sleep(0)
+                await asyncio.gather(first, *others)
+                
+                assert len(fake.command_dbs) == len(others) + 1
+                assert {db for db, _ in fake.command_dbs} == {3}
+            finally:
+                await backend.close()
+    
+    run(scenario())
+
+
+def test_wrong_password_fails_the_command():
+    async def scenario():
+        async with fake_redis_server(password="secret") as (fake, url):
+            backend = bot.RedisBackend(url.replace("secret", "wrong"))
+            try:
+                with pytest.raises(bot.RedisError):
+                    await backend.set("k", b"v")
+                assert backend.writer is None
+            finally:
+                await backend.close()
+    
+    run(scenario())
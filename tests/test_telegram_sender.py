@@ -0,0 +1,143 @@
+import asyncio
+import random
+import re
+
+import bot
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class FakeMethod:
+    def __init__(self, chat_id, label):
+        self.chat_id = chat_id
+        self.label = label
+
+
+def test_one_call_per_chat_while_waiting_for_bot_token(monkeypatch):
+    monkeypatch.setattr(bot.config, "SEND_GLOBAL_RATE", 20.0)
+    
+    async def scenario():
+        sender = bot.TelegramSender()
+        sender.global_tokens = 0.0  # первый вызов ждет токен бота
+        in_flight = {}
+        peak = {}
+        order = []
+        
+        async def make_request(_, method):
+            in_flight[method.chat_id] = in_flight.get(method.chat_id, 0) + 1
+            peak[method.chat_id] = max(peak.get(method.chat_id, 0), in_flight[method.chat_id])
+            order.append(method.label)
+            await asyncio.sleep(0.2)
+            in_flight[method.chat_id] -= 1
+            return method.label
+        
+        try:
+            first = asyncio.create_task(sender(make_request, None, FakeMethod(1, "first")))
+            await asyncio.sleep(0.01)  # цикл спит в ожидании токена бота
+            second = asyncio.create_task(sender(make_request, None, FakeMethod(1, "second")))
+            assert await asyncio.gather(first, second) == ["first", "second"]
+        finally:
+            await sender.close()
+        
+        assert order == ["first", "second"]
+        assert peak == {1: 1}
+    
+    run(scenario())
+
+
+def test_replies_go_before_progress_edits():
+    async def scenario():
+        sender = bot.TelegramSender()
+        order = []
+        gate = asyncio.Event()
+        
+        async def make_request(_, method):
+            if method.label == "blocker":
+                await gate.wait()
+            order.append(method.label)
+            return method.label
+        
+        async def send(label, priority):
+            token = bot.send_priority.set(priority)
+            try:
+                return await sender(make_request, None, FakeMethod(1, label))
+            finally:
+                bot.send_priority.reset(token)
+        
+        try:
+            calls = [asyncio.create_task(send("blocker", bot.SEND_PRIORITY_REPLY))]
+            await asyncio.sleep(0.01)
+            calls.append(asyncio.create_task(send("edit", bot.SEND_PRIORITY_PROGRESS)))
+            calls.append(asyncio.create_task(send("reply", bot.SEND_PRIORITY_REPLY)))
+            await asyncio.sleep(0.01)
+            gate.set()
+            await asyncio.gather(*calls)
+        finally:
+            await sender.close()
+        
+        assert order == ["blocker", "reply", "edit"]
+    
+    run(scenario())
+
+
+def check_part(part, limit):
+    assert len(part) <= limit, (len(part), limit)
+    # Без оборванной разметки: после удаления целых тегов и сущностей не остается < и &
+    stripped = bot.HTML_TOKEN_RE.sub("", part)
+    assert "<" not in stripped and "&" not in stripped, part
+    stack = []
+    for match in bot.HTML_TOKEN_RE.finditer(part):
+        if not match.group(2):
+            continue
+        if match.group(1):
+            assert stack and stack[-1] == match.group(2), (part, stack)
+            stack.pop()
+        else:
+            stack.append(match.group(2))
+    assert not stack, part
+
+
+def random_html(rng):
+    out = []
+    for _ in range(rng.randint(1, 60)):
+        r = rng.random()
+        if r < 0.15:
+            tag = rng.choice(["b", "i", "code"])
+            words = ["alpha", "&amp;", "&lt;", "x" * rng.randint(1, 80), "word"]
+            inner = " ".join(rng.choice(words) for _ in range(rng.randint(1, 8)))
+            out.append(f"<{tag}>{inner}</{tag}>")
+        elif r < 0.2:
+            out.append(f'<a href="http://e.com/{"p" * rng.randint(1, 150)}">link text</a>')
+        elif r < 0.3:
+            out.append("y" * rng.randint(50, 300))
+        elif r < 0.35:
+            out.append("<b><i>" + "z " * rng.randint(1, 40) + "</i></b>")
+        else:
+            out.append(rng.choice(["Hello.", "world", "&quot;q&quot;", "\n\n", "\n", "a, b; c!"]))
+        out.append(rng.choice([" ", "", "\n"]))
+    return "".join(out)
+
+
+def visible_text(text):
+    return re.sub(r"\s+", "", bot.HTML_TOKEN_RE.sub("", text))
+
+
+def test_split_message_keeps_markup_within_limit():
+    rng = random.Random(1)
+    for _ in range(3000):
+        text = random_html(rng)
+        limit = rng.choice([40, 64, 100, 200, 4096])
+        parts = bot.split_message(text, limit)
+        for part in parts:
+            check_part(part, limit)
+        assert visible_text(text) == "".join(visible_text(part) for part in parts), (text, parts)
+
+
+def test_split_message_drops_tag_longer_than_limit():
+    text = '<a href="' + "u" * 300 + '">text</a> more words here'
+    parts = bot.split_message(text, 100)
+    for part in parts:
+        check_part(part, 100)
+    assert "".join(parts).split() == ["text", "more", "words", "here"]